@@ -10,30 +10,46 @@
 from __future__ import absolute_import, division, unicode_literals
 
 import json
-from collections import Mapping
-from copy import copy
+import signal
 
 import boto
 import boto.ec2
 import boto.vpc
-from fabric.api import settings as fabric_settings
-from fabric.context_managers import hide
-from fabric.operations import sudo
-from fabric.state import env
 
 import mo_json_config
 import mo_math
 from jx_python import jx
-from mo_collections import UniqueIndex
-from mo_dots import Data, FlatList, Null, coalesce, listwrap, literal_field, unwrap, wrap, wrap_leaves
-from mo_future import text
+from mo_dots import Data, FlatList, Null, coalesce, listwrap, unwrap, wrap
+from mo_future import first, text
 from mo_http import http
 from mo_json import json2value, value2json
 from mo_logs import Log, constants, machine_metadata, startup, strings
 from mo_math import MAX, MIN, SUM
 from mo_math.randoms import Random
 from mo_threads import Signal, Thread, Till, MAIN_THREAD
-from mo_times import Date, Timer
+from mo_times import Date, Duration, Timer
+
+from balancer import tables
+from balancer.cycle import CycleState
+from balancer.forecast import DiskForecast
+from balancer.history import MoveHistory
+from balancer.inventory import DirectoryInventory, shard_digest
+from balancer.load import LoadModel
+from balancer.metrics import CycleMetrics
+from balancer.model import Allocation, NamedIndex, Node, Shard, Zone
+from balancer.patterns import IndexRules
+from balancer.plan import MovePlan
+from balancer.planner import GlobalPlanner, random_plan
+from balancer.preemption import Preemption
+from balancer.recorder import Recorder, Replayer
+from balancer.recovery import RecoveryTracker
+from balancer.rejections import TOO_MANY_COPIES, RejectionCache, failure_class
+from balancer.reroute import RerouteBatch
+from balancer.sampler import CycleProfiler
+from balancer.scanner import DATA_PATH, DEFAULT_CONNECTIONS, DEFAULT_THREADS, DirectoryScanner, SshPool
+from balancer.scheduler import RecoveryScheduler
+from balancer.snapshot import ClusterSnapshot
+from balancer.trigger import CycleTrigger
 
 DEBUG = True
 
@@ -42,16 +58,19 @@ BILLION = 1024 * 1024 * 1024
 BIG_SHARD_SIZE = 2 * BILLION  # SIZE WHEN WE SHOULD BE MOVING ONLY ONE SHARD AT A TIME
 MAX_MOVE_FAILURES = 3  # STOP TRYING TO MOVE
 
-current_moving_shards = FlatList()  # BECAUSE ES WILL NOT TELL US WHERE THE SHARDS ARE MOVING TO
+recovery_tracker = RecoveryTracker()  # WHERE THE SHARDS ARE MOVING TO, AND HOW FAST
 
 DEAD = "DEAD"
 ALIVE = "ALIVE"
 last_known_node_status = Data()
 last_scrubbing = Data()
+cycle_state = CycleState()  # MODEL FROM THE PREVIOUS CYCLE, FOR incremental MODE
+recovery_scheduler = RecoveryScheduler()  # BYTES IN FLIGHT, AND MEASURED RECOVERY RATES, PER NODE
 
 IDENTICAL_NODE_ATTRIBUTE = "xpack.installed"  # SOME node.attr[IDENTICAL_NODE_ATTRIBUTE] ALL THE SAME, REQUIRED FOR IMBALANCED SHARD ALLOCATION
 
 ACCEPT_DATA_LOSS = False
+PLAN_ONLY = False  # PLAN THE MOVES, BUT DO NOT CHANGE THE CLUSTER
 ALLOCATE_REPLICA = "allocate_replica"
 ALLOCATE_STALE_PRIMARY = "allocate_stale_primary"
 ALLOCATE_EMPTY_PRIMARY = "allocate_empty_primary"
@@ -61,6 +80,44 @@ def assign_shards(settings):
     """
     ASSIGN THE UNASSIGNED SHARDS
     """
+    metrics = get_metrics(settings)
+    metrics.start()
+    cycle_profiler.cycle_start()
+    if cycle_recorder:
+        cycle_recorder.cycle_start()
+    try:
+        _assign_shards(settings, metrics)
+    finally:
+        if cycle_recorder:
+            cycle_recorder.cycle_end()
+        if move_history is not None and not PLAN_ONLY:
+            move_history.save()
+        cycle_profiler.cycle_end()
+        summary = metrics.finish()
+        Log.note(
+            "Cycle took {{wall}} seconds ({{cpu}} seconds CPU)",
+            wall=mo_math.round(summary["wall"], decimal=2),
+            cpu=mo_math.round(summary["cpu"], decimal=2)
+        )
+
+
+cycle_metrics = None  # TIMINGS AND COUNTERS OF THE CURRENT CYCLE
+cycle_profiler = CycleProfiler()  # OFF UNTIL ASKED, BY settings.profile.start OR SIGUSR1
+cycle_recorder = None  # RECORDS THE CLUSTER STATE OF EACH CYCLE, WHEN settings.record.directory IS SET
+
+
+def get_metrics(settings):
+    global cycle_metrics
+    if cycle_metrics is None:
+        cycle_metrics = CycleMetrics(settings.metrics.filename, settings.metrics.max_bytes, settings.metrics.prometheus)
+    return cycle_metrics
+
+
+def _assign_shards(settings, metrics):
+    global move_plan
+    move_plan = MovePlan()
+    get_move_history(settings).prune()
+    metrics.phase("fetch")
     path = settings.elasticsearch.host + ":" + text(settings.elasticsearch.port)
     # GET LIST OF NODES
     # coordinator    26.2gb
@@ -76,24 +133,28 @@ def assign_shards(settings):
     # TODO: PULL DATA ABOUT NODES TO INCLUDE THE USER DEFINED ZONES
     #
 
-    zones = UniqueIndex("name")
-    for z in settings.zones:
-        z.num_nodes=0
-        zones.add(z)
-
-    stats = http.get_json(path+"/_nodes/stats")
-    nodes = UniqueIndex("name", [
-        {
-            "name": n.name,
-            "ip": n.host,
-            "roles": n.roles,
-            "zone": zones[n.attributes.zone],
-            "memory": n.jvm.mem.heap_max_in_bytes,
-            "disk": n.fs.total.total_in_bytes,
-            "disk_free": n.fs.total.available_in_bytes
-        }
+    stats, shard_rows, index_rows = tables.get_cluster_state(path)
+    if recovery_tracker.refresh(path):
+        recovery_scheduler.observe(recovery_tracker)
+
+    metrics.phase("parse")
+    zones = NamedIndex(Zone.from_settings(z) for z in settings.zones)
+    nodes = NamedIndex(
+        Node(
+            name=n.name,
+            ip=n.host,
+            roles=n.roles,
+            zone=zones[n.attributes.zone],
+            memory=n.jvm.mem.heap_max_in_bytes,
+            disk=n.fs.total.total_in_bytes,
+            disk_free=n.fs.total.available_in_bytes,
+            started=(n.jvm.timestamp - n.jvm.uptime_in_millis) / 1000 if n.jvm.uptime_in_millis else None
+        )
         for k, n in stats.nodes.items()
-    ])
+    )
+    moving_shards = get_relocations(shard_rows, nodes)
+    recovery_tracker.set_relocating(moving_shards)
+
     # if "primary" not in nodes or "secondary" not in nodes:
     #     Log.error("missing an important index\n{{nodes|json}}", nodes=nodes)
 
@@ -106,8 +167,7 @@ def assign_shards(settings):
     for n in settings.nodes:
         node = nodes[n.name]
         if node:
-            for k, v in n.items():
-                node[k] = v
+            node.override(n)
             node.disk_free = MIN([node.disk_free, node.disk])
 
     # REVIEW NODE STATUS, AND ANY CHANGES
@@ -130,170 +190,204 @@ def assign_shards(settings):
             Log.warning("Lost node {{node}}", node=n)
             last_known_node_status[n] = DEAD
 
-    for _, siblings in jx.groupby(nodes, "zone.name"):
-        siblings = wrap(filter(lambda n: 'data' in n.roles, siblings))
+    siblings_by_zone = {}
+    for n in nodes:
+        if 'data' in n.roles:
+            siblings_by_zone.setdefault(n.zone.name, []).append(n)
+    for siblings in siblings_by_zone.values():
         for s in siblings:
             s.siblings = len(siblings)
-            s.zone.memory = SUM(siblings.memory)
+            s.zone.memory = SUM(n.memory for n in siblings)
 
-    Log.note("{{num}} nodes", num=len(nodes))
+    # BUSY NODES ARE GIVEN A SMALLER SHARE OF EACH INDEX, AS IF THEY HAD LESS MEMORY
+    load = get_load_model(settings)
+    if settings.load.enabled:
+        try:
+            load.observe(
+                tables.get_shard_stats(path, {k: n.name for k, n in stats.nodes.items()}),
+                [n.name for siblings in siblings_by_zone.values() for n in siblings],
+                recovery_tracker.clock()
+            )
+            DEBUG and Log.note(
+                "Node load {{scores|json}}",
+                scores={n.name: mo_math.round(load.score(n.name), digits=2) for n in nodes if 'data' in n.roles}
+            )
+        except Exception as e:
+            Log.warning("Can not read shard stats, using the load of the last cycle", cause=e)
+    forecast = get_disk_forecast(settings)
+    forecast.observe(nodes, recovery_tracker, recovery_tracker.clock())
 
-    # INDEX-LEVEL INFORMATION
-    uuid_to_index_name = {i.uuid: i.index
-        for i in convert_table_to_list(
-            http.get(path + "/_cat/indices").content,
-            ["status", "state", "index", "uuid", "_remainder"]
-        )
-    }
+    capacity = {}  # MAP FROM node name TO memory, SCALED BY LOAD
+    zone_capacity = {}  # MAP FROM zone name TO TOTAL capacity
+    for siblings in siblings_by_zone.values():
+        for s in siblings:
+            capacity[s.name] = coalesce(s.memory, 0) * load.capacity(s.name)
+            zone_capacity[s.zone.name] = zone_capacity.get(s.zone.name, 0) + capacity[s.name]
+
+    Log.note("{{num}} nodes", num=len(nodes))
 
     # GET LIST OF SHARDS, WITH STATUS
     # debug20150915_172538                0  p STARTED        37319   9.6mb 172.31.0.196 primary
     # debug20150915_172538                0  r UNASSIGNED
     # debug20150915_172538                1  p STARTED        37624   9.6mb 172.31.0.39  secondary
     # debug20150915_172538                1  r UNASSIGNED
-    shards = wrap(list(convert_table_to_list(
-        http.get(path + "/_cat/shards").content,
-        ["index", "i", "type", "status", "num", "size", "ip", "node"]
-    )))
-    current_moving_shards.__clear__()
-    for s in shards:
-        s.i = int(s.i)
-        s.size = text_to_bytes(s.size)
-        if s.node.find(" -> ") != -1:
-            m = s.node.split(" -> ")
-            s.node = m[0]  # <from> " -> " <to> format
-            destination = m[1].split(" ")[-1]
-            if nodes[destination]:
-                destination = nodes[destination]
-            else:
-                for n in nodes:
-                    if n.ip == destination:
-                        destination = n
-                        break
-
-            current_moving_shards.append({
-                "index": s.index,
-                "shard": s.i,
-                "from_node": m[0],
-                "to_node": destination.name
-            })
-            # shards.append(set_default({"node": destination}, s))
-        s.node = nodes[s.node]
+    shards = []
+    for index, i, type_, status, num, size, ip, node in shard_rows:
+        if node and node.find(" -> ") != -1:
+            # <from> " -> " <to> format, THE DESTINATION IS IN moving_shards
+            node = node.split(" -> ")[0]
+        shards.append(Shard(index, i, type_, status, num, size, ip, nodes[node]))
 
     Log.note("TOTAL SHARDS: {{num}}", num=len(shards))
-    Log.note("{{num}} shards moving", num=len(current_moving_shards))
+    Log.note("{{num}} shards moving", num=len(moving_shards))
+
+    # COMPARE WITH PREVIOUS CYCLE
+    state = cycle_state if settings.incremental else CycleState()
+    delta = state.update(nodes, shards)
+    Log.note(
+        "Delta: {{new}} new, {{removed}} removed, {{changed}} changed shards; {{joined}} nodes joined, {{lost}} lost",
+        new=delta.new_shards,
+        removed=delta.removed_shards,
+        changed=delta.changed_shards,
+        joined=len(delta.joined),
+        lost=len(delta.lost)
+    )
+
+    # INDEX-LEVEL INFORMATION
+    state.uuid_to_index_name = {uuid: index for _, _, index, uuid in index_rows}
+    uuid_to_index_name = state.uuid_to_index_name
 
     # TODO: MAKE ZONE OBJECTS TO STORE THE NUMBER OF REPLICAS
 
+    # ALL PASSES USE THE SNAPSHOT INSTEAD OF REGROUPING THE SHARDS
+    snapshot = ClusterSnapshot(shards)
+
     # ASSIGN SIZE TO ALL SHARDS
+    snapshot.normalize_sizes()
     red_shards = []
-    for g, replicas in jx.groupby(shards, ["index", "i"]):
+    for g, replicas in snapshot.groups():
         if all(r.status == "UNASSIGNED" for r in replicas):
             red_shards.append(g)
-        size = MAX(replicas.size)
-        for r in replicas:
-            r.size = size
 
-    relocating = wrap([s for s in shards if s.status in ("RELOCATING", "INITIALIZING")])
+    relocating = snapshot.with_status("RELOCATING", "INITIALIZING")
     Log.note("{{num}} shards allocating", num=len(relocating))
 
-    for m in copy(current_moving_shards):
-        for s in shards:
-            if s.index == m.index and s.i == m.shard and s.node.name == m.to_node and s.status == "STARTED":
-                # FINISHED MOVE
-                current_moving_shards.remove(m)
-                break
-            elif s.index == m.index and s.i == m.shard and s.node.name == m.from_node and s.status == "RELOCATING":
+    for m in moving_shards:
+        for s in snapshot.replicas(m.index, m.shard):
+            if s.node.name == m.source_node and s.status == "RELOCATING":
                 # STILL MOVING, ADD A VIRTUAL SHARD TO REPRESENT THE DESTINATION OF RELOCATION
-                s = copy(s)
+                s = s.copy()
                 s.type = 'r'
-                s.node = nodes[m.to_node]
+                s.node = nodes[m.target_node]
                 s.status = "INITIALIZING"
                 if s.node:  # HAPPENS WHEN SENDING SHARD TO UNKNOWN
                     relocating.append(s)
-                    shards.append(s)  # SORRY, BUT MOVING SHARDS TAKE TWO SPOTS
+                    snapshot.add(s)  # SORRY, BUT MOVING SHARDS TAKE TWO SPOTS
                 break
-        else:
-            # COULD NOT BE FOUND
-            current_moving_shards.remove(m)
-
-    # if red_shards:
-    #     Log.warning("Cluster is RED")
-    #     # DO NOT SCRUB WHEN WE ARE MISSING SHARDS
-    #     # ALLOCATE SHARDS INSTEAD
-    #     find_and_allocate_shards(nodes, uuid_to_index_name, settings, red_shards)
+    log_recovery_progress()
+    cancel_stalled_recoveries(path, nodes, snapshot, settings)
+
+    stale_primaries = set()  # (index, i) PAIRS GIVEN A STALE PRIMARY THIS CYCLE; THE SNAPSHOT STILL SHOWS THEM UNASSIGNED
+    if red_shards:
+        metrics.phase("red_shards")
+        Log.warning("Cluster is RED")
+        # DO NOT SCRUB WHEN WE ARE MISSING SHARDS
+        # ALLOCATE SHARDS INSTEAD
+        remaining = find_and_allocate_shards(nodes, snapshot, uuid_to_index_name, settings, red_shards)
+        stale_primaries = set(red_shards) - remaining
+        red_shards = remaining
     # else:
     #     # SCRUB THE NODE DIRECTORIES SO THERE IS ROOM
-    #     clean_out_unused_shards(nodes, shards, uuid_to_index_name, settings)
+    #     clean_out_unused_shards(nodes, snapshot, uuid_to_index_name, settings)
 
+    metrics.phase("replicas")
     # AN "ALLOCATION" IS THE SET OF SHARDS FOR ONE INDEX ON ONE NODE
     # CALCULATE HOW MANY SHARDS SHOULD BE IN EACH ALLOCATION
-    allocation = UniqueIndex(["index", "node.name"])
-    replicas_per_zone = {}  # MAP <index> -> <zone.name> -> #shards
-
-    for g, replicas in jx.groupby(shards, "index"):
-        Log.note("review replicas of {{index}}", index=g.index)
-        num_primaries = len(filter(lambda r: r.type == 'p', replicas))
-
-        for zone in zones:
-            override = wrap([i for i in settings.allocate if (i.name == g.index or (i.name.endswith("*") and g.index.startswith(i.name[:-1]))) and i.zone == zone.name])[0]
-            if override:
-                wrap(replicas_per_zone)[literal_field(g.index)][literal_field(zone.name)] = MIN([coalesce(override.shards, zone.shards), zone.num_nodes])
-            else:
-                wrap(replicas_per_zone)[literal_field(g.index)][literal_field(zone.name)] = zone.shards
-
-        num_replicas = sum(replicas_per_zone[g.index].values())
-        if mo_math.round(float(len(replicas)) / float(num_primaries), decimal=0) != num_replicas:
-            # DECREASE NUMBER OF REQUIRED REPLICAS
-            # MAY NOT BE NEEDED BECAUSE WE NOW ARE ABLE TO FORCE ALLOCATE SHARDS
-            # response = http.put(
-            #     path + "/" + g.index + "/_settings",
-            #     json={"index.recovery.initial_shards": 1}
-            # )
-            # Log.note("Number of shards required {{index}}\n{{result}}", index=g.index, result=json2value(utf82unicode(response.content)))
-
-            # CHANGE NUMBER OF REPLICAS
-            response = http.put(path + "/" + g.index + "/_settings", json={"index": {"number_of_replicas": num_replicas-1}})
-            Log.note(
-                "Update to {{num}} replicas for {{index}}\n{{result}}",
-                num=num_replicas,
-                index=g.index,
-                result=json2value(response.content.decode('utf8'))
-            )
-
-        for n in nodes:
-            if 'data' in n.roles:
-                pro = (float(n.memory) / float(n.zone.memory)) * (replicas_per_zone[g.index][n.zone.name] * num_primaries)
-                min_allowed = mo_math.floor(pro)
-                max_allowed = mo_math.ceiling(pro) if n.memory else 0
-            else:
-                min_allowed = 0
-                max_allowed = 0
-
-            shards_in_node = list(filter(lambda r: r.node.name == n.name, replicas))
-            allocate_ = {
-                "index": g.index,
-                "node": n,
-                "min_allowed": min_allowed,
-                "max_allowed": max_allowed,
-                "shards": shards_in_node
-            }
-            for sh in shards_in_node:
-                sh.allocate = allocate_  # ACTIVE SHARDS WILL HAVE ACCESS TO allocate
+    # ONLY INDEXES AFFECTED BY THE DELTA ARE RECALCULATED
+    allocation = state.allocation
+    replicas_per_zone = state.replicas_per_zone  # MAP <index> -> <zone.name> -> #shards
+    rules = get_index_rules(settings)
+    rules.prune(set(snapshot.index_names))  # OLD INDEXES ARE DELETED EVERY DAY; DO NOT CACHE THEM FOREVER
+
+    num_reviewed = 0
+    for index, replicas in snapshot.index_groups():
+        num_primaries = len([r for r in replicas if r.type == 'p'])
+
+        if state.is_affected(delta, index):
+            Log.note("review replicas of {{index}}", index=index)
+            num_reviewed += 1
+            state.dirty.discard(index)
+
+            replicas_per_zone[index] = {}
+            for zone in zones:
+                override = rules.override(index, zone.name)
+                if override:
+                    replicas_per_zone[index][zone.name] = MIN([coalesce(override.shards, zone.shards), zone.num_nodes])
+                else:
+                    replicas_per_zone[index][zone.name] = zone.shards
+
+            num_replicas = sum(replicas_per_zone[index].values())
+            if mo_math.round(float(len(replicas)) / float(num_primaries), decimal=0) != num_replicas:
+                # DECREASE NUMBER OF REQUIRED REPLICAS
+                # MAY NOT BE NEEDED BECAUSE WE NOW ARE ABLE TO FORCE ALLOCATE SHARDS
+                # response = http.put(
+                #     path + "/" + g.index + "/_settings",
+                #     json={"index.recovery.initial_shards": 1}
+                # )
+                # Log.note("Number of shards required {{index}}\n{{result}}", index=index, result=json2value(utf82unicode(response.content)))
+
+                # CHANGE NUMBER OF REPLICAS
+                if PLAN_ONLY:
+                    Log.note("Plan only: would update to {{num}} replicas for {{index}}", num=num_replicas, index=index)
+                else:
+                    response = http.put(path + "/" + index + "/_settings", json={"index": {"number_of_replicas": num_replicas-1}})
+                    Log.note(
+                        "Update to {{num}} replicas for {{index}}\n{{result}}",
+                        num=num_replicas,
+                        index=index,
+                        result=json2value(response.content.decode('utf8'))
+                    )
+                    state.dirty.add(index)  # CHECK AGAIN NEXT CYCLE, EVEN IF NOTHING CHANGES
+
+            for n in nodes:
+                if 'data' in n.roles:
+                    share = capacity[n.name] / zone_capacity[n.zone.name] if zone_capacity[n.zone.name] else 0
+                    pro = share * (replicas_per_zone[index][n.zone.name] * num_primaries)
+                    min_allowed = mo_math.floor(pro)
+                    max_allowed = mo_math.ceiling(pro) if n.memory else 0
+                else:
+                    min_allowed = 0
+                    max_allowed = 0
 
-            allocation.add(allocate_)
+                allocation.add(Allocation(index, n, min_allowed, max_allowed))
 
-        index_size = SUM(replicas.size)
+        index_size = snapshot.index_size(index)
         for r in replicas:
             r.index_size = index_size
             r.siblings = num_primaries
+    Log.note("{{num}} indexes reviewed", num=num_reviewed)
+
+    # POINT THE ALLOCATIONS AT THIS CYCLE'S SHARDS
+    populated = set()
+    for (node_name, index), shards_in_node in snapshot.node_index_groups():
+        alloc = allocation[index, node_name]
+        if not alloc:
+            continue
+        alloc.shards = list(shards_in_node)
+        for sh in shards_in_node:
+            sh.allocate = alloc  # ACTIVE SHARDS WILL HAVE ACCESS TO allocate
+        populated.add((index, node_name))
+    for index, node_name in state.populated - populated:
+        allocation[index, node_name].shards = []
+    state.populated = populated
 
     del ALLOCATION_REQUESTS[:]
 
+    metrics.phase("not_started")
     # LOOKING FOR SHARDS WITH ZERO STARTED INSTANCES
     not_started = []
-    for g, replicas in jx.groupby(shards, ["index", "i"]):
-        started_replicas = list(set([s.zone.name for s in replicas if s.status in {"STARTED", "RELOCATING", "INITIALIZING"}]))
+    for _, replicas in snapshot.groups():
+        started_replicas = list(set([s.node.zone.name for s in replicas if s.status in {"STARTED", "RELOCATING", "INITIALIZING"}]))
         if len(started_replicas) == 0:
             # MARK NODE AS RISKY
             for s in replicas:
@@ -304,7 +398,7 @@ def assign_shards(settings):
         # TODO: CANCEL ANYTHING MOVING IN SPOT
         Log.warning("{{num}} shards have not started", num=len(not_started))
         # Log.warning("Shards not started!!\n{{shards|json|indent}}", shards=not_started)
-        initailizing_indexes = set(relocating.index)
+        initailizing_indexes = set(r.index for r in relocating)
         busy = [n for n in not_started if n.index in initailizing_indexes]
         please_initialize = [n for n in not_started if n.index not in initailizing_indexes]
         if len(busy) > 1:
@@ -318,9 +412,10 @@ def assign_shards(settings):
     else:
         Log.note("All shards have started")
 
+    metrics.phase("high_risk")
     # LOOKING FOR SHARDS WITH ONLY ONE INSTANCE, IN THE RISKY ZONES
     high_risk_shards = []
-    for g, replicas in jx.groupby(shards, ["index", "i"]):
+    for _, replicas in snapshot.groups():
         # TODO: CANCEL ANYTHING MOVING IN SPOT
         realized_zone_names = set([s.node.zone.name for s in replicas if s.status in {"STARTED", "RELOCATING"}])
         if len(realized_zone_names-risky_zone_names) == 0:
@@ -354,34 +449,44 @@ def assign_shards(settings):
     else:
         Log.note("No high risk shards found")
 
+    metrics.phase("over_allocated")
     # THIS HAPPENS WHEN THE ES SHARD LOGIC ASSIGNED TOO MANY REPLICAS TO A SINGLE ZONE
     overloaded_zone_index_pairs = set()
     over_allocated_shards = Data()
-    for g, replicas in jx.groupby(shards, ["index", "i"]):
+    for g, replicas in snapshot.groups():
+        index, _ = g
         for z in zones:
-            realized_replicas = filter(lambda r: r.status == "STARTED" and r.node.zone.name == z.name, replicas)
-            expected_replicas = replicas_per_zone[g.index][z.name]
+            realized_replicas = [r for r in replicas if r.status == "STARTED" and r.node.zone.name == z.name]
+            expected_replicas = replicas_per_zone[index][z.name]
             if len(realized_replicas) > expected_replicas:
-                overloaded_zone_index_pairs.add((z.name, g.index))
+                overloaded_zone_index_pairs.add((z.name, index))
                 # IS THERE A PLACE TO PUT IT?
                 best_zone = None
                 for possible_zone in zones:
-                    allowed_shards = replicas_per_zone[g.index][possible_zone.name]
-                    current_shards = len(filter(
-                        lambda r: r.status in {"INITIALIZING", "STARTED", "RELOCATING"} and r.node.zone.name == possible_zone.name,
-                        replicas
-                    ))
+                    allowed_shards = replicas_per_zone[index][possible_zone.name]
+                    current_shards = len([
+                        r
+                        for r in replicas
+                        if r.status in {"INITIALIZING", "STARTED", "RELOCATING"} and r.node.zone.name == possible_zone.name
+                    ])
                     if not best_zone or (not best_zone[0].risky and z.risky) or (best_zone[0].risky == z.risky and best_zone[1] > current_shards):
                         best_zone = possible_zone, current_shards
                     if allowed_shards > current_shards:
                         # TODO: NEED BETTER CHOOSER; NODE WITH MOST SHARDS?
 
                         try:
-                            i = Random.weight([
+                            weights = [
                                 # DO NOT ASSIGN PRIMARY SHARDS TO BUSY ZONES
                                 r.siblings if not possible_zone.busy or (r.type != 'p') else 0
                                 for r in realized_replicas
-                            ])
+                            ]
+                            if z.busy:
+                                # A BUSY ZONE SHEDS ITS PRIMARIES FIRST, OTHERWISE THE REPLICA
+                                # JUST SENT BY "move replica into busy zone" IS SENT BACK
+                                primaries_first = [w if r.type == 'p' else 0 for w, r in zip(weights, realized_replicas)]
+                                if SUM(primaries_first):
+                                    weights = primaries_first
+                            i = Random.weight(weights)
                             shard = realized_replicas[i]
                             over_allocated_shards[possible_zone.name] += [shard]
                         except ZeroDivisionError as z:
@@ -399,10 +504,11 @@ def assign_shards(settings):
                     ])
                     shard = realized_replicas[i]
                     # alloc = allocation[g.index, shard.node.name]
-                    potential_peers =filter(
-                        lambda r: r.status in {"INITIALIZING", "STARTED", "RELOCATING"} and r.index ==shard.index and r.i==shard.i and r.node.zone==shard.node.zone,
-                        shards
-                    )
+                    potential_peers = [
+                        r
+                        for r in replicas
+                        if r.status in {"INITIALIZING", "STARTED", "RELOCATING"} and r.node.zone == shard.node.zone
+                    ]
                     if len(potential_peers) >= best_zone[0].shards:
                         continue
                     over_allocated_shards[best_zone[0].name] += [shard]
@@ -414,11 +520,35 @@ def assign_shards(settings):
     else:
         Log.note("No over-allocated shard found")
 
+    metrics.phase("forecast")
+    # MOVE SHARDS OFF NODES THAT WILL BE FULL WITHIN THE HORIZON, BEFORE THEY ARE
+    if settings.forecast.enabled is not False:
+        evacuate = Data()  # MAP FROM ZONENAME TO SHARDS TO MOVE
+        for n in nodes:
+            if not forecast.fills(n):
+                continue
+            on_node = [s for s in snapshot.on_node(n.name) if s.status == "STARTED"]
+            chosen = forecast.evacuate(n, on_node)
+            if chosen:
+                ttf = forecast.time_to_full(n)
+                Log.note(
+                    "{{node}} is full in {{hours}} hours, move {{num}} shards ({{size|round(decimal=1)}}G) off",
+                    node=n.name,
+                    hours=mo_math.round(ttf / 3600, digits=2),
+                    num=len(chosen),
+                    size=SUM(s.size for s in chosen) / BILLION
+                )
+                evacuate[n.zone.name] += chosen
+        for z, moves in evacuate.items():
+            allocate(CONCURRENT, moves, {z}, "forecast full", 4, settings)
+
+    metrics.phase("free_space")
     # MOVE SHARDS OUT OF FULL NODES (BIGGEST TO SMALLEST)
     free_space = Data()  # MAP FROM ZONENAME TO SHARDS TO MOVE
     for n in nodes:
         if n.disk and float(n.disk_free) / float(n.disk) < 0.05:
-            biggest_shard = jx.sort([s for s in shards if s.node == n], "size").last()
+            on_node = snapshot.on_node(n.name)
+            biggest_shard = max(on_node, key=lambda s: s.size) if on_node else Null
             if biggest_shard.status == "STARTED":
                 free_space[n.zone.name] += [biggest_shard]
             else:
@@ -428,23 +558,24 @@ def assign_shards(settings):
             Log.note("{{num}} shards can be moved to free up space in {{zone}}", num=len(moves), zone=z)
             allocate(CONCURRENT, moves, {z}, "free space", 3, settings)
 
+    metrics.phase("busy_zone")
     # MOVE PRIMARY OFF busy ZONE
     move_primaries = Data()
     current_index = "not an index"
     is_latest = True
-    for g, replicas in jx.reverse(list(jx.groupby(shards, ["index", "i"]))):
+    for (index, _), replicas in jx.reverse(list(snapshot.groups())):
         # PRIORITY TO MOST RECENT INDEX
-        if g.index != current_index:
-            if len(current_index)>15 and len(g.index)>15 and current_index[0:-15] == g.index[0:-15]:
+        if index != current_index:
+            if len(current_index)>15 and len(index)>15 and current_index[0:-15] == index[0:-15]:
                 # MORE INDEXES OF SAME ALIAS
                 is_latest = False
                 continue
             else:
-                current_index = g.index
+                current_index = index
                 is_latest = True
 
         # FOR NOW, ONLY MOVE LATEST INDEX IN SERIES
-        if is_latest and all(s == 'STARTED' for s in replicas.status):
+        if is_latest and all(r.status == 'STARTED' for r in replicas):
             for is_busy_replica in replicas:
                 if is_busy_replica.node.zone.busy and is_busy_replica.type == 'p':
                     candidates = [
@@ -463,11 +594,12 @@ def assign_shards(settings):
     else:
         Log.note("No primary shards in busy zone")
 
+    metrics.phase("duplication")
     # LOOK FOR DUPLICATION OPPORTUNITIES
     # ONLY DUPLICATE PRIMARY SHARDS AT THIS TIME
     # IN THEORY THIS IS FASTER BECAUSE THEY ARE IN THE SAME ZONE (AND BETTER MACHINES)
     dup_shards = Data()
-    for g, replicas in jx.groupby(shards, ["index", "i"]):
+    for (index, _), replicas in snapshot.groups():
         # WE CAN ASSIGN THIS REPLICA WITHIN THE SAME ZONE
         for s in replicas:
             if s.status != "UNASSIGNED" or s.type != "p":
@@ -475,7 +607,7 @@ def assign_shards(settings):
             for z in settings.zones:
                 started_count = len([r for r in replicas if r.status in {"STARTED"} and r.node.zone.name == z.name])
                 active_count = len([r for r in replicas if r.status in {"INITIALIZING", "STARTED", "RELOCATING"} and r.node.zone.name == z.name])
-                if started_count >= 1 and active_count < replicas_per_zone[g.index][z.name]:
+                if started_count >= 1 and active_count < replicas_per_zone[index][z.name]:
                     dup_shards[z.name] += [s]
             break  # ONLY ONE SHARD PER CYCLE
 
@@ -487,16 +619,17 @@ def assign_shards(settings):
     else:
         Log.note("No intra-zone duplication remaining")
 
+    metrics.phase("low_risk")
     # LOOK FOR UNALLOCATED SHARDS
     low_risk_shards = Data()
-    for g, replicas in jx.groupby(shards, ["index", "i"]):
+    for (index, _), replicas in snapshot.groups():
         # WE CAN ASSIGN THIS REPLICA TO spot
         for s in replicas:
             if s.status != "UNASSIGNED":
                 continue
             for z in settings.zones:
                 active_count = len([r for r in replicas if r.status in {"INITIALIZING", "STARTED", "RELOCATING"} and r.node.zone.name == z.name])
-                if active_count < replicas_per_zone[g.index][z.name]:
+                if active_count < replicas_per_zone[index][z.name]:
                     low_risk_shards[z.name] += [s]
             break  # ONLY ONE SHARD PER CYCLE
 
@@ -507,16 +640,14 @@ def assign_shards(settings):
     else:
         Log.note("No low risk shards found")
 
+    metrics.phase("imbalance")
     # LOOK FOR SHARD IMBALANCE
     rebalance_candidates = Data()
-    for g, replicas in jx.groupby(filter(lambda r: r.status == "STARTED", shards), ["node.name", "index"]):
-        g = wrap_leaves(g)
+    for (node_name, index), replicas in snapshot.node_index_groups("STARTED"):
         replicas = list(replicas)
-        if not g.node:
-            continue
-        _node = nodes[g.node.name]
-        alloc = allocation[g]
-        if (_node.zone.name, g.index) in overloaded_zone_index_pairs:
+        _node = nodes[node_name]
+        alloc = allocation[index, node_name]
+        if (_node.zone.name, index) in overloaded_zone_index_pairs:
             continue
         for i in range(alloc.max_allowed, len(replicas), 1):
             candidates = [
@@ -537,9 +668,10 @@ def assign_shards(settings):
     else:
         Log.note("No shards need to be balanced")
 
+    metrics.phase("inter_zone_duplication")
     # LOOK FOR OTHER, SLOWER, DUPLICATION OPPORTUNITIES
     dup_shards = Data()
-    for _, replicas in jx.groupby(shards, ["index", "i"]):
+    for _, replicas in snapshot.groups():
         # WE CAN ASSIGN THIS REPLICA WITHIN THE SAME ZONE
         for s in replicas:
             if s.status != "UNASSIGNED":
@@ -559,6 +691,7 @@ def assign_shards(settings):
     else:
         Log.note("No inter-zone duplication remaining")
 
+    metrics.phase("slight_imbalance")
     # ENSURE ALL NODES HAVE THE MINIMUM NUMBER OF SHARDS
     #
     # Problem of 3 nodes AND 7 shards: Any node can have up to three shards,
@@ -568,7 +701,7 @@ def assign_shards(settings):
     # WE ONLY DO THIS IF THERE IS NOT OTHER REBALANCING TO BE DONE, OTHERWISE
     # IT WILL ALTERNATE SHARDS (CONTINUALLY TRYING TO FILL SPACE, BUT MAKING A HOLE ELSEWHERE)
     total_moves = 0
-    for index_name in set(shards.index):
+    for index_name in snapshot.index_names:
         for z in set([n.zone.name for n in nodes]):
             if not rebalance_candidates[z]:
                 rebalance_candidate = None  # MOVE ONLY ONE SHARD, PER INDEX, PER ZONE, AT A TIME
@@ -603,11 +736,16 @@ def assign_shards(settings):
             num=total_moves,
         )
 
+    metrics.phase("allocate")
+    preemption = Preemption(settings.preempt)
     try:
-        _allocate(relocating, path, nodes, shards, red_shards, allocation, settings)
+        _allocate(relocating, path, nodes, snapshot, red_shards, stale_primaries, allocation, preemption, settings)
     finally:
         enable_zone_restrictions(path)
 
+    metrics.phase("preempt")
+    preempt_recoveries(path, nodes, snapshot, preemption)
+
 local_ip_to_public_ip_map = Null
 
 
@@ -632,15 +770,139 @@ def get_ip_map():
     }
 
 
-def find_and_allocate_shards(nodes, uuid_to_index_name, settings, red_shards):
-    red_shards = [(g.index, g.i) for g in red_shards]
+def get_relocations(shard_rows, nodes):
+    """
+    THE RELOCATING SHARDS, FROM THE "<from> -> <ip> <id> <to>" node COLUMN OF _cat/shards;
+    ES 5 AND 6 DO NOT SAY WHICH RECOVERIES ARE RELOCATIONS, BUT THIS DOES
+    :return: LIST OF {"index", "shard", "source_node", "target_node"}
+    """
+    output = []
+    for index, i, _, _, _, _, _, node in shard_rows:
+        if not node or node.find(" -> ") == -1:
+            continue
+        source, destination = node.split(" -> ", 1)
+        target = destination.split(" ")[-1]
+        if not nodes[target]:
+            ip = destination.split(" ")[0]
+            target = first(n.name for n in nodes if n.ip == ip)
+        output.append(Data(index=index, shard=i, source_node=source, target_node=target))
+    return output
+
+
+def find_and_allocate_shards(nodes, snapshot, uuid_to_index_name, settings, red_shards):
+    """
+    ALLOCATE A PRIMARY FOR EACH RED SHARD, FROM A COPY LEFT ON SOME NODE'S DISK
+
+    THE COPIES ARE FOUND WITH ONE _shard_stores REQUEST; SSH-ING INTO EVERY
+    NODE (settings.scan_red_shards) IS ONLY FOR THE SHARDS STILL RED AFTER THAT
+    :return: SET OF (index, i) PAIRS STILL RED
+    """
+    red_shards = set(red_shards)  # (index, i) PAIRS
+    path = settings.elasticsearch.host + ":" + text(settings.elasticsearch.port)
+
+    allocate_from_shard_stores(path, nodes, snapshot, settings, red_shards)
+    if red_shards and settings.scan_red_shards:
+        if PLAN_ONLY:
+            # PLANNING AND REPLAYING DO NOT TOUCH THE CLUSTER HOSTS (OR EC2)
+            Log.note("{{num}} red shards not found by _shard_stores, nodes not scanned when only planning", num=len(red_shards))
+        else:
+            Log.note("{{num}} red shards not found by _shard_stores, scanning nodes", num=len(red_shards))
+            allocate_from_directories(path, nodes, snapshot, uuid_to_index_name, settings, red_shards)
+    return red_shards
+
+
+STORE_ALLOCATION_RANK = {"primary": 0, "replica": 1, "unused": 2}  # primary WAS THE LAST IN-SYNC PRIMARY
+
+
+def rank_shard_copies(copies, nodes):
+    """
+    :param copies: THE _shard_stores OF ONE SHARD
+    :return: THE COPIES WORTH ALLOCATING AS PRIMARY, BEST FIRST: THE LAST
+             PRIMARY, THEN IN-SYNC REPLICAS, THEN THE REST; NON-RISKY ZONES FIRST.
+             COPIES WITH A store_exception (CORRUPT), OR ON UNKNOWN NODES, ARE DROPPED
+    """
+    usable = [c for c in copies if not c.store_exception and nodes[c.node].zone]
+    return sorted(usable, key=lambda c: (STORE_ALLOCATION_RANK.get(c.allocation, 3), bool(nodes[c.node].zone.risky)))
+
+
+def allocate_from_shard_stores(path, nodes, snapshot, settings, red_shards):
+    """
+    ALLOCATE THE BEST COPY OF EACH RED SHARD; IF REJECTED, TRY THE NEXT COPY
+    :param red_shards: SET OF (index, i) PAIRS, THE ALLOCATED ONES ARE REMOVED
+    """
+    try:
+        stores = tables.get_shard_stores(path, sorted(set(index for index, _ in red_shards)))
+    except Exception as e:
+        Log.warning("Can not get _shard_stores", cause=e)
+        return
+
+    candidates = {}  # MAP FROM (index, i) TO REMAINING COPIES, BEST FIRST
+    for g in red_shards:
+        copies = rank_shard_copies(stores.get(g, []), nodes)
+        if copies:
+            candidates[g] = copies
+    Log.note("{{num}} of {{total}} red shards have copies on disk", num=len(candidates), total=len(red_shards))
+    if candidates and not ACCEPT_DATA_LOSS and not PLAN_ONLY:
+        # ES REJECTS EVERY allocate_stale_primary WITHOUT accept_data_loss, SO ONLY SAY WHAT CAN BE DONE
+        Log.warning(
+            "{{num}} red shards can be allocated from a copy on disk, with accept_data_loss:\n{{copies|json|indent}}",
+            num=len(candidates),
+            copies=[
+                {"index": index, "shard": i, "node": copies[0].node, "allocation": copies[0].allocation}
+                for (index, i), copies in sorted(candidates.items())
+            ]
+        )
+        return
+
+    while candidates:
+        batch = RerouteBatch(path, settings.reroute_batch_size, plan_only=PLAN_ONLY)
+        for (index, i), copies in sorted(candidates.items()):
+            shard = first(r for r in snapshot.replicas(index, i) if r.type == 'p')
+            best = copies.pop(0)
+            _log_stale_primary(shard, best.node, "Primary shard assign to " + coalesce(best.allocation, "unknown") + " copy")
+            move_plan.add(
+                wrap({"shard": shard, "reason": "red shard", "mode_priority": 0}),
+                ALLOCATE_STALE_PRIMARY,
+                None,
+                best.node
+            )
+            batch.add(
+                wrap({ALLOCATE_STALE_PRIMARY: {
+                    "accept_data_loss": ACCEPT_DATA_LOSS,
+                    "index": index,
+                    "shard": i,
+                    "node": best.node
+                }}),
+                shard=shard,
+                node=best.node
+            )
+
+        for entry in batch.flush():
+            g = (entry.shard.index, entry.shard.i)
+            if entry.accepted:
+                Log.note("ok: index={{shard.index}}, shard={{shard.i}}, assign_to={{node}}", shard=entry.shard, node=entry.node)
+                red_shards.discard(g)
+                candidates.pop(g, None)
+                continue
+            _log_rejection(entry, nodes)
+            if not candidates.get(g) or "accept_data_loss" in coalesce(entry.error, ""):
+                # NO MORE COPIES, OR NONE WILL BE ACCEPTED WITHOUT ACCEPT_DATA_LOSS
+                candidates.pop(g, None)
 
-    # PICK NON-RISKY NODES FIRST
-    for node in jx.sort(list(nodes), "zone.risky"):
+
+def allocate_from_directories(path, nodes, snapshot, uuid_to_index_name, settings, red_shards):
+    """
+    SSH INTO EACH NODE, NON-RISKY FIRST, TO FIND THE DIRECTORIES OF THE RED SHARDS
+    :param red_shards: SET OF (index, i) PAIRS, THE ALLOCATED ONES ARE REMOVED
+    """
+    # ALLOCATE AS EACH NODE IS SCANNED, NOT AFTER ALL NODES ARE SCANNED
+    for node, directories in get_scanner(snapshot, uuid_to_index_name, settings).scan(sorted(nodes, key=lambda n: bool(n.zone.risky))):
         Log.note("review {{node}}", node=node.name)
-        for d in get_node_directories(node, uuid_to_index_name, settings):
+        batch = RerouteBatch(path, settings.reroute_batch_size, plan_only=PLAN_ONLY)
+        for d in directories:
             if (d.index, d.i) not in red_shards:
                 continue
+            red_shards.discard((d.index, d.i))  # ONE COPY IS ENOUGH
 
             command = wrap({ALLOCATE_STALE_PRIMARY: {
                 "accept_data_loss": ACCEPT_DATA_LOSS,
@@ -648,68 +910,91 @@ def find_and_allocate_shards(nodes, uuid_to_index_name, settings, red_shards):
                 "shard": d.i,
                 "node": node.name  # nodes[i].name
             }})
+            _log_stale_primary(d, node.name, "Primary shard assign to known directory")
+            batch.add(command, shard=d, node=node.name)
 
-            if ACCEPT_DATA_LOSS:
-                Log.warning(
-                    "{{motivation}}: {{mode|upper}} index={{shard.index}}, shard={{shard.i}}, type={{shard.type}}, assign_to={{node}}",
-                    motivation="Primary shard assign to known directory with data loss",
-                    shard=d,
-                    node=node.name
-                )
-            else:
+        for entry in batch.flush():
+            if entry.accepted:
                 Log.note(
-                    "{{motivation}}: {{mode|upper}} index={{shard.index}}, shard={{shard.i}}, type={{shard.type}}, assign_to={{node}}",
-                    motivation="Primary shard assign to known directory",
-                    shard=d,
-                    node=node.name
+                    "ok: index={{shard.index}}, shard={{shard.i}}, assign_to={{node}}",
+                    shard=entry.shard,
+                    node=entry.node
                 )
+                continue
 
-            path = settings.elasticsearch.host + ":" + text(settings.elasticsearch.port)
-            response = http.post(path + "/_cluster/reroute", json={"commands": [command]})
-            result = json2value(response.content.decode('utf8'))
-            if response.status_code not in [200, 201] or not result.acknowledged:
-                if isinstance(result.error, Mapping):
-                    main_reason = result.error.root_cause.reason
-                else:
-                    main_reason = strings.between(result.error, "[NO", "]")
-
-                if main_reason == None:
-                    Log.note("Failure for unknwon reason")
-                elif "shard cannot be allocated on same node" in main_reason:
-                    Log.note("ok: ES automatically initialized already")
-                elif main_reason and main_reason.find("too many shards on nodes for attribute") != -1:
-                    pass  # THIS WILL HAPPEN WHEN THE ES SHARD BALANCER IS ACTIVATED, NOTHING WE CAN DO
-                    Log.note("failed: zone full")
-                elif main_reason and main_reason.find("after allocation more than allowed") != -1:
-                    pass
-                    Log.note("failed: out of space")
-                elif "failed to resolve [" in result.error:
-                    # LOST A NODE WHILE SENDING UPDATES
-                    lost_node_name = strings.between(result.error, "failed to resolve [", "]").strip()
-                    Log.warning("Lost node during allocate {{node}}", node=lost_node_name)
-                    nodes[lost_node_name].zone = None
-                else:
-                    Log.warning(
-                        "{{code}} Can not move/allocate:\n\treason={{reason}}\n\tdetails={{error|quote}}",
-                        code=response.status_code,
-                        reason=main_reason,
-                        error=result.error
-                    )
-            else:
-                Log.note(
-                    "ok={{result.acknowledged}}",
-                    result=result
-                )
+            # ANOTHER NODE MAY HAVE A COPY
+            red_shards.add((entry.shard.index, entry.shard.i))
+            _log_rejection(entry, nodes)
 
 
-def get_node_directories(node, uuid_to_index_name, settings):
+def _log_stale_primary(shard, node_name, motivation):
+    if ACCEPT_DATA_LOSS:
+        Log.warning(
+            "{{motivation}}: {{mode|upper}} index={{shard.index}}, shard={{shard.i}}, type={{shard.type}}, assign_to={{node}}",
+            motivation=motivation + " with data loss",
+            mode=ALLOCATE_STALE_PRIMARY,
+            shard=shard,
+            node=node_name
+        )
+    else:
+        Log.note(
+            "{{motivation}}: {{mode|upper}} index={{shard.index}}, shard={{shard.i}}, type={{shard.type}}, assign_to={{node}}",
+            motivation=motivation,
+            mode=ALLOCATE_STALE_PRIMARY,
+            shard=shard,
+            node=node_name
+        )
+
+
+def _log_rejection(entry, nodes):
+    main_reason = entry.reason
+    if main_reason == None:
+        Log.note("Failure for unknwon reason")
+    elif "shard cannot be allocated on same node" in main_reason:
+        Log.note("ok: ES automatically initialized already")
+    elif main_reason and main_reason.find("too many shards on nodes for attribute") != -1:
+        pass  # THIS WILL HAPPEN WHEN THE ES SHARD BALANCER IS ACTIVATED, NOTHING WE CAN DO
+        Log.note("failed: zone full")
+    elif main_reason and main_reason.find("after allocation more than allowed") != -1:
+        pass
+        Log.note("failed: out of space")
+    elif "failed to resolve [" in entry.error:
+        # LOST A NODE WHILE SENDING UPDATES
+        lost_node_name = strings.between(entry.error, "failed to resolve [", "]").strip()
+        Log.warning("Lost node during allocate {{node}}", node=lost_node_name)
+        nodes[lost_node_name].zone = Null
+    else:
+        Log.warning(
+            "Can not move/allocate:\n\treason={{reason}}\n\tdetails={{error|quote}}",
+            reason=main_reason,
+            error=entry.error
+        )
+
+
+ssh_pool = None  # SSH CONNECTIONS KEPT BETWEEN CYCLES
+directory_inventory = None  # SHARD DIRECTORIES FOUND BY EARLIER SCANS
+
+
+def get_scanner(snapshot, uuid_to_index_name, settings):
+    global ssh_pool, directory_inventory
+    if ssh_pool is None:
+        ssh_pool = SshPool(settings.connect, coalesce(settings.ssh_connections, DEFAULT_CONNECTIONS))
+    if directory_inventory is None:
+        directory_inventory = DirectoryInventory(settings.directory_cache.filename, settings.directory_cache.ttl)
+    return DirectoryScanner(
+        ssh_pool,
+        uuid_to_index_name,
+        node_ip,
+        coalesce(settings.scan_threads, DEFAULT_THREADS),
+        inventory=directory_inventory,
+        digest_of=lambda node: shard_digest(snapshot.on_node(node.name))
+    )
+
+
+def node_ip(node):
     """
-    :param node:
-    :param settings:
-    :return: LIST OF SHARDS AND THEIR DIRECTORIES
+    :return: THE IP TO SSH INTO node, OR None IF IT SHOULD NOT BE SCANNED
     """
-
-    # FIND THE IP
     IP = node.ip
     if not machine_metadata.aws_instance_type:
         get_ip_map()
@@ -719,106 +1004,57 @@ def get_node_directories(node, uuid_to_index_name, settings):
 
     if IP == '52.37.182.91':  # SKIP TUID SERVER
         Log.note("Hardcoded: Skipping TUID server at 52.37.182.91")
-        return Null
+        return None
 
     Log.note("using ip {{ip}}", ip=IP)
+    return IP
 
-    # SETUP FABRIC
-    for k, v in settings.connect.items():
-        env[k] = v
-    env.host_string = IP
-    env.abort_exception = Log.error
 
-    # LOGIN TO FIND SHARDS
-    try:
-        with fabric_settings(warn_only=True):
-            with hide('output'):
-                directories = sudo("find /data* -type d")
-                drive_space = sudo("df -h")
-    except Exception as e:
-        Log.warning("Can not get directories!", cause=e)
-        return Null
-    # /data1/active-data/nodes/0/indices/jobs20161001_000000
-    # /data1/active-data/nodes/0/indices/jobs20161001_000000/11
-    # /data1/active-data/nodes/0/indices/jobs20161001_000000/11/_state
-    # /data1/active-data/nodes/0/indices/jobs20161001_000000/11/translog
-    # /data1/active-data/nodes/0/indices/jobs20161001_000000/11/index
-    # /data1/active-data/nodes/0/indices/jobs20161001_000000/6
-    # /data1/active-data/nodes/0/indices/jobs20161001_000000/6/_state
-    # /data1/active-data/nodes/0/indices/jobs20161001_000000/6/translog
-    # /data1/active-data/nodes/0/indices/jobs20161001_000000/6/index
-    # CATCH THE OUT-OF-CONTROL LOGGING THAT FILLS DRIVES (AND OTHER NASTINESS)
-    for line in drive_space.split("\n"):
-        fullness = strings.between(line, " ", "%")
-        if mo_math.is_integer(fullness) and int(fullness) >= 98:
-            Log.warning("Drive at {{ip}} has full drive {{drive|quote}}", ip=IP, drive=line)
-
-    output = FlatList()
-    for dir_ in directories.split("\n"):
-        dir_ = dir_.strip()
-        if dir_.endswith("No such file or directory"):
-            continue
-        path = dir_.split("/")
-        if len(path) != 7:
-            continue
-        index = uuid_to_index_name.get(path[5])
-        if not index:
-            Log.warning("not expected dir={{dir}} for machine {{ip}}", dir=dir_, ip=IP)
-            continue  # SOMETIMES THERE ARE JUNK DIRECTORIES
-        if path[6] == "_state":
-            continue  # SOMETIMES THERE ARE _state DIRECTORIES
-        try:
-            shard = int(path[6])
-            output.append({
-                "index": index,
-                "i": shard,
-                "dir": dir_
-            })
-        except Exception as e:
-            Log.error("not expected dir={{dir}} for machine {{ip}}", cause=e, dir=dir_, ip=IP)
-    return output
+def get_node_directories(node, snapshot, uuid_to_index_name, settings):
+    """
+    :param node:
+    :param settings:
+    :return: LIST OF SHARDS AND THEIR DIRECTORIES
+    """
+    return get_scanner(snapshot, uuid_to_index_name, settings).node_directories(node)
 
 
-def clean_out_unused_shards(nodes, shards, uuid_to_index_name, settings):
+def clean_out_unused_shards(nodes, snapshot, uuid_to_index_name, settings):
     if settings.disable_cleaner:
         return
-    for node in nodes:
+    please_scrub = [n for n in nodes if not last_scrubbing[n.name] > Date("now-12hour")]
+    for node in please_scrub:
+        last_scrubbing[node.name] = Date.now()
+
+    for node, directories in get_scanner(snapshot, uuid_to_index_name, settings).scan(please_scrub):
         try:
-            cleaned = _clean_out_one_node(node, shards, uuid_to_index_name, settings)
-            if cleaned:
-                break  # EXIT EARLY SO WE CAN GET TO THE JOB OF BALANCING
+            _clean_out_one_node(node, directories, snapshot)
         except Exception as e:
             Log.warning("can not clear {{node}}", node=node.name, cause=e)
 
 
-def _clean_out_one_node(node, all_shards, uuid_to_index_name, settings):
+def _clean_out_one_node(node, directories, snapshot):
     # if not node.name.startswith("spot"):
     #     return
-    if last_scrubbing[node.name] > Date("now-12hour"):
-        return False  # NO WORK DONE
-    last_scrubbing[node.name] = Date.now()
-
-    expected_shards = [
-        (r.index, r.i)
-        for r, _ in jx.groupby(jx.filter(all_shards, {"eq": {"node.name": node.name}}), ["index", "i"])
-    ]
+    expected_shards = set((r.index, r.i) for r in snapshot.on_node(node.name))
 
     please_remove = []
-    for d in get_node_directories(node, uuid_to_index_name, settings):
+    for d in directories:
         if (d.index, d.i) in expected_shards:
             continue
 
-        with hide('output'):
-            young_files = text(sudo("find "+d.dir+" -cmin -120 -type f"))
-            if young_files:
-                Log.error("attempt to remove young files")
-            else:
-                please_remove.append(d.dir)
+        young_files = "\n".join(ssh_pool.run(node_ip(node), "find "+d.dir+" -cmin -120 -type f")).strip()
+        if young_files:
+            Log.error("attempt to remove young files")
+        else:
+            please_remove.append(d.dir)
 
     for dir_ in please_remove:
         Log.note("Scrubbing node {{node}}: Remove {{path}}", node=node.name, path=dir_)
-        with hide('output'):
-            sudo("rm -fr " + dir_)
+        for _ in ssh_pool.run(node_ip(node), "rm -fr " + dir_):
+            pass
+    if please_remove:
+        directory_inventory.invalidate(node, DATA_PATH)
 
     return bool(please_remove)
 
@@ -829,7 +1065,13 @@ ALLOCATION_REQUESTS = []
 def allocate(concurrent, proposed_shards, zones, reason, mode_priority, settings):
     if DEBUG:
         assert all(isinstance(z, text) for z in zones)
+    cycle_metrics.count("candidates", len(proposed_shards))
+    history = get_move_history(settings)
     for s in proposed_shards:
+        suppressed = history.cooldown(s, reason)
+        if suppressed:
+            cycle_metrics.count("suppressed_" + suppressed)
+            continue
         move = {
             "shard": s,
             "to_zone": zones,
@@ -842,16 +1084,65 @@ def allocate(concurrent, proposed_shards, zones, reason, mode_priority, settings
 
 
 def replication_priority(shard, settings):
-    for i, prefix in enumerate(settings.replication_priority):
-        if prefix.endswith("*") and shard.index.startswith(prefix[:-1]):
-            return i
-        elif shard.index == prefix:
-            return i
-    return len(settings.replication_priority)
+    return get_index_rules(settings).replication_priority(shard.index)
+
+
+index_rules = None  # settings.allocate AND settings.replication_priority, COMPILED
+
+
+def get_index_rules(settings):
+    """
+    :return: IndexRules FOR settings, COMPILED AGAIN WHEN THE settings ARE RELOADED
+    """
+    global index_rules
+    if index_rules is None or index_rules.settings is not settings:
+        index_rules = IndexRules(settings)
+    return index_rules
+
+
+move_history = None  # MOVES SENT BY EARLIER CYCLES, SO BALANCING DOES NOT UNDO THEM
+
+
+def get_move_history(settings):
+    global move_history
+    if move_history is None:
+        h = settings.history
+        move_history = MoveHistory(h.filename, h.max_moves, h.shard_cooldown, h.index_cooldown, h.oscillation_window, recovery_tracker.clock)
+    return move_history
+
+
+load_model = None  # DECAYED INDEXING, SEARCH AND MERGE RATES OF EACH SHARD COPY, AND NODE
+
+
+def get_load_model(settings):
+    global load_model
+    if load_model is None:
+        load_model = LoadModel(settings.load.half_life, settings.load.weights, settings.load.strength)
+    return load_model
+
+
+disk_forecast = None  # RECENT disk_free OF EACH NODE, FOR THE TIME UNTIL IT IS FULL
+
+
+def get_disk_forecast(settings):
+    global disk_forecast
+    if disk_forecast is None:
+        disk_forecast = DiskForecast(settings.forecast.window, settings.forecast.horizon, settings.forecast.floor)
+    return disk_forecast
+
+
+rejection_cache = None  # COMMANDS ES REJECTED, NOT SENT AGAIN UNTIL THEY MAY BE ACCEPTED
+
+
+def get_rejection_cache(settings):
+    global rejection_cache
+    if rejection_cache is None:
+        rejection_cache = RejectionCache(settings.rejections, recovery_tracker.clock)
+    return rejection_cache
 
 
 def net_shards_to_move(concurrent, shards, relocating):
-    sorted_shards = jx.sort(shards, ["index_size", "size"])
+    sorted_shards = sorted(shards, key=lambda s: (s.index_size, s.size))
     total_size = 0
     for s in sorted_shards:
         if total_size > BIG_SHARD_SIZE:
@@ -863,78 +1154,77 @@ def net_shards_to_move(concurrent, shards, relocating):
     return net, sorted_shards
 
 
-def _allocate(relocating, path, nodes, all_shards, red_shards, allocation, settings):
-    moves = jx.sort(ALLOCATION_REQUESTS, ["mode_priority", "replication_priority", "shard.index_size", "shard.i"])
+def _allocate(relocating, path, nodes, snapshot, red_shards, stale_primaries, allocation, preemption, settings):
+    moves = wrap(sorted(
+        ALLOCATION_REQUESTS,
+        key=lambda m: (m["mode_priority"], m["replication_priority"], m["shard"].index_size, m["shard"].i)
+    ))
 
-    inbound_data = outbound_data = Data()  # TODO: SEE IF THIS IS TOO SLOW: NODE ALLOWED INGRESS OR EGRESS, NOT BOTH
-    for s in relocating:
-        if s.status == "INITIALIZING":
-            primaries = [
-                p
-                for p in all_shards
-                if p.index == s.index and p.status == "STARTED" and p.type == 'p' and p.i == s.i
-            ]
-            if primaries:
-                # PRIMARY SHARD IS USED TO INITIALIZE SHARD
-                source_node = primaries[0].node.name if primaries else None
-                outbound_data[literal_field(source_node)] += s.size
-
-            inbound_data[literal_field(s.node.name)] += s.size
-        elif s.status == "RELOCATING":
-            # WE ALREADY ADDED A VIRTUAL INITIALIZING SHARD TO CATCH inbound_data
-            outbound_data[literal_field(s.node.name)] += s.size
+    scheduler = recovery_scheduler
+    scheduler.start(settings, nodes, relocating, snapshot)
+    moving_to = recovery_tracker.target_nodes()  # NODES RECEIVING SHARDS
+    rejections = get_rejection_cache(settings)
+    rejections.expire()
+    forecast = get_disk_forecast(settings) if settings.forecast.enabled is not False else None
 
     Log.note(
         "Busy nodes:\n{{nodes|json|indent}}",
-        nodes={k: text(mo_math.round(v / (1000 * 1000 * 1000), digits=3)) + "G" for k, v in outbound_data.items()}
+        nodes={k: text(mo_math.round(v / (1000 * 1000 * 1000), digits=3)) + "G" for k, v in scheduler.outbound.items() if v}
     )
 
-    done = set()  # (index, i) pair
+    done = set(stale_primaries)  # (index, i) pair; THE REPLICAS OF A STALE PRIMARY WAIT UNTIL IT HAS STARTED
     move_failures = 0
-    sent_full_nodes_warning = False
-    Log.note("Considering {{num}} moves", num=len(moves))
-    for move in moves:
+    batch = RerouteBatch(path, settings.reroute_batch_size, plan_only=PLAN_ONLY)
+    warnings = set()  # WARNINGS ALREADY SENT THIS CYCLE
+
+    def destinations(move):
+        """
+        :return: (source_node, list_nodes, list_node_weight) FOR move, OR None IF move CAN NOT BE MADE NOW
+        """
         shard = move.shard
         if (shard.index, shard.i) in done:
-            continue
+            return None
         source_node = shard.node.name
 
         if not source_node:
             primaries = [
                 p
-                for p in all_shards
-                if p.index == shard.index and p.status == "STARTED" and p.type == 'p' and p.i == shard.i
+                for p in snapshot.replicas(shard.index, shard.i)
+                if p.status == "STARTED" and p.type == 'p'
             ]
             source_node = primaries[0].node.name if primaries else None
 
-        if source_node and outbound_data[literal_field(source_node)] >= move.concurrent * BIG_SHARD_SIZE:
-            continue
+        if source_node and not scheduler.can_send(source_node, move.concurrent):
+            if preemption.is_urgent(move):
+                preemption.blocked(source_node, "egress", move)
+            return None
 
         zones = move.to_zone
 
-        shards_for_this_index = wrap(jx.filter(all_shards, {
-            "eq": {
-                "index": shard.index
-            }
-        }))
-        index_size = SUM(shards_for_this_index.size)
-        existing_on_nodes = set(s.node.name for s in shards_for_this_index if s.status in {"INITIALIZING", "STARTED", "RELOCATING"} and s.i==shard.i)
+        replicas = snapshot.replicas(shard.index, shard.i)
+        index_size = snapshot.index_size(shard.index)
+        existing_on_nodes = set(s.node.name for s in replicas if s.status in {"INITIALIZING", "STARTED", "RELOCATING"})
         # FOR THE NODES WITH NO SHARDS, GIVE A DEFAULT VALUES
         node_weight = {
             n.name: coalesce(n.memory, 0)
             for n in nodes
         }
-        for g, ss in jx.groupby(filter(lambda s: s.status == "STARTED" and s.node, shards_for_this_index), "node.name"):
-            g = wrap_leaves(g)
-            index_count = len(ss)
-            node_weight[g.node.name] = nodes[g.node.name].memory * (1 - float(SUM(ss.size))/float(index_size+1))
-            min_allowed = allocation[shard.index, g.node.name].min_allowed
-            node_weight[g.node.name] *= 4 ** MIN([-1, min_allowed - index_count - 1])
+        for node_name, (index_count, node_index_size) in snapshot.index_node_stats(shard.index, "STARTED").items():
+            node_weight[node_name] = nodes[node_name].memory * (1 - float(node_index_size)/float(index_size+1))
+            min_allowed = allocation[shard.index, node_name].min_allowed
+            node_weight[node_name] *= 4 ** MIN([-1, min_allowed - index_count - 1])
+        if load_model.mean_node_load:
+            # HOT SHARDS SPREAD OVER THE QUIET NODES
+            for node_name in node_weight:
+                node_weight[node_name] *= load_model.weight(node_name, shard.index, shard.i)
 
         list_nodes = list(nodes)
         list_node_weight = [node_weight[n.name] for n in list_nodes]
         full_nodes = FlatList()
         good_reasons = 0
+        budget_blocked = []  # NODES THAT COULD TAKE THE SHARD, BUT FOR THEIR RECOVERY BUDGET
+        rejected_on = rejections.nodes(shard.index, shard.i, shard.size, nodes)
+        returns = move_history.returns(shard, move.reason)
         for i, n in enumerate(list_nodes):
             alloc = allocation[shard.index, n.name]
 
@@ -942,7 +1232,19 @@ def _allocate(relocating, path, nodes, all_shards, red_shards, allocation, setti
                 list_node_weight[i] = 0
             elif n.name in existing_on_nodes:
                 list_node_weight[i] = 0
-            elif inbound_data[literal_field(n.name)] >= move.concurrent * BIG_SHARD_SIZE:
+            elif n.name in rejected_on:
+                # ES REJECTED THIS RECENTLY, AND NOTHING CHANGED SINCE
+                list_node_weight[i] = 0
+                good_reasons += 1
+                cycle_metrics.count("known_rejections")
+            elif n.name in returns:
+                # A COPY LEFT THIS NODE RECENTLY, DO NOT SEND IT BACK
+                list_node_weight[i] = 0
+                good_reasons += 1
+                cycle_metrics.count("suppressed_oscillation")
+            elif not scheduler.can_receive(n.name, move.concurrent):
+                if not n.disk or float(n.disk_free - shard.size) / float(n.disk) >= 0.10:
+                    budget_blocked.append((node_weight[n.name], n.name))
                 list_node_weight[i] = 0
                 good_reasons += 1
             elif n.disk_free == 0 and n.disk > 0:
@@ -957,19 +1259,27 @@ def _allocate(relocating, path, nodes, all_shards, red_shards, allocation, setti
                     Log.warning("Can not allocate shard {{shard}} to {{node}}", node=n.name, shard=(shard.index, shard.i))
                 list_node_weight[i] = 0
                 full_nodes.append(n)
+            elif forecast and move.reason != "not started" and forecast.fills(n, shard.size):
+                # THIS NODE WOULD BE FULL WITHIN THE HORIZON
+                list_node_weight[i] = 0
+                good_reasons += 1
+                cycle_metrics.count("forecast_full")
             elif move.mode_priority >= 5 and len(alloc.shards) >= alloc.max_allowed:
                 list_node_weight[i] = 0
                 good_reasons += 1
             elif move.reason in {"not balanced", "slightly better balance"} and (
                         len(alloc.shards) >= alloc.min_allowed or  # IF THERE IS A MIS-BALANCE THEN THERE MUST BE A NODE WITH **LESS** THAN MINIMUM NUMBER OF SHARDS (PROBABLY FULL)
-                        n.name in current_moving_shards.to_node    # SLOW DOWN MOVEMENT OF SHARDS, ENSURING THEY ARE PROPERLY ACCOUNTED FOR
+                        n.name in moving_to    # SLOW DOWN MOVEMENT OF SHARDS, ENSURING THEY ARE PROPERLY ACCOUNTED FOR
             ):
                 list_node_weight[i] = 0
                 good_reasons += 1
 
         if SUM(list_node_weight) == 0:
-            if not sent_full_nodes_warning and full_nodes and not good_reasons:
-                sent_full_nodes_warning = True
+            if budget_blocked and preemption.is_urgent(move):
+                # ASK FOR THE BUDGET OF THE BEST DESTINATION
+                preemption.blocked(max(budget_blocked)[1], "ingress", move)
+            if "full nodes" not in warnings and full_nodes and not good_reasons:
+                warnings.add("full nodes")
                 Log.warning(
                     "Can not move {{shard}} from {{source}} to {{destination}} because {{num}} nodes are all full",
                     shard=value2json({"index": shard.index, "i": shard.i}),
@@ -981,33 +1291,40 @@ def _allocate(relocating, path, nodes, all_shards, red_shards, allocation, setti
                         for n in full_nodes
                     ]
                 )
-            continue  # NO SHARDS CAN ACCEPT THIS
-
-        while True:
-            i = Random.weight(list_node_weight)
-            destination_node = list_nodes[i].name
-            for s in all_shards:
-                if s.index == shard.index and s.i == shard.i and s.node.name == destination_node:
-                    Log.error(
-                        "SHOULD NEVER HAPPEN Shard {{shard.index}}:{{shard.i}} already on node {{node}}",
-                        shard=shard,
-                        node=destination_node
-                    )
-                    break
-            else:
-                break
+            return None  # NO SHARDS CAN ACCEPT THIS
+        return source_node, list_nodes, list_node_weight
 
-        existing = filter(
-            lambda r: r.index == shard.index and r.i == shard.i and r.node.name == destination_node and r.status in {"INITIALIZING", "STARTED", "RELOCATING"},
-            all_shards
-        )
+    Log.note("Considering {{num}} moves", num=len(moves))
+    if settings.planner == "global":
+        planner = GlobalPlanner(allocation)
+        plan = planner.plan(moves, destinations)
+    else:
+        planner = None
+        plan = random_plan(moves, destinations)
+
+    for move, source_node, destination_node in plan:
+        shard = move.shard
+        replicas = snapshot.replicas(shard.index, shard.i)
+        for s in replicas:
+            if s.node.name == destination_node:
+                Log.error(
+                    "SHOULD NEVER HAPPEN Shard {{shard.index}}:{{shard.i}} already on node {{node}}",
+                    shard=shard,
+                    node=destination_node
+                )
+
+        existing = [
+            r
+            for r in replicas
+            if r.node.name == destination_node and r.status in {"INITIALIZING", "STARTED", "RELOCATING"}
+        ]
         if len(existing) >= nodes[destination_node].zone.shards:
             Log.error("should not happen")
 
-        # DESTINATION HAS BEEN DECIDED, ISSUE MOVE
+        # DESTINATION HAS BEEN DECIDED, PLAN MOVE
 
         if shard.status == "UNASSIGNED":
-            if red_shards:
+            if (shard.index, shard.i) in red_shards:
                 command = wrap({ALLOCATE_EMPTY_PRIMARY: {
                     "accept_data_loss": ACCEPT_DATA_LOSS,
                     "index": shard.index,
@@ -1034,7 +1351,7 @@ def _allocate(relocating, path, nodes, all_shards, red_shards, allocation, setti
                 "from_node": source_node,
                 "to_node": destination_node
             }
-            current_moving_shards.append(_move)
+            moving_to.add(destination_node)
             command = wrap({"move": _move})
         else:
             Log.error("do not know how to handle")
@@ -1048,33 +1365,79 @@ def _allocate(relocating, path, nodes, all_shards, red_shards, allocation, setti
             node=destination_node
         )
 
-        response = http.post(path + "/_cluster/reroute", json={"commands": [command]})
-        result = json2value(response.content.decode('utf8'))
-
-        def move_accepted():
-            # CALL ME WHEN MOVE IS ACCEPTED
-            if shard.status == "STARTED":
-                shard.status = "RELOCATING"
-            done.add((shard.index, shard.i))
-            inbound_data[literal_field(destination_node)] += shard.size
-            if source_node:
-                # `source_node is None` WHEN CLUSTER IS RED
-                outbound_data[literal_field(source_node)] += shard.size
+        move_plan.add(move, list(command.keys())[0], source_node, destination_node)
+
+        # ASSUME THE MOVE IS ACCEPTED, SO THE NEXT MOVES ARE PLANNED AROUND IT; THE planner HAS COUNTED IT ALREADY
+        entry = batch.add(command, shard=shard, status=shard.status, source_node=source_node, destination_node=destination_node, move_reason=move.reason, move_priority=move.mode_priority)
+        _account_move(entry, True, snapshot, done, scheduler)
+
+        if len(batch) >= batch.batch_size:
+            move_failures = _submit_moves(path, batch, nodes, snapshot, done, scheduler, move_failures, planner)
+            if move_failures >= MAX_MOVE_FAILURES:
+                Log.warning("{{num}} consecutive failed moves. Starting over.", num=move_failures)
+                return
+
+    move_failures = _submit_moves(path, batch, nodes, snapshot, done, scheduler, move_failures, planner)
+    if move_failures >= MAX_MOVE_FAILURES:
+        Log.warning("{{num}} consecutive failed moves. Starting over.", num=move_failures)
+        return
+    Log.note("Done making moves")
+
+
+move_plan = MovePlan()  # THE MOVES OF THE LAST CYCLE
+
+
+def _account_move(entry, accepted, snapshot, done, scheduler, planner=None):
+    """
+    ADD (OR REMOVE, IF NOT accepted) THE PLANNED MOVE FROM THE DATA FLOW ACCOUNTING
+    :param planner: GlobalPlanner, IF ITS RESERVATION MUST CHANGE TOO
+    """
+    shard = entry.shard
+    amount = shard.size if accepted else -shard.size
+    if entry.status == "STARTED":
+        snapshot.set_status(shard, "RELOCATING" if accepted else "STARTED")
+    if accepted:
+        done.add((shard.index, shard.i))
+    else:
+        done.discard((shard.index, shard.i))
+    scheduler.reserve(entry.source_node, entry.destination_node, amount)
+    load_model.reserve(entry.source_node if entry.status == "STARTED" else None, entry.destination_node, shard.index, shard.i, accepted)
+    disk_forecast.reserve(entry.source_node if entry.status == "STARTED" else None, entry.destination_node, amount)
+    if planner:
+        planner.reserve(shard, entry.destination_node, accepted)
+
+
+def _submit_moves(path, batch, nodes, snapshot, done, scheduler, move_failures, planner=None):
+    """
+    SEND THE PLANNED MOVES, AND UNDO THE ACCOUNTING OF THE REJECTED ONES
+    :param planner: GlobalPlanner THAT PLANNED THE MOVES, IF ANY
+    :return: NUMBER OF CONSECUTIVE FAILED MOVES, COUNTED IN PLAN ORDER
+    """
+    if not batch:
+        return move_failures
+
+    retry = []
+    for entry in batch.flush():
+        if entry.accepted:
+            cycle_metrics.count("accepted")
+            cycle_metrics.count("bytes_scheduled", entry.shard.size)
+            if not PLAN_ONLY:
+                move_history.record(entry.shard, entry.move_reason, entry.move_priority, entry.source_node, entry.destination_node)
             Log.note(
-                "ok={{result.acknowledged}}",
-                result=result
+                "ok: {{mode}} index={{shard.index}}, shard={{shard.i}}, assign_to={{node}}",
+                mode=list(entry.command.keys())[0],
+                shard=entry.shard,
+                node=entry.destination_node
             )
-            return 0
-
-        if response.status_code in [200, 201] and result.acknowledged:
-            move_failures = move_accepted()
+            move_failures = 0
             continue
 
-        if move_failures >= MAX_MOVE_FAILURES:
-            Log.warning("{{num}} consecutive failed moves. Starting over.", num=move_failures)
-            return
-
-        main_reason = strings.between(result.error, "[NO", "]")
+        _account_move(entry, False, snapshot, done, scheduler, planner)
+        cycle_metrics.count("rejected")
+        main_reason = entry.reason
+        if failure_class(main_reason) != TOO_MANY_COPIES and "failed to resolve [" not in entry.error:
+            # NOT RETRIED BELOW, AND NOT A LOST NODE: DO NOT SEND AGAIN SOON
+            rejection_cache.add(entry.shard.index, entry.shard.i, entry.shard.size, nodes[entry.destination_node], main_reason)
         if main_reason and "target node version" in main_reason:
             continue
 
@@ -1082,111 +1445,189 @@ def _allocate(relocating, path, nodes, all_shards, red_shards, allocation, setti
         if main_reason and main_reason.find("too many shards on nodes for attribute") != -1:
             # THIS WILL HAPPEN WHEN THE ES SHARD BALANCER IS ACTIVATED, NOTHING WE CAN DO
             Log.note("Allocation failed: zone full. ES zone-based shard balancer activated")
+            continue
         elif main_reason and main_reason.find("after allocation more than allowed") != -1:
             Log.note("Allocation failed: node out of space.")
-        elif "failed to resolve [" in result.error:
+            continue
+        elif "failed to resolve [" in entry.error:
             # LOST A NODE WHILE SENDING UPDATES
-            lost_node_name = strings.between(result.error, "failed to resolve [", "]").strip()
+            lost_node_name = strings.between(entry.error, "failed to resolve [", "]").strip()
             Log.warning("Allocation failed: Lost node during allocate {{node}}", node=lost_node_name)
-            nodes[lost_node_name].zone = None
+            nodes[lost_node_name].zone = Null
+            continue
         elif main_reason and "there are too many copies of the shard" in main_reason:
-            try:
-                disable_zone_restrications(path)
-                # TRY AGAIN
-                Till(seconds=5).wait()
-                response = http.post(path + "/_cluster/reroute", json={"commands": [command]})
-                result = json2value(response.content.decode('utf8'))
-                if response.status_code in [200, 201] and result.acknowledged:
-                    move_failures = move_accepted()
-                    continue
-            except Exception as e:
-                Log.warning("retry with disabled zone restrictions seems to have failed", cause=e)
+            retry.append(entry)
+            continue
 
         Log.warning(
-            "Allocation failed: {{code}} Can not move/allocate:\n\treason={{reason}}\n\tdetails={{error|quote}}",
-            code=response.status_code,
+            "Allocation failed: Can not move/allocate:\n\treason={{reason}}\n\tdetails={{error|quote}}",
             reason=main_reason,
-            error=result.error
+            error=entry.error
         )
 
-    Log.note("Done making moves")
+    if retry:
+        try:
+            disable_zone_restrications(path)
+            # TRY AGAIN
+            Till(seconds=5).wait()
+            again = RerouteBatch(path, batch.batch_size, plan_only=PLAN_ONLY)
+            for entry in retry:
+                again.add(entry.command, shard=entry.shard, status=entry.status, source_node=entry.source_node, destination_node=entry.destination_node, move_reason=entry.move_reason, move_priority=entry.move_priority)
+            for entry in again.flush():
+                if entry.accepted:
+                    _account_move(entry, True, snapshot, done, scheduler, planner)
+                    move_history.record(entry.shard, entry.move_reason, entry.move_priority, entry.source_node, entry.destination_node)
+                    cycle_metrics.count("accepted")
+                    cycle_metrics.count("rejected", -1)
+                    cycle_metrics.count("bytes_scheduled", entry.shard.size)
+                    move_failures = 0
+                else:
+                    rejection_cache.add(entry.shard.index, entry.shard.i, entry.shard.size, nodes[entry.destination_node], entry.reason)
+                    Log.warning(
+                        "Allocation failed: Can not move/allocate:\n\treason={{reason}}\n\tdetails={{error|quote}}",
+                        reason=entry.reason,
+                        error=entry.error
+                    )
+        except Exception as e:
+            Log.warning("retry with disabled zone restrictions seems to have failed", cause=e)
 
+    return move_failures
 
-def cancel(path, shard):
-    json = {"commands": [{"cancel": {
-        "index": shard.index,
-        "shard": shard.i,
-        "node": shard.node.name
-    }}]}
-    result = json2value(
-        http.post(path + "/_cluster/reroute", json=json).content.decode('utf8')
-    )
-    if not result.acknowledged:
-        main_reason = strings.between(result.error, "[NO", "]")
-        Log.warning(
-            "Can not cancel from {{node}}:\n\treason={{reason}}\n\tdetails={{error|quote}}",
-            reason=main_reason,
-            node=shard.node.name,
-            error=result.error
+
+def log_recovery_progress():
+    """
+    SHOW THE BYTES LEFT TO RECOVER, AND WHEN THE SLOWEST RECOVERY WILL BE DONE
+    """
+    if not recovery_tracker:
+        return
+    remaining = SUM(recovery_tracker.remaining(r) for r in recovery_tracker)
+    slowest = None
+    for r in recovery_tracker:
+        eta = recovery_tracker.eta(r)
+        if eta is not None and (slowest is None or eta > slowest[0]):
+            slowest = eta, r
+    if slowest is None:
+        Log.note(
+            "{{num}} recoveries, {{remaining|round(decimal=1)}}G remaining",
+            num=len(recovery_tracker),
+            remaining=remaining / BILLION
         )
     else:
+        eta, r = slowest
         Log.note(
-            "index={{shard.index}}, shard={{shard.i}}, assign_to={{node}}, ok={{result.acknowledged}}",
-            shard=shard,
-            result=result,
-            node=shard.node.name
+            "{{num}} recoveries, {{remaining|round(decimal=1)}}G remaining, slowest is {{index}}:{{shard}} to {{node}} at {{rate|round(decimal=1)}}M/s, done in {{eta|round(decimal=0)}} seconds",
+            num=len(recovery_tracker),
+            remaining=remaining / BILLION,
+            index=r.index,
+            shard=r.shard,
+            node=r.target_node,
+            rate=r.rate / (1024 * 1024),
+            eta=eta
         )
 
-    Log.note("All moves made")
-
-
-def balance_multiplier(shard_count, node_count):
-    return 10 ** (mo_math.floor(float(shard_count) / float(node_count) + 0.9)-1)
 
+def cancel_stalled_recoveries(path, nodes, snapshot, settings):
+    """
+    CANCEL THE RECOVERIES THAT COPIED NOTHING FOR settings.recovery.stall_timeout,
+    SO THEIR SHARDS CAN BE PLANNED AGAIN
 
-def convert_table_to_list(table, column_names):
-    lines = [l for l in table.split("\n") if l.strip()]
+    ONLY PEER RECOVERIES THE BALANCER STARTED (SEE move_history) ARE CANCELLED;
+    NEVER A store RECOVERY, AND NEVER THE PRIMARY OF A SHARD WITH NO OTHER STARTED COPY
+    """
+    if not settings.recovery.stall_timeout:
+        return
+    stalled = [
+        r
+        for r in recovery_tracker.stalled(Duration(settings.recovery.stall_timeout).seconds)
+        if nodes[r.target_node]
+        and recovery_tracker.is_peer(r)
+        and move_history.priority(r.index, r.shard, r.target_node) is not None
+        and not snapshot.is_only_primary(r.index, r.shard, r.source_node, r.target_node)
+    ]
+    if not stalled:
+        return
+    if PLAN_ONLY:
+        Log.note("Plan only: would cancel {{num}} stalled recoveries", num=len(stalled))
+        return
+    Log.warning(
+        "Cancel {{num}} stalled recoveries:\n{{recoveries|json|indent}}",
+        num=len(stalled),
+        recoveries=[
+            {"index": r.index, "shard": r.shard, "from": r.source_node, "to": r.target_node, "recovered": r.bytes_recovered, "total": r.bytes_total}
+            for r in stalled
+        ]
+    )
+    cancel(path, [
+        wrap({"index": r.index, "i": r.shard, "node": nodes[r.target_node]})
+        for r in stalled
+    ])
+    recovery_tracker.forget(stalled)
 
-    # FIND THE COLUMNS WITH JUST SPACES
-    columns = []
-    for i, c in enumerate(zip(*lines)):
-        if all(r == " " for r in c):
-            columns.append(i)
 
-    columns = columns[0:len(column_names)-1]
-    for i, row in enumerate(lines):
-        yield wrap({c: r for c, r in zip(column_names, split_at(row, columns))})
+def preempt_recoveries(path, nodes, snapshot, preemption):
+    """
+    CANCEL THE LOW-PRIORITY RECOVERIES HOLDING THE BUDGET THAT URGENT MOVES
+    NEED; THE NEXT CYCLE GIVES THAT BUDGET TO THE URGENT MOVES
+    """
+    victims = [r for r in preemption.victims(recovery_tracker, move_history, snapshot) if nodes[r.target_node]]
+    if not victims:
+        return
+    cycle_metrics.count("preempted", len(victims))
+    recoveries = [
+        {
+            "index": r.index,
+            "shard": r.shard,
+            "from": r.source_node,
+            "to": r.target_node,
+            "priority": move_history.priority(r.index, r.shard, r.target_node),
+            "recovered": r.bytes_recovered,
+            "total": r.bytes_total
+        }
+        for r in victims
+    ]
+    if PLAN_ONLY:
+        Log.note("Plan only: would cancel {{num}} low-priority recoveries:\n{{recoveries|json|indent}}", num=len(victims), recoveries=recoveries)
+        return
+    Log.note("Cancel {{num}} low-priority recoveries, for urgent moves:\n{{recoveries|json|indent}}", num=len(victims), recoveries=recoveries)
+    cancel(path, [
+        wrap({"index": r.index, "i": r.shard, "node": nodes[r.target_node]})
+        for r in victims
+    ])
+    recovery_tracker.forget(victims)
 
 
-def split_at(row, columns):
-    output = []
-    last = 0
-    for c in columns:
-        output.append(row[last:c].strip())
-        last = c
-    output.append(row[last:].strip())
-    return output
+def cancel(path, shards):
+    """
+    CANCEL THE RECOVERY OF ALL shards, IN ONE BATCH
+    """
+    batch = RerouteBatch(path, plan_only=PLAN_ONLY)
+    for shard in shards:
+        batch.add({"cancel": {
+            "index": shard.index,
+            "shard": shard.i,
+            "node": shard.node.name
+        }}, shard=shard)
+
+    for entry in batch.flush():
+        if not entry.accepted:
+            Log.warning(
+                "Can not cancel from {{node}}:\n\treason={{reason}}\n\tdetails={{error|quote}}",
+                reason=entry.reason,
+                node=entry.shard.node.name,
+                error=entry.error
+            )
+        else:
+            Log.note(
+                "index={{shard.index}}, shard={{shard.i}}, cancelled on {{node}}",
+                shard=entry.shard,
+                node=entry.shard.node.name
+            )
 
+    Log.note("All cancels sent")
 
-def text_to_bytes(size):
-    if size == "":
-        return 0
 
-    multiplier = {
-        "kb": 1000,
-        "mb": 1000000,
-        "gb": 1000000000
-    }.get(size[-2:])
-    if not multiplier:
-        multiplier = 1
-        if size[-1]=="b":
-            size = size[:-1]
-    else:
-        size = size[:-2]
-    try:
-        return float(size) * float(multiplier)
-    except Exception as e:
-        Log.error("not expected", cause=e)
+def balance_multiplier(shard_count, node_count):
+    return 10 ** (mo_math.floor(float(shard_count) / float(node_count) + 0.9)-1)
 
 
 zone_restrictions_on = True  # KEEP THIS TRUE SO QUERIES GO TO spot, NOT backup NDOES
@@ -1221,12 +1662,76 @@ def enable_zone_restrictions(path):
 
 
 def main():
-    global zone_restrictions_on
-    settings = startup.read_settings()
+    global zone_restrictions_on, PLAN_ONLY
+    settings = startup.read_settings(defs=[
+        {
+            "name": ["--plan-only", "--plan_only"],
+            "help": "plan one cycle of moves, and exit, without changing the cluster",
+            "action": "store_true",
+            "dest": "plan_only"
+        },
+        {
+            "name": ["--plan"],
+            "help": "file to write the --plan-only moves (JSON)",
+            "type": str,
+            "dest": "plan",
+            "default": None
+        },
+        {
+            "name": ["--replay"],
+            "help": "plan one cycle of moves from a recorded cycle file (implies --plan-only)",
+            "type": str,
+            "dest": "replay",
+            "default": None
+        }
+    ])
     Log.start(settings.debug)
 
     constants.set(settings.constants)
     path = settings.elasticsearch.host + ":" + text(settings.elasticsearch.port)
+    global cycle_profiler, cycle_recorder
+    cycle_profiler = CycleProfiler(settings.profile.interval, settings.profile.cycles, settings.profile.filename)
+    if settings.profile.start:
+        cycle_profiler.request()
+    if hasattr(signal, "SIGUSR1"):
+        # kill -USR1 <pid> TO PROFILE THE NEXT FEW CYCLES
+        signal.signal(signal.SIGUSR1, lambda signum, frame: cycle_profiler.request())
+
+    if settings.args.replay:
+        # THE CLUSTER IS NOT TOUCHED; EVERY GET IS ANSWERED FROM THE RECORDING
+        PLAN_ONLY = True
+        try:
+            tables.http = Replayer(settings.args.replay)
+            assign_shards(settings)
+            move_plan.write(settings.args.plan, recovery_scheduler)
+        except Exception as e:
+            Log.error("Problem replaying {{filename}}", filename=settings.args.replay, cause=e)
+        finally:
+            Log.stop()
+        return
+
+    if settings.record.directory:
+        cycle_recorder = Recorder(tables.http, settings.record.directory, settings.record.max_files, settings.record.max_bytes)
+        tables.http = cycle_recorder
+
+    # KEEP CONNECTIONS TO ES OPEN FOR THE LIFE OF THE BALANCER
+    http.session_pool = http.SessionPool(
+        max_connections=coalesce(settings.http.connections, 10),
+        timeout=settings.http.timeout,
+        timeouts=settings.http.timeouts
+    )
+
+    if settings.args.plan_only:
+        PLAN_ONLY = True
+        try:
+            assign_shards(settings)
+            move_plan.write(settings.args.plan, recovery_scheduler)
+        except Exception as e:
+            Log.error("Problem planning moves", e)
+        finally:
+            http.session_pool.close()
+            Log.stop()
+        return
 
     try:
         # response = http.put(
@@ -1274,13 +1779,19 @@ def main():
 
         please_stop = Signal()
 
+        interval = Duration(coalesce(settings.interval, "30second")).seconds
+        max_interval = Duration(coalesce(settings.max_interval, "10minute")).seconds
+        trigger = CycleTrigger(path, interval, max_interval, Duration(coalesce(settings.poll, "10second")).seconds)
+
         def loop(please_stop):
             while not please_stop:
                 try:
                     assign_shards(settings)
                 except Exception as e:
                     Log.warning("Not expected", cause=e)
-                (Till(seconds=30) | please_stop).wait()
+                # WAKE EARLY ON CLUSTER EVENTS, OR IF A RECOVERY IS EXPECTED TO FINISH
+                reason = trigger.wait(recovery_tracker.next_wait(max_interval), please_stop)
+                Log.note("Next cycle: {{reason}}", reason=reason)
 
         Thread.run("loop", loop, please_stop=please_stop)
         MAIN_THREAD.wait_for_shutdown_signal(please_stop=please_stop, allow_exit=True)
@@ -1295,6 +1806,7 @@ def main():
                 )
                 Log.note("Finally {{command}}\n{{result}}", command=c, result=response.all_content)
 
+        http.session_pool.close()
         Log.stop()
 
 
@@ -0,0 +1,189 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# RUN balance.assign_shards() AGAINST SIMULATED CLUSTERS
+#
+#     export PYTHONPATH=.:vendor
+#     python -m balancer.bench_simulator --scenarios=10x1000,100x10000 --lose=2
+#
+# EACH SCENARIO IS <nodes>x<shards>. THE CLUSTER STARTS WITH ALL PRIMARIES
+# STARTED AND ALL REPLICAS UNASSIGNED. IT IS RUN TO CONVERGENCE, THEN --lose
+# SPOT NODES ARE REMOVED, AND IT IS RUN TO CONVERGENCE AGAIN. FOR EACH PHASE
+# THE CPU TIME PER CYCLE, THE CYCLES TO CONVERGENCE AND THE BYTES MOVED ARE
+# REPORTED
+#
+from __future__ import absolute_import, division, unicode_literals
+
+import random
+
+from mo_dots import wrap
+from mo_logs import Log, startup
+
+from balancer import reroute, tables, trigger
+from balancer.cycle import CycleState
+from balancer.plan import MovePlan
+from balancer.recovery import RecoveryTracker
+from balancer.scheduler import RecoveryScheduler
+from balancer.simulator import SimulatedCluster
+
+try:
+    from time import process_time
+except ImportError:
+    from time import clock as process_time
+
+GIGABYTE = 1000 * 1000 * 1000
+INTERVAL = 30  # SIMULATED SECONDS BETWEEN CYCLES
+SHARDS_PER_INDEX = 20
+
+SETTINGS = {
+    "zones": [
+        {"name": "spot", "risky": True, "shards": 2},
+        {"name": "primary", "risky": False, "busy": True, "shards": 1}
+    ],
+    "nodes": [],
+    "allocate": [],
+    "incremental": True,
+    "reroute_batch_size": 50,
+    "replication_priority": ["saved*", "repo*", "task*"],
+    "elasticsearch": {"host": "http://simulator", "port": 9200}
+}
+PREFIXES = ["saved", "repo", "task", "unittest"]
+
+
+def build_cluster(num_nodes, num_shards, seed):
+    """
+    ONE primary NODE FOR EVERY FOUR spot NODES. ALL PRIMARIES ARE STARTED ON
+    THE primary ZONE, ALL REPLICAS UNASSIGNED
+    """
+    rand = random.Random(seed)
+    cluster = SimulatedCluster()
+    num_primary = max(1, num_nodes // 5)
+    primary_nodes = []
+    for n in range(num_nodes):
+        zone = "primary" if n < num_primary else "spot"
+        name = ("primary_%04d" if zone == "primary" else "spot_%04d") % n
+        memory = rand.choice([8, 16, 30]) * GIGABYTE
+        cluster.add_node(name, zone, memory, disk=rand.choice([500, 1000, 2000]) * GIGABYTE)
+        if zone == "primary":
+            primary_nodes.append(name)
+
+    num_copies = sum(z["shards"] for z in SETTINGS["zones"])
+    num_indexes = max(1, num_shards // (SHARDS_PER_INDEX * num_copies))
+    for k in range(num_indexes):
+        index = "%s%08d_000000" % (PREFIXES[k % len(PREFIXES)], k)
+        sizes = [int(rand.lognormvariate(19, 1.5)) for _ in range(SHARDS_PER_INDEX)]
+        cluster.add_index(index, sizes, num_copies - 1)
+        for i in range(SHARDS_PER_INDEX):
+            cluster.place(index, i, rand.choice(primary_nodes))
+    return cluster
+
+
+def install(cluster):
+    """
+    POINT balance.py AT THE SIMULATOR, AND FORGET STATE FROM ANY PREVIOUS RUN
+    """
+    import balance
+
+    for module in (balance, tables, reroute, trigger):
+        module.http = cluster
+    tables.json_supported = {}
+    balance.last_known_node_status.__clear__()
+    balance.last_scrubbing.__clear__()
+    balance.cycle_state = CycleState()
+    balance.cycle_metrics = None
+    balance.recovery_tracker = RecoveryTracker(clock=lambda: cluster.clock)  # THE STATE BELOW USES ITS clock
+    balance.recovery_scheduler = RecoveryScheduler()
+    balance.index_rules = None
+    balance.move_history = None
+    balance.load_model = None
+    balance.disk_forecast = None
+    balance.rejection_cache = None
+    balance.directory_inventory = None
+    balance.move_plan = MovePlan()
+    balance.zone_restrictions_on = True
+    return balance
+
+
+def run_to_convergence(balance, cluster, settings, max_cycles):
+    """
+    :return: STATISTICS FOR THE CYCLES UNTIL A CYCLE, WITH NOTHING RECOVERING, ISSUES NO COMMANDS
+    """
+    cpu = []
+    start_bytes = cluster.bytes_moved
+    start_commands = cluster.commands_accepted
+    for cycle in range(max_cycles):
+        accepted = cluster.commands_accepted
+        idle = not cluster.recovering()  # OTHERWISE MOVES MAY BE THROTTLED
+        start = process_time()
+        balance.assign_shards(settings)
+        cpu.append(process_time() - start)
+        cluster.tick(INTERVAL)
+        if idle and cluster.commands_accepted == accepted:
+            converged = True
+            break
+    else:
+        converged = False
+    return wrap({
+        "cycles": len(cpu),
+        "converged": converged,
+        "cpu_mean": sum(cpu) / len(cpu),
+        "cpu_max": max(cpu),
+        "bytes_moved": cluster.bytes_moved - start_bytes,
+        "commands": cluster.commands_accepted - start_commands,
+        "unassigned": cluster.unassigned()
+    })
+
+
+def report(scenario, phase, stats):
+    Log.note(
+        "{{scenario|left_align(12)}} {{phase|left_align(10)}} {{stats.cycles}} cycles (converged={{stats.converged}}), cpu/cycle mean={{stats.cpu_mean|round(places=3)}}s max={{stats.cpu_max|round(places=3)}}s, {{gb|round(decimal=1)}}GB moved by {{stats.commands}} commands, {{stats.unassigned}} unassigned",
+        scenario=scenario,
+        phase=phase,
+        stats=stats,
+        gb=stats.bytes_moved / GIGABYTE
+    )
+
+
+def main():
+    args = startup.argparse([
+        {"name": "--scenarios", "help": "comma separated <nodes>x<shards>", "type": str, "dest": "scenarios", "default": "10x1000,50x10000,200x50000,500x100000", "required": False},
+        {"name": "--lose", "help": "number of spot nodes lost after convergence", "type": int, "dest": "lose", "default": 2, "required": False},
+        {"name": "--cycles", "help": "maximum cycles per phase", "type": int, "dest": "cycles", "default": 200, "required": False},
+        {"name": "--planner", "help": "random or global", "type": str, "dest": "planner", "default": "random", "required": False},
+        {"name": "--seed", "help": "random seed", "type": int, "dest": "seed", "default": 42, "required": False},
+        {"name": "--verbose", "help": "show the balancer log", "action": "store_true", "dest": "verbose", "required": False}
+    ])
+    Log.start()
+    try:
+        settings = wrap(SETTINGS)
+        settings.planner = args.planner
+        for scenario in args.scenarios.split(","):
+            num_nodes, num_shards = map(int, scenario.strip().split("x"))
+            random.seed(args.seed)
+            cluster = build_cluster(num_nodes, num_shards, args.seed)
+            balance = install(cluster)
+
+            quiet = not args.verbose
+            if quiet:
+                Log.start({"log": [{"log_type": "nothing"}]})
+            try:
+                startup_stats = run_to_convergence(balance, cluster, settings, args.cycles)
+                spot = sorted(n for n, node in cluster.nodes.items() if node.zone == "spot")
+                for name in random.sample(spot, min(args.lose, len(spot))):
+                    cluster.remove_node(name)
+                loss_stats = run_to_convergence(balance, cluster, settings, args.cycles)
+            finally:
+                if quiet:
+                    Log.stop()
+
+            report(scenario, "startup", startup_stats)
+            report(scenario, "node loss", loss_stats)
+    finally:
+        Log.stop()
+
+
+if __name__ == "__main__":
+    main()
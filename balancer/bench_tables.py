@@ -0,0 +1,147 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# COMPARE THE _cat/shards PARSERS
+#
+#     export PYTHONPATH=.:vendor
+#     python -m balancer.bench_tables --shards=shards.txt --shards-json=shards.json
+#
+# RECORD THE PAYLOADS WITH
+#
+#     curl http://localhost:9200/_cat/shards > shards.txt
+#     curl "http://localhost:9200/_cat/shards?format=json&bytes=b&h=index,shard,prirep,state,docs,store,ip,node" > shards.json
+#
+# WITHOUT RECORDED PAYLOADS, A SYNTHETIC CLUSTER OF --size SHARDS IS USED
+#
+from __future__ import absolute_import, division, unicode_literals
+
+from io import BytesIO
+from time import time
+
+from mo_files import File
+from mo_json import stream, value2json
+from mo_logs import Log, startup
+from mo_math.randoms import Random
+
+from balancer.tables import SHARD_COLUMNS, SHARD_NAMES, convert_table_to_list, json_decoder, parse_table, text_to_bytes
+
+
+def original(content):
+    output = []
+    for s in convert_table_to_list(content, SHARD_NAMES):
+        s.i = int(s.i)
+        s.size = text_to_bytes(s.size)
+        output.append(s)
+    return output
+
+
+def fixed_width(content):
+    return [
+        (index, int(i), type_, status, num, text_to_bytes(size), ip, node)
+        for index, i, type_, status, num, size, ip, node in parse_table(content, len(SHARD_NAMES))
+    ]
+
+
+def json_stream(content):
+    return [
+        tuple(row[c] for c in SHARD_COLUMNS)
+        for row in stream.parse(BytesIO(content), ".", SHARD_COLUMNS)
+    ]
+
+
+def json_decode(content):
+    return [
+        tuple(row.get(c, "") for c in SHARD_COLUMNS)
+        for row in json_decoder(content.decode("utf8"))
+    ]
+
+
+def synthetic_rows(num):
+    """
+    :return: LIST OF _cat/shards ROWS (LISTS OF STRINGS)
+    """
+    rows = []
+    for k in range(num):
+        index = "jobs%08d_000000" % (k // 40)
+        i = str(k % 20)
+        type_ = "p" if (k // 20) % 2 == 0 else "r"
+        status = Random.sample(["STARTED"] * 8 + ["UNASSIGNED", "INITIALIZING", "RELOCATING"], 1)[0]
+        ip = "172.31.0." + str(Random.int(250))
+        node = "spot_" + Random.hex(4).upper()
+        if status == "UNASSIGNED":
+            rows.append([index, i, type_, status, "", "", "", ""])
+        elif status == "INITIALIZING":
+            rows.append([index, i, type_, status, "", "", ip, node])
+        else:
+            if status == "RELOCATING":
+                node += " -> 172.31.0." + str(Random.int(250)) + " " + Random.hex(22) + " spot_" + Random.hex(4).upper()
+            rows.append([index, i, type_, status, str(Random.int(10 ** 7)), str(Random.int(10 ** 9)) + "b", ip, node])
+    return rows
+
+
+def rows_to_table(rows):
+    """
+    FORMAT rows LIKE THE _cat ENDPOINTS: PADDED, NUMBERS RIGHT-ALIGNED
+    """
+    right = {1, 4, 5}
+    widths = [max(len(r[c]) for r in rows) for c in range(len(SHARD_COLUMNS))]
+    return "".join(
+        " ".join(r[c].rjust(w) if c in right else r[c].ljust(w) for c, w in enumerate(widths)) + "\n"
+        for r in rows
+    )
+
+
+def rows_to_json(rows):
+    return value2json([
+        {k: v for k, v in zip(SHARD_COLUMNS, r) if v}
+        for r in rows
+    ]).encode("utf8")
+
+
+def timed(name, func, content, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time()
+        result = func(content)
+        duration = time() - start
+        best = duration if best is None else min(best, duration)
+    Log.note("{{name|left_align(20)}} {{num}} shards in {{duration|round(places=3)}} seconds", name=name, num=len(result), duration=best)
+    return result, best
+
+
+def main():
+    args = startup.argparse([
+        {"name": "--shards", "help": "recorded text response from _cat/shards", "type": str, "dest": "shards", "default": None, "required": False},
+        {"name": "--shards-json", "help": "recorded JSON response from _cat/shards", "type": str, "dest": "shards_json", "default": None, "required": False},
+        {"name": "--size", "help": "number of synthetic shards", "type": int, "dest": "size", "default": 50000, "required": False},
+        {"name": "--repeat", "help": "number of timing runs", "type": int, "dest": "repeat", "default": 3, "required": False}
+    ])
+    Log.start()
+    try:
+        if args.shards or args.shards_json:
+            table = File(args.shards).read() if args.shards else None
+            json = File(args.shards_json).read_bytes() if args.shards_json else None
+        else:
+            rows = synthetic_rows(args.size)
+            table = rows_to_table(rows)
+            json = rows_to_json(rows)
+
+        if table:
+            old, old_time = timed("original", original, table, args.repeat)
+            new, new_time = timed("fixed width", fixed_width, table, args.repeat)
+            if [tuple(s[k] for k in SHARD_NAMES) for s in old] != new:
+                Log.warning("fixed width parser does not match original")
+            Log.note("fixed width is {{ratio|round(places=1)}}x faster", ratio=old_time / new_time)
+        if json:
+            timed("json stream", json_stream, json, args.repeat)
+            timed("json decode", json_decode, json, args.repeat)
+    finally:
+        Log.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import, division, unicode_literals
+
+from mo_dots import Data
+
+from balancer.model import Allocations
+
+
+class CycleState(object):
+    """
+    THE MODEL BUILT BY THE PREVIOUS CYCLE
+
+    ONLY A FEW DOZEN SHARDS CHANGE STATE BETWEEN CYCLES, SO THE REPLICA
+    TARGETS AND ALLOCATION LIMITS ARE KEPT, AND ONLY THE INDEXES TOUCHED
+    BY THE DELTA ARE RECALCULATED
+    """
+
+    def __init__(self):
+        self.nodes = {}  # MAP FROM node name TO (zone name, memory, is_data) SIGNATURE
+        self.shards = {}  # MAP FROM (index, i, type, node name) TO TUPLE OF status
+        self.uuid_to_index_name = {}
+        self.replicas_per_zone = {}  # MAP <index> -> <zone.name> -> #shards
+        self.allocation = Allocations()
+        self.populated = set()  # (index, node name) PAIRS THAT HAD SHARDS LAST CYCLE
+        self.dirty = set()  # INDEXES THAT MUST BE REVIEWED AGAIN, EVEN WITHOUT CHANGE
+
+    def update(self, nodes, shards):
+        """
+        COMPARE nodes AND shards WITH THE PREVIOUS CYCLE, AND REMEMBER THEM FOR THE NEXT
+        :return: THE DELTA
+        """
+        delta = Data(
+            new_shards=0,
+            removed_shards=0,
+            changed_shards=0,
+            joined=[],
+            lost=[],
+            changed_nodes=[],
+            indexes=set(),  # INDEXES WITH SOME SHARD CHANGE
+            all_indexes=False  # TRUE IF EVERY INDEX MUST BE RECALCULATED
+        )
+
+        # NODES
+        curr_nodes = {
+            n.name: (n.zone.name, n.memory, 'data' in n.roles)
+            for n in nodes
+        }
+        prev_nodes = self.nodes
+        for name, signature in curr_nodes.items():
+            prev = prev_nodes.get(name)
+            if prev is None:
+                delta.joined.append(name)
+            elif prev != signature:
+                delta.changed_nodes.append(name)
+        for name in prev_nodes:
+            if name not in curr_nodes:
+                delta.lost.append(name)
+        delta.all_indexes = not prev_nodes or bool(delta.joined or delta.lost or delta.changed_nodes)
+        self.nodes = curr_nodes
+
+        # SHARDS
+        curr_shards = {}
+        for s in shards:
+            key = (s.index, s.i, s.type, s.node.name or None)
+            curr_shards[key] = curr_shards.get(key, ()) + (s.status,)
+        prev_shards = self.shards
+        indexes = delta.indexes
+        for key, status in curr_shards.items():
+            prev = prev_shards.get(key)
+            if prev is None:
+                delta.new_shards += len(status)
+                indexes.add(key[0])
+            elif sorted(prev) != sorted(status):
+                delta.changed_shards += 1
+                indexes.add(key[0])
+        for key, status in prev_shards.items():
+            if key not in curr_shards:
+                delta.removed_shards += len(status)
+                indexes.add(key[0])
+        self.shards = curr_shards
+
+        # FORGET INDEXES THAT ARE GONE
+        index_names = set(k[0] for k in curr_shards)
+        for index in list(self.replicas_per_zone.keys()):
+            if index not in index_names:
+                del self.replicas_per_zone[index]
+        self.dirty &= index_names
+        if delta.all_indexes:
+            self.allocation = Allocations()
+            self.populated = set()
+        else:
+            for a in list(self.allocation):
+                if a.index not in index_names:
+                    self.allocation.remove(a)
+            self.populated = set(p for p in self.populated if p[0] in index_names)
+
+        return delta
+
+    def is_affected(self, delta, index):
+        return delta.all_indexes or index in delta.indexes or index in self.dirty or index not in self.replicas_per_zone
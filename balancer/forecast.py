@@ -0,0 +1,165 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import, division, unicode_literals
+
+from collections import deque
+
+from mo_dots import coalesce
+from mo_times import Duration
+
+DEFAULT_WINDOW = "hour"
+DEFAULT_HORIZON = "6hour"
+DEFAULT_FLOOR = 0.10  # FRACTION OF THE DISK KEPT FREE; _allocate ALSO SENDS NO SHARD THAT LEAVES LESS THAN 10%
+MAX_SAMPLES = 1000  # PER NODE, IN CASE THE CYCLES ARE VERY SHORT
+
+
+class DiskForecast(object):
+    """
+    PROJECT WHEN EACH NODE'S DISK WILL FILL, SO SHARDS ARE MOVED OFF BEFORE IT DOES
+
+    EACH CYCLE, observe() ADDS A SAMPLE OF disk_free PER NODE, AND THE BYTES
+    COPIED IN BY THE NODE'S RECOVERIES. THE GROWTH RATE IS THE DISK USED
+    OVER THE LAST window, LESS WHAT RECOVERIES COPIED IN; THE INTERVALS
+    WHERE A RECOVERY STARTED OR ENDED ARE SKIPPED, BECAUSE ITS BYTES ARRIVE
+    (OR LEAVE) ALL AT ONCE. THE BYTES STILL TO ARRIVE BY RECOVERY, LESS THE
+    SHARDS STILL RELOCATING AWAY, ARE pending AND COUNTED AS USED
+
+    A NODE IS FULL WHEN LESS THAN floor OF ITS DISK IS FREE
+    """
+
+    def __init__(self, window=None, horizon=None, floor=None):
+        self.window = Duration(coalesce(window, DEFAULT_WINDOW)).seconds
+        self.horizon = Duration(coalesce(horizon, DEFAULT_HORIZON)).seconds
+        self.floor = coalesce(floor, DEFAULT_FLOOR)
+        self.series = {}  # MAP FROM node name TO (disk, deque OF (time, disk_free, bytes copied in, recoveries))
+        self.growth = {}  # MAP FROM node name TO BYTES/SECOND, None IF NOT KNOWN YET
+        self.pending = {}  # MAP FROM node name TO BYTES STILL TO ARRIVE, LESS BYTES STILL TO LEAVE, BY KNOWN RECOVERIES
+
+    def observe(self, nodes, recoveries, now):
+        """
+        :param nodes: THE NODES, WITH disk AND disk_free
+        :param recoveries: RecoveryTracker, JUST REFRESHED
+        :param now: SECONDS, ON THE CLOCK OF THE recoveries
+        """
+        copied = {}  # MAP FROM node name TO BYTES COPIED IN SO FAR
+        pending = {}
+        moving = {}  # MAP FROM node name TO THE RECOVERIES THAT CHANGE ITS DISK
+        for r in recoveries:
+            key = r.index, r.shard, r.target_node
+            copied[r.target_node] = copied.get(r.target_node, 0) + r.bytes_recovered
+            pending[r.target_node] = pending.get(r.target_node, 0) + recoveries.remaining(r)
+            moving.setdefault(r.target_node, set()).add(key)
+            if r.source_node and recoveries.is_relocation(r):
+                # THE SOURCE COPY IS DELETED WHEN THE RELOCATION IS DONE
+                pending[r.source_node] = pending.get(r.source_node, 0) - r.bytes_total
+                moving.setdefault(r.source_node, set()).add(key)
+        self.pending = pending
+
+        growth = {}
+        for n in nodes:
+            if not n.disk:
+                continue
+            disk, samples = self.series.get(n.name, (None, None))
+            if disk != n.disk:
+                # NEW NODE, OR A NEW DISK
+                samples = deque(maxlen=MAX_SAMPLES)
+            samples.append((now, n.disk_free, copied.get(n.name, 0), frozenset(moving.get(n.name, ()))))
+            while len(samples) > 2 and now - samples[1][0] >= self.window:
+                samples.popleft()
+            self.series[n.name] = n.disk, samples
+            growth[n.name] = _growth(samples)
+        self.series = {k: v for k, v in self.series.items() if k in growth}
+        self.growth = growth
+
+    def reserve(self, source_node, destination_node, amount):
+        """
+        A SHARD OF amount BYTES IS PLANNED TO MOVE (NEGATIVE TO UNDO), SO THE NEXT MOVES OF THIS CYCLE SEE IT AS pending
+        :param source_node: THE NODE THE SHARD LEAVES, OR None IF IT IS A NEW COPY
+        """
+        self.pending[destination_node] = self.pending.get(destination_node, 0) + amount
+        if source_node:
+            self.pending[source_node] = self.pending.get(source_node, 0) - amount
+
+    def time_to_full(self, node, extra=0):
+        """
+        :param extra: BYTES TO BE ADDED TO THE NODE NOW
+        :return: SECONDS UNTIL node IS FULL, 0 IF IT ALREADY IS, None IF IT IS NOT FILLING
+        """
+        if not node.disk:
+            return None
+        headroom = node.disk_free - self.floor * node.disk - self.pending.get(node.name, 0) - extra
+        if headroom <= 0:
+            return 0
+        growth = self.growth.get(node.name)
+        if not growth or growth <= 0:
+            return None
+        return headroom / growth
+
+    def fills(self, node, extra=0):
+        """
+        :return: True IF node IS FULL WITHIN THE horizon, AFTER extra BYTES ARE ADDED
+        """
+        ttf = self.time_to_full(node, extra)
+        return ttf is not None and ttf < self.horizon
+
+    def excess(self, node):
+        """
+        :return: BYTES TO MOVE OFF node SO IT LASTS THE horizon
+        """
+        if not node.disk:
+            return 0
+        growth = max(0, self.growth.get(node.name) or 0)
+        return growth * self.horizon + self.floor * node.disk + self.pending.get(node.name, 0) - node.disk_free
+
+    def evacuate(self, node, shards):
+        """
+        :param shards: THE STARTED SHARDS ON node THAT MAY MOVE
+        :return: THE SHARDS TO MOVE OFF node: AT LEAST excess(node) BYTES, WITH AS LITTLE MORE AS WE CAN FIND
+        """
+        need = self.excess(node)
+        if need <= 0 or not self.fills(node):
+            return []
+        chosen = []
+        rest = []
+        remaining = need
+        # BIGGEST SHARDS THAT FIT IN WHAT IS STILL NEEDED
+        for s in sorted(shards, key=lambda s: s.size, reverse=True):
+            if 0 < s.size <= remaining:
+                chosen.append(s)
+                remaining -= s.size
+            else:
+                rest.append(s)
+        if remaining > 0:
+            # THEN THE SMALLEST SHARD THAT COVERS THE REST
+            covering = [s for s in rest if s.size >= remaining]
+            if not covering:
+                return chosen + rest  # NOT ENOUGH ON THE NODE, MOVE WHAT WE CAN
+            chosen.append(min(covering, key=lambda s: s.size))
+            # THE COVERING SHARD MAY MAKE SOME SMALL ONES UNNEEDED
+            total = sum(s.size for s in chosen)
+            for s in sorted(chosen[:-1], key=lambda s: s.size):
+                if total - s.size >= need:
+                    chosen.remove(s)
+                    total -= s.size
+        return chosen
+
+
+def _growth(samples):
+    """
+    :return: BYTES/SECOND WRITTEN TO THE NODE, NOT COUNTING RECOVERIES, OR None IF NOT KNOWN
+    """
+    written = 0
+    elapsed = 0
+    prev = None
+    for sample in samples:
+        if prev is not None and sample[3] == prev[3] and sample[0] > prev[0]:
+            written += (prev[1] - sample[1]) - (sample[2] - prev[2])
+            elapsed += sample[0] - prev[0]
+        prev = sample
+    if not elapsed:
+        return None
+    return written / elapsed
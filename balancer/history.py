@@ -0,0 +1,147 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import, division, unicode_literals
+
+from collections import deque
+
+from mo_dots import coalesce, unwrap
+from mo_files import File
+from mo_json import json2value, value2json
+from mo_logs import Log
+from mo_times import Date, Duration
+
+DEFAULT_MAX_MOVES = 10000
+DEFAULT_SHARD_COOLDOWN = "hour"
+DEFAULT_INDEX_COOLDOWN = "0second"
+DEFAULT_OSCILLATION_WINDOW = "6hour"
+IN_FLIGHT = 24 * 60 * 60  # SECONDS, LONGEST A RECOVERY IS EXPECTED TO TAKE; THE PRIORITY OF A MOVE IS KEPT THIS LONG
+
+# THE REASONS TO MOVE A STARTED SHARD THAT ARE ONLY ABOUT BALANCE; ONLY THESE ARE SUPPRESSED
+DISCRETIONARY = {"over allocated", "move replica into busy zone", "not balanced", "slightly better balance"}
+
+SHARD_COOLDOWN = "shard_cooldown"
+INDEX_COOLDOWN = "index_cooldown"
+
+
+class MoveHistory(object):
+    """
+    THE LAST max_moves MOVES SENT, WITH time, reason, priority AND bytes, SO
+    THE BALANCING PASSES DO NOT UNDO WHAT THE LAST CYCLES DID, AND THE
+    PRIORITY OF EACH IN-FLIGHT RECOVERY IS KNOWN
+
+    A SHARD MOVED (FOR ANY REASON) IN THE LAST shard_cooldown, OR A SHARD
+    OF AN INDEX MOVED IN THE LAST index_cooldown, IS NOT MOVED FOR BALANCE.
+    A NODE THAT A COPY OF THE SHARD LEFT IN THE LAST oscillation_window IS
+    NOT A DESTINATION FOR BALANCE, SO NO SHARD GOES A->B->A
+
+    WITH filename, THE HISTORY IS KEPT ON LOCAL DISK SO IT SURVIVES RESTARTS
+    """
+
+    def __init__(self, filename=None, max_moves=None, shard_cooldown=None, index_cooldown=None, oscillation_window=None, clock=None):
+        self.clock = clock or (lambda: Date.now().unix)  # SECONDS, REPLACEABLE FOR SIMULATION
+        self.file = File(filename) if filename else None
+        self.moves = deque(maxlen=coalesce(max_moves, DEFAULT_MAX_MOVES))
+        self.shard_cooldown = Duration(coalesce(shard_cooldown, DEFAULT_SHARD_COOLDOWN)).seconds
+        self.index_cooldown = Duration(coalesce(index_cooldown, DEFAULT_INDEX_COOLDOWN)).seconds
+        self.oscillation_window = Duration(coalesce(oscillation_window, DEFAULT_OSCILLATION_WINDOW)).seconds
+        self.shard_moved = {}  # MAP FROM (index, i) TO TIME OF LAST MOVE
+        self.index_moved = {}  # MAP FROM index TO TIME OF LAST MOVE
+        self.left = {}  # MAP FROM (index, i) TO (MAP FROM node name TO TIME A COPY LEFT IT)
+        self.sent = {}  # MAP FROM (index, i, node name) TO (TIME, mode_priority) OF THE LAST MOVE THERE
+        self.dirty = False
+        if self.file is not None and self.file.exists:
+            try:
+                for m in unwrap(json2value(self.file.read(), leaves=False)):
+                    self._remember(m)
+            except Exception as e:
+                Log.warning("Can not read move history {{file}}", file=self.file.abspath, cause=e)
+
+    def record(self, shard, reason, priority, source_node, destination_node):
+        self._remember({
+            "time": self.clock(),
+            "index": shard.index,
+            "shard": shard.i,
+            "reason": reason,
+            "priority": priority,
+            "bytes": shard.size,
+            "from": source_node,
+            "to": destination_node
+        })
+        self.dirty = True
+
+    def _remember(self, move):
+        self.moves.append(move)
+        key = move["index"], move["shard"]
+        now = move["time"]
+        self.shard_moved[key] = now
+        if move["reason"] in DISCRETIONARY:
+            self.index_moved[move["index"]] = now
+        if move["from"]:
+            self.left.setdefault(key, {})[move["from"]] = now
+        self.sent[key + (move["to"],)] = now, move.get("priority")
+
+    def cooldown(self, shard, reason):
+        """
+        :return: SHARD_COOLDOWN OR INDEX_COOLDOWN IF shard SHOULD NOT BE MOVED FOR reason NOW, ELSE None
+        """
+        if reason not in DISCRETIONARY:
+            return None
+        now = self.clock()
+        moved = self.shard_moved.get((shard.index, shard.i))
+        if moved is not None and now - moved < self.shard_cooldown:
+            return SHARD_COOLDOWN
+        moved = self.index_moved.get(shard.index)
+        if moved is not None and now - moved < self.index_cooldown:
+            return INDEX_COOLDOWN
+        return None
+
+    def returns(self, shard, reason):
+        """
+        :return: NAMES OF THE NODES A COPY OF shard LEFT RECENTLY; MOVING THERE FOR reason WOULD OSCILLATE
+        """
+        if reason not in DISCRETIONARY:
+            return ()
+        left = self.left.get((shard.index, shard.i))
+        if not left:
+            return ()
+        since = self.clock() - self.oscillation_window
+        return set(node_name for node_name, when in left.items() if when > since)
+
+    def priority(self, index, i, node_name):
+        """
+        :return: mode_priority OF THE LAST MOVE OF (index, i) TO node_name, OR None IF NOT SENT BY THE BALANCER
+        """
+        sent = self.sent.get((index, i, node_name))
+        return sent[1] if sent else None
+
+    def prune(self):
+        """
+        FORGET WHAT CAN NO LONGER SUPPRESS A MOVE
+        """
+        now = self.clock()
+        for lookup, window in ((self.shard_moved, self.shard_cooldown), (self.index_moved, self.index_cooldown)):
+            for k, when in list(lookup.items()):
+                if now - when >= window:
+                    del lookup[k]
+        for k, left in list(self.left.items()):
+            for node_name, when in list(left.items()):
+                if now - when >= self.oscillation_window:
+                    del left[node_name]
+            if not left:
+                del self.left[k]
+        for k, (when, _) in list(self.sent.items()):
+            if now - when >= IN_FLIGHT:
+                del self.sent[k]
+
+    def save(self):
+        if self.file is None or not self.dirty:
+            return
+        try:
+            self.file.write(value2json(list(self.moves)))
+            self.dirty = False
+        except Exception as e:
+            Log.warning("Can not save move history {{file}}", file=self.file.abspath, cause=e)
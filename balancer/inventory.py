@@ -0,0 +1,105 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import, division, unicode_literals
+
+import hashlib
+
+from mo_dots import coalesce, unwrap, wrap
+from mo_files import File
+from mo_future import text
+from mo_json import json2value, value2json
+from mo_logs import Log
+from mo_threads import Lock
+from mo_times import Date, Duration
+
+DEFAULT_TTL = "6hour"
+RESTART_TOLERANCE = 60  # SECONDS OF CLOCK DIFFERENCE BEFORE A NODE IS CONSIDERED RESTARTED
+
+
+class DirectoryInventory(object):
+    """
+    THE SHARD DIRECTORIES OF EACH NODE, AS FOUND BY THE LAST SCAN, KEPT ON
+    LOCAL DISK SO THEY SURVIVE RESTARTS OF THE BALANCER
+
+    AN ENTRY IS KEYED BY NODE NAME AND DATA PATH. IT IS USED ONLY WHILE
+    - IT IS YOUNGER THAN ttl
+    - THE NODE HAS NOT RESTARTED (node.started IS THE SAME)
+    - THE SET OF SHARDS ES PUT ON THE NODE IS THE SAME (SAME shard_digest)
+    """
+
+    def __init__(self, filename=None, ttl=None):
+        self.file = File(filename) if filename else None
+        self.ttl = Duration(coalesce(ttl, DEFAULT_TTL)).seconds
+        self.lock = Lock("directory inventory")
+        self.entries = {}  # MAP FROM key TO {"time", "started", "digest", "directories"}
+        if self.file is not None and self.file.exists:
+            try:
+                self.entries = unwrap(json2value(self.file.read(), leaves=False))
+                self._evict(Date.now().unix)
+            except Exception as e:
+                Log.warning("Can not read directory inventory {{file}}", file=self.file.abspath, cause=e)
+                self.entries = {}
+
+    def get(self, node, data_path, digest):
+        """
+        :return: THE CACHED DIRECTORIES, OR None IF THE NODE MUST BE SCANNED
+        """
+        with self.lock:
+            entry = self.entries.get(_key(node, data_path))
+        if entry is None:
+            return None
+        if Date.now().unix - entry["time"] > self.ttl:
+            return None
+        if entry["digest"] != digest:
+            return None
+        started = node.started
+        if started != None and (entry["started"] is None or abs(entry["started"] - started) > RESTART_TOLERANCE):
+            return None
+        return wrap(entry["directories"])
+
+    def set(self, node, data_path, digest, directories):
+        now = Date.now().unix
+        with self.lock:
+            self.entries[_key(node, data_path)] = {
+                "time": now,
+                "started": unwrap(node.started),
+                "digest": digest,
+                "directories": unwrap(directories)
+            }
+            self._evict(now)
+            self._save()
+
+    def invalidate(self, node, data_path):
+        with self.lock:
+            if self.entries.pop(_key(node, data_path), None) is not None:
+                self._save()
+
+    def _evict(self, now):
+        for k, entry in list(self.entries.items()):
+            if now - entry["time"] > self.ttl:
+                del self.entries[k]
+
+    def _save(self):
+        if self.file is None:  # File IS FALSE UNTIL IT EXISTS
+            return
+        try:
+            self.file.write(value2json(self.entries))
+        except Exception as e:
+            Log.warning("Can not save directory inventory {{file}}", file=self.file.abspath, cause=e)
+
+
+def shard_digest(shards):
+    """
+    :param shards: THE SHARDS ES HAS ON A NODE
+    :return: SHORT DIGEST OF THE (index, i) SET
+    """
+    content = "\n".join(sorted(s.index + ":" + text(s.i) for s in shards))
+    return hashlib.sha1(content.encode("utf8")).hexdigest()
+
+
+def _key(node, data_path):
+    return node.name + ":" + data_path
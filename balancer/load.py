@@ -0,0 +1,145 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import, division, unicode_literals
+
+from mo_dots import coalesce
+from mo_times import Date, Duration
+
+COMPONENTS = ["indexing", "search", "merge"]  # THE ORDER OF THE COUNTERS IN THE tables.get_shard_stats() ROWS
+DEFAULT_HALF_LIFE = "10minute"
+DEFAULT_WEIGHTS = {"indexing": 1, "search": 1, "merge": 1}
+DEFAULT_STRENGTH = 1
+MIN_CAPACITY = 0.5  # A NODE IS NEVER GIVEN LESS THAN THIS FRACTION OF ITS MEMORY-PROPORTIONAL SHARDS
+MAX_CAPACITY = 1.5
+
+
+class LoadModel(object):
+    """
+    THE INDEXING, SEARCH AND MERGE LOAD OF EACH SHARD COPY, AND OF EACH NODE
+
+    EACH CYCLE, observe() IS GIVEN THE CUMULATIVE COUNTERS OF EVERY COPY;
+    THE RATE SINCE THE LAST CYCLE IS FOLDED INTO AN EXPONENTIALLY DECAYED
+    RATE WITH THE GIVEN half_life. THE THREE RATES HAVE DIFFERENT UNITS, SO
+    EACH IS TAKEN AS A FRACTION OF THE CLUSTER TOTAL BEFORE THEY ARE ADDED,
+    BY weights, INTO THE LOAD OF THE COPY
+
+    A NODE'S score IS ITS LOAD OVER THE MEAN NODE LOAD (1.0 IS AVERAGE), AND
+    A SHARD'S heat IS ITS LOAD OVER THE MEAN SHARD LOAD. WITH NO RATES YET,
+    BOTH ARE 1.0, AND capacity() AND weight() CHANGE NOTHING
+    """
+
+    def __init__(self, half_life=None, weights=None, strength=None):
+        self.half_life = Duration(coalesce(half_life, DEFAULT_HALF_LIFE)).seconds
+        self.weights = [coalesce(weights[c] if weights else None, DEFAULT_WEIGHTS[c]) for c in COMPONENTS]
+        self.strength = coalesce(strength, DEFAULT_STRENGTH)
+        self.counters = {}  # MAP FROM (index, i, node name) TO (time, counters) OF THE LAST SAMPLE
+        self.rates = {}  # MAP FROM (index, i, node name) TO DECAYED RATE OF EACH COMPONENT
+        self.shard_load = {}  # MAP FROM (index, i) TO MEAN LOAD OF ITS COPIES
+        self.index_load = {}  # MAP FROM index TO MEAN shard_load, FOR THE SHARDS WITH NO RATES YET
+        self.node_load = {}  # MAP FROM node name TO LOAD, INCLUDING THE MOVES PLANNED THIS CYCLE
+        self.mean_node_load = 0
+        self.mean_shard_load = 0
+
+    def observe(self, rows, node_names, now=None):
+        """
+        :param rows: LIST OF (index, i, node_name, index_total, query_total, merge_millis), FROM tables.get_shard_stats()
+        :param node_names: NAMES OF THE DATA NODES, SO NODES WITH NO LOAD PULL THE MEAN DOWN
+        :param now: TIME OF THE SAMPLE (FOR TESTING)
+        """
+        now = coalesce(now, Date.now().unix)
+        samples = {}
+        for row in rows:
+            key, counters = row[:3], row[3:]
+            samples[key] = now, counters
+            prev = self.counters.get(key)
+            if prev is None:
+                continue
+            elapsed = now - prev[0]
+            if elapsed <= 0:
+                continue
+            deltas = [c - p for c, p in zip(counters, prev[1])]
+            if any(d < 0 for d in deltas):
+                # COUNTERS RESET: THE COPY WAS RECOVERED AGAIN, OR THE NODE RESTARTED; KEEP THE OLD RATE
+                continue
+            rate = [d / elapsed for d in deltas]
+            old = self.rates.get(key)
+            if old is None:
+                self.rates[key] = rate
+            else:
+                decay = 0.5 ** (elapsed / self.half_life)
+                self.rates[key] = [decay * o + (1 - decay) * r for o, r in zip(old, rate)]
+        self.counters = samples
+        self.rates = {k: v for k, v in self.rates.items() if k in samples}
+        self._score(node_names)
+
+    def _score(self, node_names):
+        totals = [sum(r[c] for r in self.rates.values()) for c in range(len(COMPONENTS))]
+        copies = {}
+        node_load = {n: 0 for n in node_names}
+        for (index, i, node_name), rate in self.rates.items():
+            load = sum(w * r / t for w, r, t in zip(self.weights, rate, totals) if t)
+            copies.setdefault((index, i), []).append(load)
+            node_load[node_name] = node_load.get(node_name, 0) + load
+        self.shard_load = {k: sum(v) / len(v) for k, v in copies.items()}
+        by_index = {}
+        for (index, i), load in self.shard_load.items():
+            by_index.setdefault(index, []).append(load)
+        self.index_load = {k: sum(v) / len(v) for k, v in by_index.items()}
+        self.node_load = node_load
+        self.mean_node_load = sum(node_load.values()) / len(node_load) if node_load else 0
+        self.mean_shard_load = sum(self.shard_load.values()) / len(self.shard_load) if self.shard_load else 0
+
+    def score(self, node_name):
+        """
+        :return: LOAD OF node_name, RELATIVE TO THE MEAN NODE
+        """
+        if not self.mean_node_load:
+            return 1.0
+        return self.node_load.get(node_name, 0) / self.mean_node_load
+
+    def heat(self, index, i):
+        """
+        :return: LOAD OF A COPY OF (index, i), RELATIVE TO THE MEAN SHARD; A NEW SHARD IS AS HOT AS ITS INDEX, A NEW INDEX IS AVERAGE
+        """
+        if not self.mean_shard_load:
+            return 1.0
+        load = self.shard_load.get((index, i))
+        if load is None:
+            load = self.index_load.get(index, self.mean_shard_load)
+        return load / self.mean_shard_load
+
+    def capacity(self, node_name):
+        """
+        :return: MULTIPLIER OF THE NODE'S MEMORY, FOR ITS SHARE OF THE SHARDS; LESS THAN 1 FOR BUSY NODES
+        """
+        d = 1 + self.strength * (self.score(node_name) - 1)
+        if d <= 0:
+            return MAX_CAPACITY
+        return min(MAX_CAPACITY, max(MIN_CAPACITY, 1 / d))
+
+    def weight(self, node_name, index, i):
+        """
+        :return: MULTIPLIER OF THE NODE'S DESTINATION WEIGHT FOR A COPY OF (index, i); HOT SHARDS AVOID BUSY NODES MORE
+        """
+        if not self.mean_node_load:
+            return 1.0
+        return 1 / (1 + self.strength * self.score(node_name) * self.heat(index, i))
+
+    def reserve(self, source_node, destination_node, index, i, accepted=True):
+        """
+        A COPY OF (index, i) IS PLANNED TO MOVE, SO THE NEXT MOVES OF THIS CYCLE SEE ITS LOAD ON destination_node
+        :param source_node: THE NODE THE COPY LEAVES, OR None IF IT IS A NEW COPY
+        :param accepted: False TO UNDO THE RESERVATION OF A REJECTED MOVE
+        """
+        if not self.mean_node_load:
+            return
+        load = self.heat(index, i) * self.mean_shard_load
+        if not accepted:
+            load = -load
+        self.node_load[destination_node] = self.node_load.get(destination_node, 0) + load
+        if source_node:
+            self.node_load[source_node] = self.node_load.get(source_node, 0) - load
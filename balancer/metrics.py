@@ -0,0 +1,143 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import, division, unicode_literals
+
+import os
+import time
+from collections import OrderedDict
+
+from mo_files import File
+from mo_json import value2json
+from mo_logs import Log
+from mo_times import Date
+
+try:
+    cpu_time = time.process_time
+except AttributeError:
+    cpu_time = time.clock  # PYTHON2
+
+MAX_BYTES = 10 * 1000 * 1000  # ROLL THE JSON-LINES FILE AT THIS SIZE
+PREFIX = "balancer_"  # PROMETHEUS METRIC NAME PREFIX
+
+
+class CycleMetrics(object):
+    """
+    WALL AND CPU TIME OF EACH PHASE OF A BALANCING CYCLE, WITH COUNTERS
+
+    A PHASE LASTS UNTIL THE NEXT phase() OR finish(), SO THE PHASES OF
+    assign_shards ARE MARKED WITH ONE LINE EACH. count() ADDS TO THE
+    CURRENT PHASE, AND TO THE CYCLE TOTAL
+
+    AFTER EACH CYCLE, THE METRICS ARE APPENDED TO A JSON-LINES filename
+    (ROLLED TO filename.1 AT max_bytes) AND/OR WRITTEN TO A PROMETHEUS
+    TEXT FILE (FOR THE node_exporter textfile COLLECTOR)
+    """
+
+    def __init__(self, filename=None, max_bytes=MAX_BYTES, prometheus=None):
+        self.file = File(filename) if filename else None
+        self.max_bytes = max_bytes or MAX_BYTES
+        self.prometheus = File(prometheus) if prometheus else None
+        self.cycles = 0
+        self.start()
+
+    def start(self):
+        """
+        BEGIN A NEW CYCLE
+        """
+        self.time = Date.now().unix
+        self.phases = OrderedDict()  # MAP FROM PHASE NAME TO {"wall", "cpu", COUNTERS...}
+        self.counters = {}
+        self.current = None
+        self.started = None
+
+    def phase(self, name):
+        """
+        END THE CURRENT PHASE, AND START name
+        """
+        self._stop()
+        self.current = self.phases.setdefault(name, {"wall": 0, "cpu": 0})
+        self.started = (time.time(), cpu_time())
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+        if self.current is not None:
+            self.current[name] = self.current.get(name, 0) + amount
+
+    def finish(self):
+        """
+        END THE CYCLE, AND WRITE THE METRICS
+        :return: THE CYCLE SUMMARY
+        """
+        self._stop()
+        self.current = None
+        self.cycles += 1
+        summary = OrderedDict([
+            ("time", self.time),
+            ("wall", sum(p["wall"] for p in self.phases.values())),
+            ("cpu", sum(p["cpu"] for p in self.phases.values())),
+            ("counters", self.counters),
+            ("phases", self.phases)
+        ])
+        try:
+            if self.file is not None:
+                self._write_jsonl(summary)
+            if self.prometheus is not None:
+                self._write_prometheus(summary)
+        except Exception as e:
+            Log.warning("Can not write cycle metrics", cause=e)
+        return summary
+
+    def _stop(self):
+        if self.current is None:
+            return
+        wall, cpu = self.started
+        self.current["wall"] += time.time() - wall
+        self.current["cpu"] += cpu_time() - cpu
+
+    def _write_jsonl(self, summary):
+        if self.file.exists and len(self.file) > self.max_bytes:
+            os.rename(self.file.abspath, self.file.abspath + ".1")
+        self.file.append(value2json(summary))
+
+    def _write_prometheus(self, summary):
+        lines = []
+
+        def gauge(name, help, samples):
+            lines.append("# HELP " + PREFIX + name + " " + help)
+            lines.append("# TYPE " + PREFIX + name + " gauge")
+            for labels, value in samples:
+                lines.append(PREFIX + name + labels + " " + _number(value))
+
+        lines.append("# HELP " + PREFIX + "cycles_total Balancing cycles completed")
+        lines.append("# TYPE " + PREFIX + "cycles_total counter")
+        lines.append(PREFIX + "cycles_total " + _number(self.cycles))
+        gauge("cycle_timestamp_seconds", "Start of the last cycle", [("", summary["time"])])
+        gauge("cycle_wall_seconds", "Wall time of the last cycle", [("", summary["wall"])])
+        gauge("cycle_cpu_seconds", "CPU time of the last cycle", [("", summary["cpu"])])
+        for name, value in sorted(summary["counters"].items()):
+            gauge("cycle_" + name, "Total " + name + " in the last cycle", [("", value)])
+
+        phases = summary["phases"]
+        measures = sorted(set(m for p in phases.values() for m in p))
+        for m in measures:
+            if m in ("wall", "cpu"):
+                metric, help = "phase_" + m + "_seconds", m.capitalize() + " time of each phase in the last cycle"
+            else:
+                metric, help = "phase_" + m, m.capitalize() + " of each phase in the last cycle"
+            gauge(metric, help, [
+                ('{phase="' + name + '"}', p[m])
+                for name, p in phases.items()
+                if m in p
+            ])
+
+        temp = File(self.prometheus.abspath + ".tmp")
+        temp.write("\n".join(lines) + "\n")
+        os.rename(temp.abspath, self.prometheus.abspath)  # SO THE COLLECTOR NEVER SEES A PARTIAL FILE
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
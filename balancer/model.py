@@ -0,0 +1,163 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import, division, unicode_literals
+
+from mo_dots import Null
+from mo_logs import Log
+
+# THE CLUSTER MODEL, BUILT EVERY CYCLE
+#
+# THESE ARE PLAIN __slots__ CLASSES, NOT Data: THERE ARE MILLIONS OF
+# ATTRIBUTE LOOKUPS PER CYCLE.  A MISSING NODE OR ZONE IS STILL Null, SO
+# CHAINS LIKE shard.node.zone.name WORK FOR UNASSIGNED SHARDS
+
+
+class Zone(object):
+    __slots__ = ["name", "risky", "busy", "shards", "ingress", "egress", "num_nodes", "memory"]
+
+    def __init__(self, name, risky=False, busy=False, shards=None, ingress=None, egress=None):
+        self.name = name
+        self.risky = risky
+        self.busy = busy
+        self.shards = shards
+        self.ingress = ingress  # BYTES/SECOND, FOR THE RecoveryScheduler
+        self.egress = egress
+        self.num_nodes = 0
+        self.memory = 0
+
+    @classmethod
+    def from_settings(cls, z):
+        return cls(z.name, bool(z.risky), bool(z.busy), z.shards, _value(z.ingress), _value(z.egress))
+
+
+class Node(object):
+    __slots__ = ["name", "ip", "roles", "zone", "memory", "disk", "disk_free", "started", "siblings", "ingress", "egress"]
+
+    def __init__(self, name, ip, roles, zone, memory, disk, disk_free, started=None):
+        self.name = name
+        self.ip = ip
+        self.roles = roles
+        self.zone = zone  # Zone, OR Null
+        self.memory = memory
+        self.disk = disk
+        self.disk_free = disk_free
+        self.started = started  # UNIX TIME THE NODE STARTED
+        self.siblings = 0  # NUMBER OF DATA NODES IN THE ZONE
+        self.ingress = None  # BYTES/SECOND, FOR THE RecoveryScheduler
+        self.egress = None
+
+    def override(self, settings):
+        """
+        SET THE PROPERTIES GIVEN IN settings.nodes
+        """
+        for k, v in settings.items():
+            if k == "name":
+                continue
+            if k not in Node.__slots__:
+                Log.warning("Unknown node property {{name|quote}} for {{node}}", name=k, node=self.name)
+                continue
+            setattr(self, k, _value(v))
+
+
+class Shard(object):
+    __slots__ = ["index", "i", "type", "status", "num", "size", "ip", "node", "index_size", "siblings", "allocate"]
+
+    def __init__(self, index, i, type, status, num, size, ip, node):
+        self.index = index
+        self.i = i
+        self.type = type
+        self.status = status
+        self.num = num
+        self.size = size
+        self.ip = ip
+        self.node = node  # Node, OR Null IF UNASSIGNED
+        self.index_size = 0
+        self.siblings = 0  # NUMBER OF PRIMARIES IN THE INDEX
+        self.allocate = Null  # THE Allocation THIS SHARD IS IN
+
+    def copy(self):
+        output = Shard(self.index, self.i, self.type, self.status, self.num, self.size, self.ip, self.node)
+        output.index_size = self.index_size
+        output.siblings = self.siblings
+        output.allocate = self.allocate
+        return output
+
+
+class Allocation(object):
+    """
+    THE SHARDS OF ONE INDEX ON ONE NODE, AND HOW MANY THERE SHOULD BE
+    """
+    __slots__ = ["index", "node", "min_allowed", "max_allowed", "shards"]
+
+    def __init__(self, index, node, min_allowed, max_allowed):
+        self.index = index
+        self.node = node
+        self.min_allowed = min_allowed
+        self.max_allowed = max_allowed
+        self.shards = []
+
+
+class NamedIndex(object):
+    """
+    Zone OR Node BY name, IN INSERTION ORDER; Null FOR UNKNOWN NAMES
+    """
+
+    def __init__(self, values=None):
+        self._data = {}
+        self._order = []
+        for v in values or []:
+            self.add(v)
+
+    def add(self, value):
+        if value.name in self._data:
+            Log.error("{{name|quote}} already added", name=value.name)
+        self._data[value.name] = value
+        self._order.append(value)
+
+    def __getitem__(self, name):
+        return self._data.get(name, Null)
+
+    def __contains__(self, name):
+        return name in self._data
+
+    def __iter__(self):
+        return iter(self._order)
+
+    def __len__(self):
+        return len(self._order)
+
+
+class Allocations(object):
+    """
+    Allocation BY (index, node name); Null FOR UNKNOWN PAIRS
+    """
+
+    def __init__(self):
+        self._data = {}
+
+    def add(self, alloc):
+        """
+        ADD, OR REPLACE, alloc
+        """
+        self._data[(alloc.index, alloc.node.name)] = alloc
+
+    def remove(self, alloc):
+        self._data.pop((alloc.index, alloc.node.name), None)
+
+    def __getitem__(self, key):
+        return self._data.get(key, Null)
+
+    def __iter__(self):
+        return iter(self._data.values())
+
+    def __len__(self):
+        return len(self._data)
+
+
+def _value(v):
+    # SETTINGS ARE Data; MISSING VALUES ARE Null, WHICH WE STORE AS None
+    return None if v == None else v
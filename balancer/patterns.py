@@ -0,0 +1,104 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import, division, unicode_literals
+
+from mo_dots import Null
+
+
+class IndexPatterns(object):
+    """
+    MATCH INDEX NAMES AGAINST A LIST OF PATTERNS: AN INDEX NAME, OR A PREFIX
+    ENDING WITH "*"
+
+    THE PATTERNS ARE COMPILED INTO A MAP OF NAMES, AND A MAP OF PREFIXES,
+    SO A MATCH LOOKS UP ONE PREFIX PER DISTINCT PREFIX LENGTH, NOT EVERY
+    PATTERN. THE RESULT FOR EACH INDEX NAME IS CACHED, UNTIL prune() IS
+    TOLD THE INDEX IS GONE
+    """
+
+    def __init__(self, patterns):
+        self.num_patterns = len(patterns)
+        self.names = {}  # MAP FROM NAME TO PATTERN POSITIONS
+        self.prefixes = {}  # MAP FROM PREFIX TO PATTERN POSITIONS
+        for i, p in enumerate(patterns):
+            if p.endswith("*"):
+                self.prefixes.setdefault(p[:-1], []).append(i)
+            else:
+                self.names.setdefault(p, []).append(i)
+        self.lengths = sorted(set(len(p) for p in self.prefixes))
+        self.cache = {}  # MAP FROM INDEX NAME TO MATCHING POSITIONS
+
+    def matches(self, index):
+        """
+        :return: TUPLE OF THE POSITIONS OF THE PATTERNS MATCHING index, IN ORDER
+        """
+        found = self.cache.get(index)
+        if found is None:
+            found = list(self.names.get(index, ()))
+            for n in self.lengths:
+                if n > len(index):
+                    break
+                found.extend(self.prefixes.get(index[:n], ()))
+            found = self.cache[index] = tuple(sorted(found))
+        return found
+
+    def prune(self, indexes):
+        """
+        FORGET THE CACHED MATCHES OF INDEXES NOT IN indexes (A set OF THE CURRENT INDEX NAMES)
+        """
+        _prune(self.cache, indexes)
+
+    def first(self, index):
+        """
+        :return: POSITION OF THE FIRST PATTERN MATCHING index, OR THE NUMBER OF PATTERNS IF NONE
+        """
+        found = self.matches(index)
+        return found[0] if found else self.num_patterns
+
+
+class IndexRules(object):
+    """
+    settings.allocate AND settings.replication_priority, COMPILED
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.allocate = list(settings.allocate)
+        self.allocate_patterns = IndexPatterns([r.name for r in self.allocate])
+        self.priority_patterns = IndexPatterns(list(settings.replication_priority))
+        self.overrides = {}  # MAP FROM INDEX NAME TO (MAP FROM ZONE NAME TO FIRST MATCHING RULE)
+
+    def override(self, index, zone_name):
+        """
+        :return: THE FIRST settings.allocate RULE FOR index IN zone_name, OR Null
+        """
+        by_zone = self.overrides.get(index)
+        if by_zone is None:
+            by_zone = self.overrides[index] = {}
+            for i in self.allocate_patterns.matches(index):
+                rule = self.allocate[i]
+                by_zone.setdefault(rule.zone, rule)
+        return by_zone.get(zone_name, Null)
+
+    def prune(self, indexes):
+        """
+        FORGET EVERYTHING CACHED FOR INDEXES NOT IN indexes (A set OF THE CURRENT INDEX NAMES)
+        """
+        _prune(self.overrides, indexes)
+        self.allocate_patterns.prune(indexes)
+        self.priority_patterns.prune(indexes)
+
+    def replication_priority(self, index):
+        """
+        :return: POSITION OF index IN settings.replication_priority (LOWER IS MORE IMPORTANT)
+        """
+        return self.priority_patterns.first(index)
+
+
+def _prune(cache, indexes):
+    for index in [i for i in cache if i not in indexes]:
+        del cache[index]
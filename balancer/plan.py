@@ -0,0 +1,74 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import, division, unicode_literals
+
+from mo_dots import coalesce
+from mo_files import File
+from mo_json import value2json
+from mo_logs import Log
+
+DEFAULT_RATE = 40 * 1024 * 1024  # BYTES/SECOND, THE ES DEFAULT indices.recovery.max_bytes_per_sec
+BILLION = 1024 * 1024 * 1024
+
+
+class MovePlan(object):
+    """
+    THE MOVES PLANNED BY ONE CYCLE, IN THE ORDER THEY ARE SENT
+    """
+
+    def __init__(self):
+        self.moves = []
+
+    def add(self, move, mode, source_node, destination_node):
+        shard = move.shard
+        self.moves.append({
+            "mode": mode,
+            "index": shard.index,
+            "shard": shard.i,
+            "type": shard.type,
+            "reason": move.reason,
+            "mode_priority": move.mode_priority,
+            "bytes": shard.size,
+            "from": source_node,
+            "to": destination_node
+        })
+
+    def estimate(self, scheduler):
+        """
+        :param scheduler: RecoveryScheduler, FOR THE RECOVERY RATE OF EACH NODE
+        :return: {"moves", "bytes", "seconds"}, WHERE seconds IS THE TIME THE
+                 BUSIEST NODE NEEDS TO SEND, OR RECEIVE, ITS SHARDS
+        """
+        inbound, outbound = {}, {}
+        for m in self.moves:
+            if m["from"]:
+                outbound[m["from"]] = outbound.get(m["from"], 0) + m["bytes"]
+            inbound[m["to"]] = inbound.get(m["to"], 0) + m["bytes"]
+
+        seconds = 0
+        for direction, totals in (("ingress", inbound), ("egress", outbound)):
+            for node_name, total in totals.items():
+                rate = coalesce(scheduler.rate(node_name, direction), DEFAULT_RATE)
+                seconds = max(seconds, total / rate)
+        return {
+            "moves": len(self.moves),
+            "bytes": sum(m["bytes"] for m in self.moves),
+            "seconds": seconds
+        }
+
+    def write(self, filename, scheduler):
+        estimate = self.estimate(scheduler)
+        Log.note(
+            "Plan: {{moves}} moves, {{gb|round(decimal=1)}}G, done in about {{seconds|round(decimal=0)}} seconds",
+            moves=estimate["moves"],
+            gb=estimate["bytes"] / BILLION,
+            seconds=estimate["seconds"]
+        )
+        if filename:
+            plan_file = File(filename)
+            plan_file.write(value2json({"estimate": estimate, "moves": self.moves}, pretty=True))
+            Log.note("Plan written to {{filename}}", filename=plan_file.abspath)
@@ -0,0 +1,148 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import, division, unicode_literals
+
+from heapq import heapify, heappop, heappush
+from itertools import groupby
+
+from mo_math.randoms import Random
+
+BALANCE_REASONS = {"not balanced", "slightly better balance"}
+INFINITY = float("inf")
+
+
+def random_plan(moves, destinations):
+    """
+    THE ORIGINAL PLANNER: EACH move, IN ORDER, GOES TO A NODE SAMPLED BY WEIGHT
+
+    :param moves: ALLOCATION REQUESTS, IN PRIORITY ORDER
+    :param destinations: FUNCTION(move) RETURNING (source_node, list_nodes, list_node_weight), OR None
+    :return: GENERATOR OF (move, source_node, destination_node)
+    """
+    for move in moves:
+        found = destinations(move)
+        if not found:
+            continue
+        source_node, list_nodes, list_node_weight = found
+        i = Random.weight(list_node_weight)
+        yield move, source_node, list_nodes[i].name
+
+
+class GlobalPlanner(object):
+    """
+    LOOK AT ALL MOVES OF A PRIORITY TOGETHER, AND ASSIGN THE MOVE WITH THE
+    MOST TO LOSE FIRST
+
+    EVERY DESTINATION HAS A COST: THE INDEX LOAD (SHARDS OF THE INDEX,
+    RELATIVE TO max_allowed) PLUS THE DISK FILL, BOTH AFTER THE MOVE, AND
+    INCLUDING THE MOVES ALREADY PLANNED THIS CYCLE. THE REGRET OF A MOVE IS
+    THE COST OF ITS SECOND-BEST DESTINATION MINUS ITS BEST.  MOVES WITH A
+    SINGLE GOOD DESTINATION ARE PLANNED BEFORE MOVES THAT CAN GO ANYWHERE,
+    SO THEY DO NOT LOSE THAT DESTINATION, AND THE SHARDS ARE SPREAD IN ONE
+    CYCLE INSTEAD OF CORRECTED BY THE BALANCE PASSES IN LATER CYCLES.
+
+    REGRETS ARE RECALCULATED LAZILY: A MOVE IS ONLY PLANNED WHEN ITS REGRET
+    IS CURRENT, AND STILL THE BIGGEST.  BALANCE MOVES THAT DO NOT MAKE THE
+    INDEX MORE EVEN ARE DROPPED.
+    """
+
+    def __init__(self, allocation):
+        self.allocation = allocation
+        self.planned_shards = {}  # MAP FROM (index, node name) TO CHANGE IN NUMBER OF SHARDS
+        self.planned_bytes = {}  # MAP FROM node name TO BYTES ARRIVING
+
+    def plan(self, moves, destinations):
+        """
+        :param moves: ALLOCATION REQUESTS, IN PRIORITY ORDER
+        :param destinations: FUNCTION(move) RETURNING (source_node, list_nodes, list_node_weight), OR None
+        :return: GENERATOR OF (move, source_node, destination_node)
+        """
+        for _, tier in groupby(moves, key=lambda m: (m.mode_priority, m.replication_priority)):
+            step = 0  # NUMBER OF MOVES PLANNED IN THIS TIER
+            heap = [(-INFINITY, order, -1, move, None) for order, move in enumerate(tier)]
+            heapify(heap)
+            while heap:
+                _, order, evaluated, move, choice = heappop(heap)
+                if evaluated != step:
+                    # THE REGRET IS STALE, RECALCULATE IT
+                    found = self._best(move, destinations)
+                    if found:
+                        regret, source_node, destination_node = found
+                        heappush(heap, (-regret, order, step, move, (source_node, destination_node)))
+                    continue
+
+                # REGRET IS CURRENT, AND NO OTHER KNOWN REGRET IS BIGGER
+                source_node, destination_node = choice
+                self.reserve(move.shard, destination_node)
+                step += 1
+                yield move, source_node, destination_node
+
+    def _best(self, move, destinations):
+        """
+        :return: (regret, source_node, destination_node) OR None IF NO DESTINATION IS GOOD
+        """
+        found = destinations(move)
+        if not found:
+            return None
+        source_node, list_nodes, list_node_weight = found
+        shard = move.shard
+
+        costs = []
+        for n, weight in zip(list_nodes, list_node_weight):
+            if weight <= 0:
+                continue
+            if move.reason in BALANCE_REASONS and not self._improves(shard, source_node, n.name):
+                continue
+            cost = self._cost(move, n)
+            if cost is not None:
+                costs.append((cost, n.name))
+        if not costs:
+            return None
+        costs.sort()
+        regret = costs[1][0] - costs[0][0] if len(costs) > 1 else INFINITY
+        return regret, source_node, costs[0][1]
+
+    def _count(self, index, node_name):
+        return len(self.allocation[index, node_name].shards) + self.planned_shards.get((index, node_name), 0)
+
+    def _cost(self, move, node):
+        """
+        :return: COST OF PUTTING THE SHARD ON node, OR None IF THE PLANNED MOVES FILLED IT
+        """
+        shard = move.shard
+        alloc = self.allocation[shard.index, node.name]
+        index_load = float(self._count(shard.index, node.name) + 1) / float(alloc.max_allowed or 1)
+        if not node.disk:
+            return index_load
+        disk_free = node.disk_free - self.planned_bytes.get(node.name, 0) - shard.size
+        if float(disk_free) / float(node.disk) < (0.05 if move.reason == "not started" else 0.10):
+            return None
+        return index_load + 1 - float(disk_free) / float(node.disk)
+
+    def _improves(self, shard, source_node, destination_node):
+        """
+        :return: True IF MOVING shard MAKES THE INDEX MORE EVEN
+        """
+        source_count = self._count(shard.index, source_node)
+        destination_count = self._count(shard.index, destination_node)
+        if source_count > self.allocation[shard.index, source_node].max_allowed:
+            return destination_count < self.allocation[shard.index, destination_node].max_allowed
+        return destination_count + 1 < source_count
+
+    def reserve(self, shard, destination_node, accepted=True):
+        """
+        COUNT shard ON destination_node, AND OFF ITS NODE, FOR THE REST OF THE PLAN
+        :param accepted: False TO UNDO THE RESERVATION OF A REJECTED MOVE
+        """
+        change = 1 if accepted else -1
+        key = (shard.index, destination_node)
+        self.planned_shards[key] = self.planned_shards.get(key, 0) + change
+        self.planned_bytes[destination_node] = self.planned_bytes.get(destination_node, 0) + change * shard.size
+        if shard.node.name:
+            # A COPY IS LEAVING THE SOURCE
+            key = (shard.index, shard.node.name)
+            self.planned_shards[key] = self.planned_shards.get(key, 0) - change
@@ -0,0 +1,79 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import, division, unicode_literals
+
+from mo_dots import coalesce
+
+URGENT_PRIORITY = 2  # MOVES OF THIS mode_PRIORITY, OR MORE URGENT ("not started", "high risk shards"), CAN PREEMPT
+VICTIM_PRIORITY = 5  # RECOVERIES OF THIS mode_priority, OR LESS URGENT, CAN BE CANCELLED
+MAX_PROGRESS = 0.5  # RECOVERIES THAT COPIED MORE THAN THIS FRACTION ARE LEFT TO FINISH
+MAX_CANCELS = 10  # PER CYCLE
+
+
+class Preemption(object):
+    """
+    CANCEL LOW-PRIORITY RECOVERIES WHEN AN URGENT MOVE IS BLOCKED ONLY BY
+    THE RECOVERY BUDGET OF A NODE
+
+    WHILE PLANNING, blocked() IS TOLD WHICH NODE (AND DIRECTION) STOPPED AN
+    URGENT MOVE. AFTER, victims() PICKS, FOR EACH SUCH NODE, THE LEAST URGENT
+    RECOVERY USING THAT BUDGET, LEAST COPIED FIRST. THE PRIORITY OF A
+    RECOVERY IS THE mode_priority OF THE MOVE THAT STARTED IT (FROM THE
+    MoveHistory); RECOVERIES ES STARTED ON ITS OWN, AND THE MOVE OF A
+    PRIMARY WITH NO OTHER STARTED COPY, ARE NEVER CANCELLED
+    """
+
+    def __init__(self, settings):
+        self.urgent = coalesce(settings.urgent_priority, URGENT_PRIORITY)
+        self.victim = coalesce(settings.victim_priority, VICTIM_PRIORITY)
+        self.max_progress = coalesce(settings.max_progress, MAX_PROGRESS)
+        self.max_cancels = coalesce(settings.max_cancels, MAX_CANCELS)
+        self.enabled = settings.enabled is not False
+        self.needs = {}  # MAP FROM (node name, direction) TO THE MOST URGENT mode_priority BLOCKED THERE
+
+    def is_urgent(self, move):
+        return self.enabled and move.mode_priority <= self.urgent
+
+    def blocked(self, node_name, direction, move):
+        """
+        THE URGENT move CAN NOT GO BECAUSE node_name HAS NO direction ("ingress" OR "egress") BUDGET LEFT
+        """
+        key = node_name, direction
+        self.needs[key] = min(self.needs.get(key, move.mode_priority), move.mode_priority)
+
+    def victims(self, tracker, history, snapshot):
+        """
+        :param tracker: RecoveryTracker, THE IN-FLIGHT RECOVERIES
+        :param history: MoveHistory, FOR THE PRIORITY OF EACH RECOVERY
+        :param snapshot: ClusterSnapshot, FOR THE OTHER COPIES OF EACH SHARD
+        :return: THE RECOVERIES TO CANCEL, AT MOST ONE PER BLOCKED NODE
+        """
+        chosen = {}  # MAP FROM (index, shard, target_node) TO RECOVERY
+        for (node_name, direction), priority in sorted(self.needs.items(), key=lambda p: p[1]):
+            if len(chosen) >= self.max_cancels:
+                break
+            candidates = []
+            for r in tracker:
+                if (r.target_node if direction == "ingress" else r.source_node) != node_name:
+                    continue
+                key = r.index, r.shard, r.target_node
+                if key in chosen:
+                    continue
+                p = history.priority(r.index, r.shard, r.target_node)
+                if p is None or p < self.victim or p <= priority:
+                    continue
+                progress = r.bytes_recovered / r.bytes_total if r.bytes_total else 0
+                if progress > self.max_progress:
+                    continue
+                if snapshot.is_only_primary(r.index, r.shard, r.source_node, r.target_node):
+                    continue
+                candidates.append((-p, progress, key, r))
+            if candidates:
+                _, _, key, r = min(candidates, key=lambda c: c[:2])
+                chosen[key] = r
+        self.needs = {}
+        return list(chosen.values())
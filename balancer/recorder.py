@@ -0,0 +1,144 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import, division, unicode_literals
+
+import io
+
+from mo_files import File
+from mo_future import urlparse
+from mo_http.big_data import bytes2zip, zip2bytes
+from mo_json import json2value, value2json
+from mo_logs import Log
+from mo_times import Date
+
+MAX_FILES = 100  # RECORDED CYCLES TO KEEP
+MAX_BYTES = 1000 * 1000 * 1000  # TOTAL SIZE OF THE RECORDED CYCLES TO KEEP
+PREFIX = "cycle_"
+SUFFIX = ".json.gz"
+
+
+class Recorder(object):
+    """
+    RECORD THE RESPONSES TO THE GET REQUESTS OF A CYCLE, SO THE CYCLE CAN BE REPLAYED
+
+    HAS THE SAME get/get_json INTERFACE AS mo_http.http, SO IT CAN REPLACE
+    THE http MODULE OF balancer.tables, WHERE ALL THE CLUSTER STATE IS READ
+
+    EACH CYCLE IS ONE GZIPPED JSON FILE IN directory. THE OLDEST FILES ARE
+    DELETED TO KEEP AT MOST max_files, AND AT MOST max_bytes
+    """
+
+    def __init__(self, http, directory, max_files=MAX_FILES, max_bytes=MAX_BYTES):
+        self.http = http
+        self.directory = File(directory)
+        self.max_files = max_files or MAX_FILES
+        self.max_bytes = max_bytes or MAX_BYTES
+        self.requests = []
+
+    def get(self, url, **kwargs):
+        response = self.http.get(url, **kwargs)
+        content = response.content  # READ IT ALL, all_content MAY SPILL BIG RESPONSES TO A FILE
+        self.requests.append({  # list.append IS THREAD SAFE; THE CLUSTER STATE IS FETCHED IN PARALLEL
+            "url": _relative(url),
+            "status": response.status_code,
+            "content": content.decode("utf8") if content else ""
+        })
+        return response
+
+    def get_json(self, url, **kwargs):
+        response = self.get(url, **kwargs)
+        if response.status_code not in (200, 201):
+            Log.error("Bad GET response: {{code}}", code=response.status_code)
+        return json2value(response.all_content.decode("utf8"))
+
+    def cycle_start(self):
+        self.requests = []
+
+    def cycle_end(self):
+        requests, self.requests = self.requests, []
+        if not requests:
+            return
+        try:
+            cycle_file = self.directory / (PREFIX + Date.now().format("%Y%m%d_%H%M%S_%f") + SUFFIX)
+            cycle_file.write_bytes(bytes2zip(value2json({"time": Date.now().unix, "requests": requests}).encode("utf8")))
+            self._rotate()
+        except Exception as e:
+            Log.warning("Can not record cycle", cause=e)
+
+    def _rotate(self):
+        files = sorted(
+            (f for f in self.directory.children if f.filename.endswith(SUFFIX)),
+            key=lambda f: f.filename,
+            reverse=True
+        )
+        total = 0
+        for i, f in enumerate(files):
+            total += len(f)
+            if i >= self.max_files or total > self.max_bytes:
+                f.delete()
+
+
+class Replayer(object):
+    """
+    ANSWER THE GET REQUESTS WITH THE RESPONSES OF A RECORDED CYCLE
+
+    A REQUEST THAT WAS NOT RECORDED IS AN ERROR, EXCEPT THE format=json FORM
+    OF AN ENDPOINT RECORDED AS A TEXT TABLE: IT GETS A 400, SO balancer.tables
+    FALLS BACK TO TEXT, AS IT DID WHEN RECORDED
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with io.open(File(filename).abspath, "rb") as f:
+            recorded = json2value(zip2bytes(f).read().decode("utf8"), leaves=False)
+        self.time = recorded.time
+        self.responses = {r.url: r for r in recorded.requests}
+        Log.note(
+            "Replay {{num}} responses, recorded {{time|datetime}}, from {{filename}}",
+            num=len(self.responses),
+            time=self.time,
+            filename=filename
+        )
+
+    def get(self, url, **kwargs):
+        relative = _relative(url)
+        r = self.responses.get(relative)
+        if r is None:
+            if "format=json" in relative and self._text_recorded(relative):
+                return RecordedResponse(400, b'{"error": "recorded as a text table"}')
+            Log.error("{{url}} was not recorded in {{filename}}", url=relative, filename=self.filename)
+        return RecordedResponse(r.status, r.content.encode("utf8"))
+
+    def _text_recorded(self, relative):
+        path = relative.split("?")[0]
+        return any(u.split("?")[0] == path and "format=json" not in u for u in self.responses)
+
+    def get_json(self, url, **kwargs):
+        response = self.get(url, **kwargs)
+        if response.status_code not in (200, 201):
+            Log.error("Bad GET response: {{code}}", code=response.status_code)
+        return json2value(response.content.decode("utf8"))
+
+
+class RecordedResponse(object):
+    """
+    LOOKS LIKE mo_http.http.HttpResponse
+    """
+
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+
+    @property
+    def all_content(self):
+        return self.content
+
+
+def _relative(url):
+    # THE SAME CYCLE MAY BE REPLAYED WITH ANOTHER elasticsearch.host
+    parsed = urlparse(str(url))
+    return parsed.path + ("?" + parsed.query if parsed.query else "")
@@ -0,0 +1,159 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import, division, unicode_literals
+
+from mo_dots import Data
+from mo_logs import Log
+from mo_times import Date
+
+from balancer import tables
+
+EWMA_WEIGHT = 0.3  # WEIGHT OF THE NEWEST RATE OBSERVATION
+COPY_STAGE = "index"  # THE ONLY RECOVERY STAGE THAT COPIES BYTES
+MIN_WAIT = 5  # SECONDS, SHORTEST TIME BETWEEN CYCLES
+NO_NODE = "n/a"  # THE source_node OF STORE RECOVERIES
+PEER_TYPES = {"peer", "relocation"}  # RECOVERIES THAT COPY FROM ANOTHER NODE; THE BALANCER STARTS NO OTHER KIND
+
+
+class RecoveryTracker(object):
+    """
+    THE IN-FLIGHT RECOVERIES, AS REPORTED BY _cat/recovery
+
+    EACH RECOVERY IS A Data WITH index, shard, type, stage, source_node,
+    target_node, bytes_recovered AND bytes_total. BETWEEN TWO refresh() WE
+    ALSO KNOW delta (BYTES COPIED SINCE THE LAST refresh, None FOR NEW
+    RECOVERIES), rate (EWMA OF BYTES/SECOND), first_seen AND last_progress
+
+    ES 5 AND 6 SHOW A RELOCATION AS A peer RECOVERY, LIKE A NEW REPLICA; IT
+    IS KNOWN TO BE A RELOCATION ONLY BECAUSE _cat/shards SHOWS ITS SOURCE
+    AS RELOCATING, SO THOSE ROWS ARE GIVEN TO set_relocating()
+    """
+
+    def __init__(self, clock=None):
+        self.clock = clock or (lambda: Date.now().unix)  # SECONDS, REPLACEABLE FOR SIMULATION
+        self.recoveries = {}  # MAP FROM (index, shard, target_node) TO RECOVERY
+        self.last_time = None
+        self.elapsed = None  # SECONDS BETWEEN THE LAST TWO refresh()
+        self.moving = {}  # MAP FROM (index, shard, source_node) TO target_node, THE RELOCATING SHARDS IN _cat/shards
+
+    def refresh(self, path):
+        """
+        READ THE ACTIVE RECOVERIES, AND UPDATE THEIR RATES
+        :return: True IF THE RECOVERIES COULD BE READ
+        """
+        now = self.clock()
+        try:
+            rows = tables.get_recovery(path)
+        except Exception as e:
+            Log.warning("Can not read recoveries", cause=e)
+            return False
+
+        elapsed = now - self.last_time if self.last_time is not None and now > self.last_time else None
+        recoveries = {}
+        for index, shard, type_, stage, source_node, target_node, bytes_recovered, bytes_total in rows:
+            key = (index, shard, target_node)
+            r = Data(
+                index=index,
+                shard=shard,
+                type=type_,
+                stage=stage,
+                source_node=None if source_node == NO_NODE else (source_node or None),
+                target_node=target_node,
+                bytes_recovered=bytes_recovered,
+                bytes_total=bytes_total
+            )
+            before = self.recoveries.get(key)
+            if before is None:
+                r.first_seen = now
+                r.last_progress = now
+            else:
+                r.first_seen = before.first_seen
+                r.delta = bytes_recovered - before.bytes_recovered
+                # A QUEUED RECOVERY STARTS ITS STALL TIMER WHEN IT STARTS COPYING
+                r.last_progress = now if r.delta > 0 or before.stage != stage else before.last_progress
+                r.rate = before.rate
+                if elapsed:
+                    rate = r.delta / elapsed
+                    r.rate = rate if before.rate == None else EWMA_WEIGHT * rate + (1 - EWMA_WEIGHT) * before.rate
+            recoveries[key] = r
+
+        self.recoveries = recoveries
+        self.last_time = now
+        self.elapsed = elapsed
+        return True
+
+    def set_relocating(self, moving):
+        """
+        :param moving: THE RELOCATING SHARDS, AS SHOWN BY _cat/shards, EACH WITH index, shard, source_node AND target_node
+        """
+        self.moving = {(m.index, m.shard, m.source_node): m.target_node for m in moving}
+
+    def is_relocation(self, r):
+        """
+        :return: True IF THE RECOVERY r MOVES A STARTED SHARD, SO ITS SOURCE COPY IS DELETED WHEN DONE
+        """
+        return r.type == "relocation" or (r.index, r.shard, r.source_node) in self.moving
+
+    def is_peer(self, r):
+        """
+        :return: True IF THE RECOVERY r COPIES FROM ANOTHER NODE (NOT store, existing_store, snapshot, ...)
+        """
+        return r.type in PEER_TYPES and r.source_node is not None
+
+    def forget(self, recoveries):
+        """
+        REMOVE THE (CANCELLED) recoveries
+        """
+        for r in recoveries:
+            self.recoveries.pop((r.index, r.shard, r.target_node), None)
+
+    def __iter__(self):
+        return iter(self.recoveries.values())
+
+    def __len__(self):
+        return len(self.recoveries)
+
+    def relocations(self):
+        """
+        :return: THE RECOVERIES THAT MOVE A STARTED SHARD TO ANOTHER NODE
+        """
+        return [r for r in self.recoveries.values() if self.is_relocation(r)]
+
+    def target_nodes(self):
+        return set(r.target_node for r in self.recoveries.values())
+
+    def remaining(self, r):
+        return max(0, r.bytes_total - r.bytes_recovered)
+
+    def eta(self, r):
+        """
+        :return: SECONDS UNTIL r IS DONE COPYING, OR None IF THE RATE IS NOT KNOWN
+        """
+        if not r.rate:
+            return None
+        return self.remaining(r) / r.rate
+
+    def stalled(self, timeout):
+        """
+        :param timeout: SECONDS WITHOUT PROGRESS
+        :return: THE RECOVERIES THAT STOPPED COPYING BYTES FOR timeout SECONDS
+        """
+        now = self.last_time
+        return [
+            r
+            for r in self.recoveries.values()
+            if r.stage == COPY_STAGE and now - r.last_progress >= timeout
+        ]
+
+    def next_wait(self, interval):
+        """
+        :return: SECONDS TO WAIT BEFORE THE NEXT CYCLE: interval, OR LESS IF A RECOVERY WILL FINISH SOONER
+        """
+        etas = [e for e in (self.eta(r) for r in self.recoveries.values()) if e is not None]
+        if not etas:
+            return interval
+        return max(MIN_WAIT, min(interval, min(etas)))
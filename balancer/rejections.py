@@ -0,0 +1,150 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import, division, unicode_literals
+
+from mo_dots import coalesce
+from mo_times import Date, Duration
+
+ZONE_FULL = "zone_full"
+DISK = "disk"
+VERSION = "version"
+TOO_MANY_COPIES = "too_many_copies"
+THROTTLED = "throttled"
+OTHER = "other"
+
+RESTART_TOLERANCE = 60  # SECONDS, A NODE WITH A start TIME MOVED THIS MUCH HAS RESTARTED
+
+# FAILURE CLASSES, BY A PHRASE IN THE DECIDER EXPLANATION; FIRST MATCH WINS
+FAILURE_PHRASES = [
+    ("too many shards on nodes for attribute", ZONE_FULL),
+    ("after allocation more than allowed", DISK),
+    ("watermark", DISK),
+    ("target node version", VERSION),
+    ("there are too many copies of the shard", TOO_MANY_COPIES),
+    ("reached the limit of", THROTTLED),
+]
+
+# HOW LONG A REJECTION IS REMEMBERED, BY CLASS; settings.rejections CAN OVERRIDE
+DEFAULT_TTL = {
+    ZONE_FULL: "10minute",
+    DISK: "10minute",
+    VERSION: "hour",
+    TOO_MANY_COPIES: "10minute",
+    THROTTLED: "0second",  # ONLY BUSY NOW, THE SCHEDULER HANDLES THAT
+    OTHER: "2minute",
+}
+
+
+def failure_class(reason):
+    """
+    :param reason: THE MAIN DECIDER REASON OF A REJECTED COMMAND
+    :return: ONE OF THE FAILURE CLASSES
+    """
+    if reason:
+        for phrase, failure in FAILURE_PHRASES:
+            if phrase in reason:
+                return failure
+    return OTHER
+
+
+class RejectionCache(object):
+    """
+    REMEMBER WHICH (index, shard, target node) COMMANDS ES REJECTED, AND WHY,
+    SO THE NEXT CYCLES DO NOT SEND THEM AGAIN
+
+    A REJECTION IS FORGOTTEN AFTER THE ttl OF ITS CLASS, OR SOONER IF THE
+    CLUSTER CHANGED SO IT MAY BE ACCEPTED: THE TARGET NODE RESTARTED (A NEW
+    VERSION, SETTINGS, OR DISK), OR, FOR DISK REJECTIONS, THE NODE FREED
+    AT LEAST THE SIZE OF THE SHARD SINCE IT REJECTED
+
+    A DISK REJECTION IS ABOUT THE NODE, NOT THE SHARD: NO SHARD AS BIG AS
+    THE ONE REJECTED IS SENT TO THAT NODE EITHER
+    """
+
+    def __init__(self, ttl=None, clock=None):
+        self.clock = clock or (lambda: Date.now().unix)  # SECONDS, REPLACEABLE FOR SIMULATION
+        self.ttl = {
+            failure: Duration(coalesce(ttl[failure] if ttl else None, default)).seconds
+            for failure, default in DEFAULT_TTL.items()
+        }
+        self.rejected = {}  # MAP FROM (index, i) TO (MAP FROM node name TO (failure, expires, started, disk_free_to_retry))
+        self.full = {}  # MAP FROM node name TO (size, expires, started, disk_free_to_retry), FOR DISK REJECTIONS
+
+    def add(self, index, i, size, node, reason):
+        """
+        REMEMBER THE REJECTION OF (index, i) ON node
+        :return: THE FAILURE CLASS
+        """
+        failure = failure_class(reason)
+        ttl = self.ttl[failure]
+        if ttl > 0 and node:
+            entry = (failure, self.clock() + ttl, node.started, coalesce(node.disk_free, 0) + size)
+            self.rejected.setdefault((index, i), {})[node.name] = entry
+            if failure == DISK:
+                smallest = self.full.get(node.name)
+                if smallest is None or size < smallest[0]:
+                    self.full[node.name] = (size,) + entry[1:]
+        return failure
+
+    def nodes(self, index, i, size, nodes):
+        """
+        :param nodes: NamedIndex OF THE NODES, AS THEY ARE NOW
+        :return: SET OF NODE NAMES THAT STILL REJECT (index, i), OF size
+        """
+        now = self.clock()
+        output = set()
+        for node_name, (smallest, expires, started, disk_free_to_retry) in list(self.full.items()):
+            if size < smallest:
+                continue
+            node = nodes[node_name]
+            if expires <= now or not node or _restarted(node.started, started) or coalesce(node.disk_free, 0) >= disk_free_to_retry:
+                del self.full[node_name]
+                continue
+            output.add(node_name)
+
+        by_node = self.rejected.get((index, i))
+        if not by_node:
+            return output
+        for node_name, (failure, expires, started, disk_free_to_retry) in list(by_node.items()):
+            node = nodes[node_name]
+            if (
+                expires <= now or
+                not node or
+                _restarted(node.started, started) or
+                (failure == DISK and coalesce(node.disk_free, 0) >= disk_free_to_retry)
+            ):
+                del by_node[node_name]
+                continue
+            output.add(node_name)
+        if not by_node:
+            del self.rejected[(index, i)]
+        return output
+
+    def expire(self):
+        """
+        DROP THE EXPIRED REJECTIONS
+        """
+        now = self.clock()
+        for key, by_node in list(self.rejected.items()):
+            for node_name, entry in list(by_node.items()):
+                if entry[1] <= now:
+                    del by_node[node_name]
+            if not by_node:
+                del self.rejected[key]
+        for node_name, entry in list(self.full.items()):
+            if entry[1] <= now:
+                del self.full[node_name]
+
+    def __len__(self):
+        return sum(len(by_node) for by_node in self.rejected.values())
+
+
+def _restarted(started, before):
+    # started IS CALCULATED FROM TWO jvm STATS, SO IT MOVES A LITTLE EACH CYCLE
+    if started is None or before is None:
+        return started is not before
+    return abs(started - before) > RESTART_TOLERANCE
@@ -0,0 +1,165 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import, division, unicode_literals
+
+from mo_dots import Data, coalesce, wrap
+from mo_future import Mapping, is_text
+from mo_http import http
+from mo_json import json2value, value2json
+from mo_logs import Log, strings
+
+DEBUG = False
+MAX_BATCH = 50  # MAXIMUM NUMBER OF COMMANDS IN ONE _cluster/reroute REQUEST
+
+DRY_RUN = "/_cluster/reroute?dry_run=true&explain=true&filter_path=acknowledged,error,explanations"
+REROUTE = "/_cluster/reroute?filter_path=acknowledged,error"
+
+
+class RerouteBatch(object):
+    """
+    COLLECT _cluster/reroute COMMANDS, AND SEND THEM AS A FEW MULTI-COMMAND REQUESTS
+
+    EVERY reroute MAKES THE MASTER RECOMPUTE, AND PUBLISH, THE CLUSTER STATE.
+    THE COMMANDS ARE FIRST SENT WITH dry_run AND explain TO FIND THE ONES
+    THE DECIDERS REJECT, THEN THE REST ARE SENT FOR REAL. WHEN A WHOLE
+    REQUEST FAILS (ES THROWS ON SOME COMMANDS, EVEN WITH explain) THE BATCH
+    IS SPLIT IN HALF UNTIL THE FAILING COMMAND IS FOUND
+
+    WITH plan_only, NOTHING IS SENT; EVERY COMMAND IS ACCEPTED
+    """
+
+    def __init__(self, path, batch_size=MAX_BATCH, plan_only=False):
+        self.path = path
+        self.batch_size = batch_size or MAX_BATCH
+        self.plan_only = plan_only
+        self.entries = []
+
+    def add(self, command, **kwargs):
+        """
+        :param command: ONE reroute COMMAND, LIKE {"move": {...}}
+        :param kwargs: ANYTHING THE CALLER NEEDS TO MAP THE RESULT BACK
+        :return: THE ENTRY; AFTER flush() IT HAS accepted (boolean), error (TEXT) AND reason (MAIN REASON, OR None)
+        """
+        entry = Data(kwargs)
+        entry.command = command
+        entry.accepted = None
+        entry.error = None
+        entry.reason = None
+        self.entries.append(entry)
+        return entry
+
+    def __len__(self):
+        return len(self.entries)
+
+    def review(self):
+        """
+        dry_run ALL PENDING COMMANDS, MARK THE REJECTED ONES
+        :return: ENTRIES, IN ORDER, WITH accepted AND error SET
+        """
+        entries = [e for e in self.entries if e.accepted == None]
+        for chunk in _chunks(entries, self.batch_size):
+            self._dry_run(chunk)
+        return self.entries
+
+    def submit(self, entries=None):
+        """
+        SEND THE (ACCEPTED) entries FOR REAL
+        :return: THE entries, WITH accepted AND error UPDATED
+        """
+        if entries is None:
+            entries = [e for e in self.entries if e.accepted]
+        for chunk in _chunks(entries, self.batch_size):
+            self._send(chunk)
+        return entries
+
+    def flush(self):
+        """
+        review() AND submit() EVERYTHING
+        :return: ALL ENTRIES, IN ORDER
+        """
+        if self.plan_only:
+            for e in self.entries:
+                e.accepted = True
+        else:
+            self.review()
+            self.submit()
+        entries, self.entries = self.entries, []
+        return entries
+
+    def _dry_run(self, entries):
+        result, code = _post(self.path + DRY_RUN, entries)
+        if code in (200, 201) and result.acknowledged:
+            explanations = result.explanations
+            if len(explanations) != len(entries):
+                Log.error("Expecting one explanation per command")
+            for e, x in zip(entries, explanations):
+                reasons = [d.explanation for d in x.decisions if d.decision == "NO"]
+                if reasons:
+                    _reject(e, "".join("[NO(" + r + ")]" for r in reasons))
+                else:
+                    e.accepted = True
+        elif len(entries) == 1:
+            _reject(entries[0], result.error)
+        else:
+            # SOME COMMAND MAKES THE WHOLE REQUEST FAIL, FIND IT
+            half = len(entries) // 2
+            self._dry_run(entries[:half])
+            self._dry_run(entries[half:])
+
+    def _send(self, entries):
+        result, code = _post(self.path + REROUTE, entries)
+        if code in (200, 201) and result.acknowledged:
+            for e in entries:
+                e.accepted = True
+        elif len(entries) == 1:
+            _reject(entries[0], result.error)
+        else:
+            # CLUSTER CHANGED SINCE THE dry_run, FIND THE COMMAND THAT FAILS
+            half = len(entries) // 2
+            self._send(entries[:half])
+            self._send(entries[half:])
+
+
+def _reject(entry, error):
+    entry.accepted = False
+    entry.error = error_text(error)
+    entry.reason = main_reason(error)
+
+
+def _post(url, entries):
+    response = http.post(url, json={"commands": [e.command for e in entries]})
+    try:
+        result = json2value(response.content.decode('utf8'))
+    except Exception as e:
+        result = wrap({"error": response.content.decode('utf8')})
+    DEBUG and Log.note("{{code}} {{url}} {{num}} commands", code=response.status_code, url=url, num=len(entries))
+    return result, response.status_code
+
+
+def _chunks(values, size):
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def error_text(error):
+    """
+    ES RETURNS THE ERROR AS TEXT, OR AS AN OBJECT; ALWAYS RETURN TEXT
+    """
+    if error == None:
+        return ""
+    if is_text(error):
+        return error
+    return value2json(error)
+
+
+def main_reason(error):
+    """
+    :return: THE FIRST DECIDER REASON IN error, OR None
+    """
+    if isinstance(error, Mapping):
+        return coalesce(error.root_cause[0].reason, error.reason)
+    return strings.between(error, "[NO", "]")
@@ -0,0 +1,169 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import, division, unicode_literals
+
+import sys
+import time
+
+from mo_files import File
+from mo_future import get_ident, text
+from mo_logs import Log
+from mo_threads import Thread
+from mo_threads.profiles import list2tab
+from mo_times import Date
+
+DEFAULT_INTERVAL = 0.01  # SECONDS BETWEEN SAMPLES
+DEFAULT_CYCLES = 3
+DEFAULT_FILENAME = "./results/profile"
+
+
+class SamplingProfiler(object):
+    """
+    SAMPLE THE PYTHON STACKS OF RUNNING THREADS EVERY interval SECONDS
+
+    ONLY THE THREAD THAT CALLS start(), AND THE THREADS STARTED AFTER IT,
+    ARE SAMPLED; THE IDLE BACKGROUND THREADS ARE NOT. EACH SAMPLE IS
+    WEIGHTED BY THE TIME SINCE THE PREVIOUS ONE, SO A LATE SAMPLE (THE GIL
+    WAS HELD) STILL ACCOUNTS FOR THE WHOLE GAP
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        self.interval = interval
+        self.stacks = {}  # MAP FROM TUPLE OF FRAME NAMES (ROOT FIRST) TO SECONDS
+        self.thread = None
+        self.paused = False
+
+    def start(self):
+        ignore = set(sys._current_frames().keys())
+        ignore.discard(get_ident())
+        self.thread = Thread.run("sampling profiler", self._sample, ignore)
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+
+    def stop(self):
+        if self.thread is not None:
+            self.thread.stop()
+            self.thread.join()
+            self.thread = None
+
+    def _sample(self, ignore, please_stop):
+        ignore.add(get_ident())
+        stacks = self.stacks
+        names = {}  # MAP FROM CODE OBJECT TO FRAME NAME
+        last = time.time()
+        while not please_stop:
+            time.sleep(self.interval)
+            now = time.time()
+            elapsed, last = now - last, now
+            if self.paused:
+                continue
+            for ident, frame in sys._current_frames().items():
+                if ident in ignore:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    name = names.get(code)
+                    if name is None:
+                        name = names[code] = _frame_name(code)
+                    stack.append(name)
+                    frame = frame.f_back
+                stack = tuple(reversed(stack))
+                stacks[stack] = stacks.get(stack, 0) + elapsed
+
+    def functions(self):
+        """
+        :return: LIST OF {"method", "file", "line", "self_time", "total_time"}, SLOWEST FIRST
+        """
+        self_time = {}
+        total_time = {}
+        for stack, seconds in self.stacks.items():
+            self_time[stack[-1]] = self_time.get(stack[-1], 0) + seconds
+            for name in set(stack):  # RECURSION COUNTS ONCE
+                total_time[name] = total_time.get(name, 0) + seconds
+        output = []
+        for name, seconds in total_time.items():
+            method, location = name.split(" (", 1)
+            file, line = location[:-1].rsplit(":", 1)
+            output.append({
+                "method": method,
+                "file": file,
+                "line": int(line),
+                "self_time": self_time.get(name, 0),
+                "total_time": seconds
+            })
+        output.sort(key=lambda r: -r["total_time"])
+        return output
+
+    def write(self, filename):
+        """
+        WRITE filename_<timestamp>.tab, PER-FUNCTION TIMES, AND
+        filename_<timestamp>.collapsed, FOR flamegraph.pl OR speedscope
+        """
+        suffix = Date.now().format("_%Y%m%d_%H%M%S")
+        tab = File(filename + suffix + ".tab")
+        tab.write(list2tab(self.functions()))
+        collapsed = File(filename + suffix + ".collapsed")
+        collapsed.write("\n".join(
+            ";".join(stack) + " " + text(int(round(seconds * 1000)))  # MILLISECONDS
+            for stack, seconds in sorted(self.stacks.items())
+        ))
+        Log.note("profile written to {{tab}} and {{collapsed}}", tab=tab.abspath, collapsed=collapsed.abspath)
+
+
+class CycleProfiler(object):
+    """
+    PROFILE THE NEXT cycles BALANCING CYCLES, WHEN ASKED
+
+    WHEN NOT ASKED, NOTHING RUNS; cycle_start() AND cycle_end() ONLY CHECK
+    A NUMBER
+    """
+
+    def __init__(self, interval=None, cycles=None, filename=None):
+        self.interval = interval or DEFAULT_INTERVAL
+        self.cycles = cycles or DEFAULT_CYCLES
+        self.filename = filename or DEFAULT_FILENAME
+        self.remaining = 0  # CYCLES STILL TO PROFILE
+        self.sampler = None
+
+    def request(self, cycles=None):
+        """
+        PROFILE THE NEXT cycles CYCLES; SAFE TO CALL FROM A SIGNAL HANDLER
+        """
+        self.remaining = cycles or self.cycles
+
+    def cycle_start(self):
+        if self.sampler is not None:
+            self.sampler.resume()
+        elif self.remaining:
+            Log.note("Profiling the next {{num}} cycles", num=self.remaining)
+            self.sampler = SamplingProfiler(self.interval)
+            self.sampler.start()
+
+    def cycle_end(self):
+        if self.sampler is None:
+            return
+        self.remaining -= 1
+        if self.remaining > 0:
+            self.sampler.pause()  # DO NOT PROFILE THE WAIT BETWEEN CYCLES
+            return
+        sampler, self.sampler = self.sampler, None
+        sampler.stop()
+        try:
+            sampler.write(self.filename)
+        except Exception as e:
+            Log.warning("Can not write profile", cause=e)
+
+
+def _frame_name(code):
+    # LAST TWO PATH PARTS ARE ENOUGH TO TELL FILES APART (balancer/tables.py, mo_dots/lists.py)
+    path = code.co_filename.replace("\\", "/").split("/")
+    return code.co_name + " (" + "/".join(path[-2:]) + ":" + text(code.co_firstlineno) + ")"
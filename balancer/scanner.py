@@ -0,0 +1,225 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import, division, unicode_literals
+
+import os
+from collections import OrderedDict
+
+import paramiko
+
+import mo_math
+from mo_dots import FlatList, Null, coalesce
+from mo_future import text
+from mo_logs import Log, strings
+from mo_threads import Lock, Queue, Thread, Till
+
+DEFAULT_THREADS = 10  # NODES SCANNED AT ONCE
+DEFAULT_CONNECTIONS = 100  # SSH CONNECTIONS KEPT OPEN
+DEFAULT_TIMEOUT = 30 * 60  # SECONDS, LONGEST A WHOLE SCAN MAY TAKE
+FULL_DRIVE = 98  # PERCENT
+DATA_PATH = "/data*"  # WHERE ES KEEPS THE SHARDS
+
+
+class SshPool(object):
+    """
+    PERSISTENT SSH CONNECTIONS, SO EACH SCAN DOES NOT PAY FOR A NEW LOGIN
+
+    THE connect SETTINGS ARE THE SAME AS FOR Fabric's env (user, key_filename,
+    password, port, disable_known_hosts, banner_timeout). AT MOST
+    max_connections IDLE CONNECTIONS ARE KEPT; THE LEAST RECENTLY USED ARE
+    CLOSED FIRST
+    """
+
+    def __init__(self, connect, max_connections=DEFAULT_CONNECTIONS):
+        self.connect = connect
+        self.max_connections = max_connections
+        self.lock = Lock("ssh pool")
+        self.idle = OrderedDict()  # MAP FROM ip TO SSHClient, LEAST RECENTLY USED FIRST
+
+    def run(self, ip, command):
+        """
+        RUN command, WITH sudo, ON ip
+        :return: GENERATOR OF OUTPUT LINES, AS THEY ARRIVE
+        """
+        client = self._acquire(ip)
+        try:
+            _, stdout, _ = client.exec_command("sudo " + command)
+            for line in stdout:
+                yield line.rstrip("\n")
+        except Exception as e:
+            client.close()
+            client = None
+            Log.error("Problem running {{command|quote}} on {{ip}}", command=command, ip=ip, cause=e)
+        finally:
+            if client is not None:
+                self._release(ip, client)
+
+    def _acquire(self, ip):
+        with self.lock:
+            client = self.idle.pop(ip, None)
+        if client is not None:
+            transport = client.get_transport()
+            if transport and transport.is_active():
+                return client
+            client.close()
+
+        connect = self.connect
+        client = paramiko.SSHClient()
+        if connect.disable_known_hosts:
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        else:
+            client.load_system_host_keys()
+        client.connect(
+            ip,
+            port=coalesce(connect.port, 22),
+            username=connect.user,
+            password=connect.password or None,
+            key_filename=os.path.expanduser(connect.key_filename) if connect.key_filename else None,
+            banner_timeout=connect.banner_timeout
+        )
+        return client
+
+    def _release(self, ip, client):
+        with self.lock:
+            self.idle[ip] = client
+            while len(self.idle) > self.max_connections:
+                _, oldest = self.idle.popitem(last=False)
+                oldest.close()
+
+    def close(self):
+        with self.lock:
+            clients, self.idle = list(self.idle.values()), OrderedDict()
+        for c in clients:
+            c.close()
+
+
+class DirectoryScanner(object):
+    """
+    FIND THE SHARD DIRECTORIES OF MANY NODES AT ONCE
+    """
+
+    def __init__(self, pool, uuid_to_index_name, ip_of, threads=DEFAULT_THREADS, inventory=None, digest_of=None, timeout=DEFAULT_TIMEOUT):
+        """
+        :param pool: SshPool
+        :param uuid_to_index_name: MAP FROM INDEX uuid (THE DIRECTORY NAME) TO INDEX NAME
+        :param ip_of: FUNCTION(node) RETURNING THE IP TO CONNECT TO, OR None TO SKIP THE NODE
+        :param threads: NUMBER OF NODES SCANNED AT ONCE
+        :param inventory: OPTIONAL DirectoryInventory, TO SKIP NODES SCANNED RECENTLY
+        :param digest_of: FUNCTION(node) RETURNING THE shard_digest OF THE NODE, REQUIRED WITH inventory
+        :param timeout: SECONDS TO WAIT FOR THE WHOLE SCAN; THE NODES NOT SCANNED BY THEN ARE NOT RETURNED
+        """
+        self.pool = pool
+        self.uuid_to_index_name = uuid_to_index_name
+        self.ip_of = ip_of
+        self.threads = threads
+        self.inventory = inventory
+        self.digest_of = digest_of
+        self.timeout = timeout
+
+    def scan(self, nodes):
+        """
+        :return: GENERATOR OF (node, directories) PAIRS, IN THE ORDER THE SCANS
+                 FINISH, SO THE CALLER CAN ACT ON THE FIRST NODES WHILE THE
+                 OTHERS ARE STILL SCANNED. NODES ARE STARTED IN THE GIVEN ORDER
+        """
+        nodes = list(nodes)
+        if not nodes:
+            return
+        todo = Queue("nodes to scan", max=len(nodes))
+        todo.extend(nodes)
+        done = Queue("scanned nodes", max=len(nodes))
+
+        def worker(please_stop):
+            while not please_stop:
+                node = todo.pop_one()
+                if node is None:
+                    break
+                try:
+                    directories = self.node_directories(node)
+                except Exception as e:
+                    # EVERY NODE MUST BE ANSWERED, OR THE CALLER WAITS FOR IT
+                    Log.warning("Can not scan {{node}}", node=node.name, cause=e)
+                    directories = Null
+                done.add((node, directories))
+
+        workers = [
+            Thread.run("scan directories " + text(i), worker)
+            for i in range(min(self.threads, len(nodes)))
+        ]
+        till = Till(seconds=self.timeout)
+        try:
+            for i, _ in enumerate(nodes):
+                found = done.pop(till=till)
+                if found is None:
+                    Log.warning("Directory scan timed out, {{num}} nodes not scanned", num=len(nodes) - i)
+                    return
+                yield found
+        finally:
+            for w in workers:
+                w.stop()
+
+    def node_directories(self, node):
+        """
+        :return: LIST OF SHARDS AND THEIR DIRECTORIES, OR Null IF THE NODE CAN NOT BE SCANNED
+        """
+        digest = None
+        if self.inventory:
+            digest = self.digest_of(node)
+            cached = self.inventory.get(node, DATA_PATH, digest)
+            if cached is not None:
+                return cached
+
+        ip = self.ip_of(node)
+        if not ip:
+            return Null
+        try:
+            # CATCH THE OUT-OF-CONTROL LOGGING THAT FILLS DRIVES (AND OTHER NASTINESS)
+            for line in self.pool.run(ip, "df -h"):
+                fullness = strings.between(line, " ", "%")
+                if mo_math.is_integer(fullness) and int(fullness) >= FULL_DRIVE:
+                    Log.warning("Drive at {{ip}} has full drive {{drive|quote}}", ip=ip, drive=line)
+
+            output = FlatList()
+            for line in self.pool.run(ip, "find " + DATA_PATH + " -type d"):
+                d = parse_directory(line, self.uuid_to_index_name, ip)
+                if d:
+                    output.append(d)
+        except Exception as e:
+            Log.warning("Can not get directories from {{node}}!", node=node.name, cause=e)
+            return Null
+
+        if self.inventory:
+            self.inventory.set(node, DATA_PATH, digest, output)
+        return output
+
+
+def parse_directory(line, uuid_to_index_name, ip):
+    """
+    :param line: ONE LINE OF `find /data* -type d`
+    :return: {"index", "i", "dir"} IF line IS A SHARD DIRECTORY, OTHERWISE None
+    """
+    # /data1/active-data/nodes/0/indices/jobs20161001_000000
+    # /data1/active-data/nodes/0/indices/jobs20161001_000000/11
+    # /data1/active-data/nodes/0/indices/jobs20161001_000000/11/_state
+    # /data1/active-data/nodes/0/indices/jobs20161001_000000/11/translog
+    # /data1/active-data/nodes/0/indices/jobs20161001_000000/11/index
+    dir_ = line.strip()
+    if dir_.endswith("No such file or directory"):
+        return None
+    path = dir_.split("/")
+    if len(path) != 7:
+        return None
+    index = uuid_to_index_name.get(path[5])
+    if not index:
+        Log.warning("not expected dir={{dir}} for machine {{ip}}", dir=dir_, ip=ip)
+        return None  # SOMETIMES THERE ARE JUNK DIRECTORIES
+    if path[6] == "_state":
+        return None  # SOMETIMES THERE ARE _state DIRECTORIES
+    try:
+        return {"index": index, "i": int(path[6]), "dir": dir_}
+    except Exception as e:
+        Log.error("not expected dir={{dir}} for machine {{ip}}", cause=e, dir=dir_, ip=ip)
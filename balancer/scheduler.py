@@ -0,0 +1,175 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import, division, unicode_literals
+
+from mo_dots import coalesce
+from mo_future import is_text
+from mo_logs import Log
+from mo_times import Duration
+
+from balancer import tables
+
+DEBUG = False
+BILLION = 1024 * 1024 * 1024
+BIG_SHARD_SIZE = 2 * BILLION  # DEFAULT BUDGET, PER NODE, PER DIRECTION: SAME AS THE OLD THROTTLE
+DEFAULT_WINDOW = "2minute"  # A BUDGET IS THE BYTES THAT CAN BE RECOVERED IN THIS TIME
+EWMA_WEIGHT = 0.3  # WEIGHT OF THE NEWEST THROUGHPUT OBSERVATION
+
+
+class RecoveryScheduler(object):
+    """
+    ADMIT MOVES ONLY WHEN THE SOURCE HAS EGRESS BUDGET, AND THE DESTINATION
+    HAS INGRESS BUDGET, BOTH FOR THE NODE AND FOR ITS ZONE
+
+    A BUDGET IS THE BYTES THAT CAN BE IN FLIGHT: THE RATE (BYTES/SECOND) TIMES
+    THE window.  RATES ARE CONFIGURED WITH ingress/egress ON THE node (IN
+    settings.nodes) OR ZONE (IN settings.zones), OR settings.recovery.ingress
+    AND settings.recovery.egress FOR ALL NODES.  WITHOUT A RATE, A NODE GETS
+    THE OLD BIG_SHARD_SIZE BUDGET.
+
+    THE THROUGHPUT OF EACH NODE IS MEASURED WITH THE RecoveryTracker. A NODE THAT
+    WAS RECOVERING FOR THE WHOLE TIME BETWEEN TWO CYCLES IS SATURATED, SO ITS
+    THROUGHPUT IS ITS REAL RATE; THE BUDGET USES THE LOWER OF THE CONFIGURED
+    AND THE MEASURED RATE.  NODES THAT MADE NO PROGRESS ARE NOT MEASURED: THEIR
+    RECOVERIES ARE QUEUED BY ES, NOT LIMITED BY BANDWIDTH.
+
+    THE BUDGETS ARE MULTIPLIED BY move.concurrent, SO URGENT MOVES CAN STILL
+    USE MORE OF THE NETWORK
+    """
+
+    def __init__(self):
+        self.measured = {"ingress": {}, "egress": {}}  # MAP FROM node name TO EWMA OF BYTES/SECOND
+        self.settings = None
+        self.inbound = {}  # MAP FROM node name TO BYTES IN FLIGHT
+        self.outbound = {}
+        self.zone_inbound = {}  # MAP FROM zone name TO BYTES IN FLIGHT
+        self.zone_outbound = {}
+        self.nodes = None
+        self.window = Duration(DEFAULT_WINDOW).seconds
+
+    def start(self, settings, nodes, relocating, snapshot):
+        """
+        RESET THE BYTES IN FLIGHT TO WHAT IS RECOVERING NOW
+        """
+        self.settings = settings.recovery
+        self.nodes = nodes
+        self.window = Duration(coalesce(self.settings.window, DEFAULT_WINDOW)).seconds
+        self.inbound, self.outbound, self.zone_inbound, self.zone_outbound = {}, {}, {}, {}
+        for s in relocating:
+            if s.status == "INITIALIZING":
+                primaries = [
+                    p
+                    for p in snapshot.replicas(s.index, s.i)
+                    if p.status == "STARTED" and p.type == 'p'
+                ]
+                # PRIMARY SHARD IS USED TO INITIALIZE SHARD
+                source_node = primaries[0].node.name if primaries else None
+                self.reserve(source_node, s.node.name, s.size)
+            elif s.status == "RELOCATING":
+                # WE ALREADY ADDED A VIRTUAL INITIALIZING SHARD TO CATCH THE INBOUND
+                self.reserve(s.node.name, None, s.size)
+
+    def observe(self, tracker):
+        """
+        MEASURE THE RECOVERY THROUGHPUT OF EVERY NODE
+        :param tracker: RecoveryTracker, JUST REFRESHED
+        """
+        if not tracker.elapsed:
+            return
+        ingress, egress = {}, {}
+        busy_in, busy_out = set(), set()
+        for r in tracker:
+            # A RECOVERY THAT STARTED SINCE THE LAST refresh COPIED ALL ITS BYTES IN THAT TIME
+            moved = r.bytes_recovered if r.delta == None else r.delta
+            ingress[r.target_node] = ingress.get(r.target_node, 0) + moved
+            if r.source_node:
+                egress[r.source_node] = egress.get(r.source_node, 0) + moved
+            if r.delta != None:
+                # ONLY NODES BUSY AT BOTH OBSERVATIONS WERE SATURATED THE WHOLE TIME
+                busy_in.add(r.target_node)
+                if r.source_node:
+                    busy_out.add(r.source_node)
+
+        for direction, busy, moved in (("ingress", busy_in, ingress), ("egress", busy_out, egress)):
+            measured = self.measured[direction]
+            for node_name in busy:
+                if moved.get(node_name, 0) <= 0:
+                    continue
+                rate = moved[node_name] / tracker.elapsed
+                prev = measured.get(node_name)
+                measured[node_name] = rate if prev is None else EWMA_WEIGHT * rate + (1 - EWMA_WEIGHT) * prev
+        DEBUG and Log.note("Measured recovery rates {{rates|json}}", rates=self.measured)
+
+    def _rate(self, value):
+        if value == None:
+            return None
+        if is_text(value):
+            return tables.text_to_bytes(value)
+        return float(value)
+
+    def rate(self, node_name, direction):
+        """
+        :return: BYTES/SECOND: THE LOWER OF THE CONFIGURED AND THE MEASURED RATE, OR None IF NEITHER IS KNOWN
+        """
+        rate = self._rate(coalesce(getattr(self.nodes[node_name], direction), self.settings[direction]))
+        measured = self.measured[direction].get(node_name)
+        if rate is None:
+            return measured
+        if measured is None:
+            return rate
+        return min(rate, measured)
+
+    def node_budget(self, node_name, direction):
+        """
+        :return: BYTES THAT CAN BE IN FLIGHT, FOR ONE concurrent
+        """
+        node = self.nodes[node_name]
+        rate = self._rate(coalesce(getattr(node, direction), self.settings[direction]))
+        measured = self.measured[direction].get(node_name)
+        if rate is None:
+            if measured is None:
+                return BIG_SHARD_SIZE
+            return max(BIG_SHARD_SIZE, measured * self.window)
+        if measured is not None:
+            rate = min(rate, measured)
+        return rate * self.window
+
+    def zone_budget(self, zone, direction):
+        rate = self._rate(getattr(zone, direction))
+        if rate is None:
+            return None
+        return rate * self.window
+
+    def can_send(self, node_name, concurrent):
+        node = self.nodes[node_name]
+        if self.outbound.get(node_name, 0) >= concurrent * self.node_budget(node_name, "egress"):
+            return False
+        budget = self.zone_budget(node.zone, "egress")
+        return budget is None or self.zone_outbound.get(node.zone.name, 0) < concurrent * budget
+
+    def can_receive(self, node_name, concurrent):
+        node = self.nodes[node_name]
+        if self.inbound.get(node_name, 0) >= concurrent * self.node_budget(node_name, "ingress"):
+            return False
+        budget = self.zone_budget(node.zone, "ingress")
+        return budget is None or self.zone_inbound.get(node.zone.name, 0) < concurrent * budget
+
+    def reserve(self, source_node, destination_node, size):
+        """
+        ADD (OR REMOVE, WITH NEGATIVE size) BYTES IN FLIGHT
+        """
+        if source_node:
+            # `source_node is None` WHEN CLUSTER IS RED
+            self.outbound[source_node] = self.outbound.get(source_node, 0) + size
+            zone = self.nodes[source_node].zone.name
+            if zone:
+                self.zone_outbound[zone] = self.zone_outbound.get(zone, 0) + size
+        if destination_node:
+            self.inbound[destination_node] = self.inbound.get(destination_node, 0) + size
+            zone = self.nodes[destination_node].zone.name
+            if zone:
+                self.zone_inbound[zone] = self.zone_inbound.get(zone, 0) + size
@@ -0,0 +1,814 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import, division, unicode_literals
+
+import json
+from math import ceil
+
+from mo_future import is_binary, text, urlparse
+from mo_json import json2value, value2json
+from mo_logs import Log
+
+from balancer.snapshot import INITIALIZING, RELOCATING, STARTED, UNASSIGNED
+
+DEBUG = False
+DEFAULT_BANDWIDTH = 40 * 1000 * 1000  # BYTES PER SECOND, ES DEFAULT indices.recovery.max_bytes_per_sec
+CONCURRENT_RECOVERIES = 2  # ES DEFAULT cluster.routing.allocation.node_concurrent_recoveries
+HIGH_WATERMARK = 0.90
+
+AWARENESS = "cluster.routing.allocation.awareness.attributes"
+DISK_THRESHOLD = "cluster.routing.allocation.disk.threshold_enabled"
+
+
+class SimulatedNode(object):
+    __slots__ = ["name", "id", "ip", "zone", "memory", "disk", "roles", "bandwidth", "used"]
+
+    def __init__(self, name, id, ip, zone, memory, disk, roles, bandwidth):
+        self.name = name
+        self.id = id
+        self.ip = ip
+        self.zone = zone
+        self.memory = memory
+        self.disk = disk
+        self.roles = roles
+        self.bandwidth = bandwidth
+        self.used = 0  # BYTES ON DISK, INCLUDING RECOVERIES IN PROGRESS
+
+
+class SimulatedShard(object):
+    __slots__ = ["index", "i", "primary", "status", "node", "size", "recovered", "source", "target", "started"]
+
+    def __init__(self, index, i, primary, size):
+        self.index = index
+        self.i = i
+        self.primary = primary
+        self.status = UNASSIGNED
+        self.node = None  # NODE NAME
+        self.size = size
+        self.recovered = 0  # BYTES COPIED SO FAR, WHEN INITIALIZING
+        self.source = None  # RELOCATION TARGET: THE RELOCATING SHARD IT COPIES
+        self.target = None  # RELOCATING SHARD: THE INITIALIZING COPY ON THE DESTINATION
+        self.started = None  # CLOCK WHEN RECOVERY STARTED
+
+
+class CommandFailure(Exception):
+    pass
+
+
+class SimulatedCluster(object):
+    """
+    PURE PYTHON STAND-IN FOR THE ES ENDPOINTS USED BY balance.py
+
+    HAS THE SAME get/get_json/put/post INTERFACE AS mo_http.http, SO IT CAN
+    REPLACE THE http MODULE. SHARDS ONLY MOVE WHEN COMMANDED; RECOVERIES
+    PROGRESS WHEN tick() ADVANCES THE SIMULATED CLOCK, LIMITED BY THE
+    bandwidth OF THE SOURCE AND DESTINATION NODES
+    """
+
+    def __init__(self, concurrent_recoveries=CONCURRENT_RECOVERIES):
+        self.clock = 0.0  # SIMULATED SECONDS
+        self.concurrent_recoveries = concurrent_recoveries
+        self.nodes = {}  # MAP FROM NAME TO SimulatedNode
+        self.indexes = {}  # MAP FROM NAME TO (uuid, number_of_shards, number_of_replicas)
+        self.copies = {}  # MAP FROM (index, i) TO LIST OF SimulatedShard
+        self.stores = {}  # MAP FROM (index, i) TO (MAP FROM NODE NAME TO "primary"/"replica"), COPIES LEFT ON LOST NODES' DISKS
+        self.num_nodes_added = 0
+        self.load = {}  # MAP FROM index TO (documents indexed, queries, merge millis) PER SECOND, PER COPY
+        self.ingest = {}  # MAP FROM index TO BYTES PER SECOND WRITTEN TO EACH STARTED COPY
+        self.settings = {"persistent": {}, "transient": {}}
+        self.bytes_moved = 0
+        self.commands_accepted = 0
+        self.commands_rejected = 0
+        self.requests = {}  # MAP FROM ENDPOINT TO NUMBER OF CALLS
+        self._journal = None  # UNDO LOG, WHILE EXECUTING REROUTE COMMANDS
+
+    ###########################################################################
+    # CLUSTER SETUP AND EVENTS
+    ###########################################################################
+
+    def add_node(self, name, zone, memory, disk, bandwidth=DEFAULT_BANDWIDTH, roles=("data", "master", "ingest")):
+        n = self.num_nodes_added  # A NODE ADDED BACK IS GIVEN A NEW id
+        self.num_nodes_added += 1
+        node = SimulatedNode(
+            name=name,
+            id="node%018d" % n,
+            ip="10.0." + text(n // 250) + "." + text(n % 250 + 1),
+            zone=zone,
+            memory=memory,
+            disk=disk,
+            roles=list(roles),
+            bandwidth=bandwidth
+        )
+        self.nodes[name] = node
+        return node
+
+    def add_index(self, index, sizes, number_of_replicas):
+        """
+        :param sizes: SIZE OF EACH PRIMARY SHARD
+        """
+        self.indexes[index] = ("uuid%018d" % len(self.indexes), len(sizes), number_of_replicas)
+        for i, size in enumerate(sizes):
+            self.copies[(index, i)] = [SimulatedShard(index, i, r == 0, size) for r in range(number_of_replicas + 1)]
+
+    def place(self, index, i, node_name, primary=True):
+        """
+        PUT A STARTED COPY ON node_name, WITHOUT RECOVERY (FOR BUILDING THE INITIAL CLUSTER)
+        """
+        for s in self.copies[(index, i)]:
+            if s.status == UNASSIGNED and s.primary == primary:
+                s.status = STARTED
+                s.node = node_name
+                s.recovered = s.size
+                self.nodes[node_name].used += s.size
+                return s
+        Log.error("No unassigned copy of {{index}}:{{i}}", index=index, i=i)
+
+    def remove_node(self, name):
+        """
+        SIMULATE THE LOSS OF A NODE: ITS COPIES BECOME UNASSIGNED, ITS RECOVERIES FAIL
+
+        THE STARTED COPIES STAY ON ITS DISK, AND ARE FOUND BY _shard_stores IF
+        A NODE OF THE SAME NAME IS ADDED BACK
+        """
+        node = self.nodes.pop(name)
+        for (index, i), copies in self.copies.items():
+            if not any(s.node == name for s in copies):
+                continue
+            for s in list(copies):
+                if s.node == name:
+                    if s.status in (STARTED, RELOCATING):
+                        self.stores.setdefault((index, i), {})[name] = "primary" if s.primary else "replica"
+                    self._lose(copies, s)
+                elif s.status == INITIALIZING and self._recovery_source(copies, s) == name:
+                    self._lose(copies, s)
+        return node
+
+    def _lose(self, copies, s):
+        if s not in copies:
+            return
+        if s.source:
+            # RELOCATION TARGET LOST, SOURCE IS STARTED AGAIN
+            s.source.status = STARTED
+            s.source.target = None
+            copies.remove(s)
+        else:
+            if s.target:
+                # RELOCATION SOURCE LOST, THE TARGET HAS NOTHING TO COPY
+                self._release(s.target)
+                copies.remove(s.target)
+                s.target = None
+            self._release(s)
+            s.status = UNASSIGNED
+            s.node = None
+            s.recovered = 0
+            if s.primary:
+                # PROMOTE A STARTED REPLICA
+                for r in copies:
+                    if r.status in (STARTED, RELOCATING) and not r.primary and not r.source:
+                        r.primary = True
+                        s.primary = False
+                        break
+        if s.primary and s.status == UNASSIGNED:
+            # NO PRIMARY, SO THE REPLICA RECOVERIES FAIL TOO
+            for r in list(copies):
+                if r.status == INITIALIZING and not r.source:
+                    self._lose(copies, r)
+
+    def _release(self, s):
+        node = self.nodes.get(s.node)
+        if node:
+            node.used -= s.size
+
+    def tick(self, seconds):
+        """
+        ADVANCE THE CLOCK, AND PROGRESS THE RECOVERIES
+        """
+        end = self.clock + seconds
+        self._grow(seconds)
+        waiting = sorted(
+            (s for copies in self.copies.values() for s in copies if s.status == INITIALIZING),
+            key=lambda s: s.started
+        )
+        while True:
+            recoveries = self._progressing(waiting)
+            if not recoveries:
+                break
+            rates = self._rates(recoveries)
+            step = min(
+                (s.size - s.recovered) / rate if rate else float("inf")
+                for s, rate in zip(recoveries, rates)
+            )
+            step = max(0, min(step, end - self.clock))
+            for s, rate in zip(recoveries, rates):
+                s.recovered = min(s.size, s.recovered + rate * step)
+            self.clock += step
+            finished = [s for s in recoveries if s.size - s.recovered < 1]  # FLOAT ROUNDING CAN LEAVE A FRACTION OF A BYTE
+            for s in finished:
+                s.recovered = s.size
+                self._finish(s)
+                waiting.remove(s)
+            if not finished:
+                break
+        self.clock = end
+
+    def _grow(self, seconds):
+        """
+        WRITE THE self.ingest BYTES; ONLY STARTED COPIES GROW, SO RECOVERIES COPY A FIXED SIZE
+        """
+        for index, rate in self.ingest.items():
+            added = int(rate * seconds)
+            for i in range(self.indexes[index][1]):
+                for s in self.copies[(index, i)]:
+                    if s.status == STARTED:
+                        s.size += added
+                        s.recovered = s.size
+                        self.nodes[s.node].used += added
+
+    def _progressing(self, waiting):
+        """
+        :param waiting: INITIALIZING SHARDS, OLDEST FIRST
+        :return: THE RECOVERIES THAT ARE NOT THROTTLED
+        """
+        incoming = {}
+        outgoing = {}
+        output = []
+        for s in waiting:
+            source = self._recovery_source(self.copies[(s.index, s.i)], s)
+            if incoming.get(s.node, 0) >= self.concurrent_recoveries:
+                continue
+            if source and outgoing.get(source, 0) >= self.concurrent_recoveries:
+                continue
+            incoming[s.node] = incoming.get(s.node, 0) + 1
+            if source:
+                outgoing[source] = outgoing.get(source, 0) + 1
+            output.append(s)
+        return output
+
+    def _rates(self, recoveries):
+        incoming = {}
+        outgoing = {}
+        sources = []
+        for s in recoveries:
+            source = self._recovery_source(self.copies[(s.index, s.i)], s)
+            sources.append(source)
+            incoming[s.node] = incoming.get(s.node, 0) + 1
+            if source:
+                outgoing[source] = outgoing.get(source, 0) + 1
+        rates = []
+        for s, source in zip(recoveries, sources):
+            rate = self.nodes[s.node].bandwidth / incoming[s.node]
+            if source:
+                rate = min(rate, self.nodes[source].bandwidth / outgoing[source])
+            rates.append(rate)
+        return rates
+
+    def _recovery_source(self, copies, s):
+        """
+        :return: NAME OF THE NODE s IS COPIED FROM, OR None IF NOTHING IS COPIED
+        """
+        if s.source:
+            return s.source.node
+        if s.primary:
+            return None
+        for p in copies:
+            if p.primary and p.status in (STARTED, RELOCATING):
+                return p.node
+        return None
+
+    def _finish(self, s):
+        copies = self.copies[(s.index, s.i)]
+        if s.source or not s.primary:
+            self.bytes_moved += s.size
+        s.status = STARTED
+        s.started = None
+        if s.source:
+            source = s.source
+            self._release(source)
+            copies.remove(source)
+            s.primary = source.primary
+            s.source = None
+
+    def recovering(self):
+        """
+        :return: NUMBER OF SHARDS INITIALIZING
+        """
+        return sum(1 for copies in self.copies.values() for s in copies if s.status == INITIALIZING)
+
+    def unassigned(self):
+        return sum(1 for copies in self.copies.values() for s in copies if s.status == UNASSIGNED)
+
+    ###########################################################################
+    # mo_http INTERFACE
+    ###########################################################################
+
+    def get(self, url, **kwargs):
+        return self._request("get", url, kwargs)
+
+    def get_json(self, url, **kwargs):
+        response = self.get(url, **kwargs)
+        return json2value(response.all_content.decode("utf8"))
+
+    def put(self, url, **kwargs):
+        return self._request("put", url, kwargs)
+
+    def post(self, url, **kwargs):
+        return self._request("post", url, kwargs)
+
+    def _request(self, method, url, kwargs):
+        parsed = urlparse(url)
+        path = parsed.path
+        query = {}
+        for pair in parsed.query.split("&"):
+            if pair:
+                k, _, v = pair.partition("=")
+                query[k] = v
+        body = None
+        if kwargs.get("json") is not None:
+            # SAME SERIALIZATION AS mo_http, SO Data IS SEEN AS PLAIN JSON
+            body = json.loads(value2json(kwargs["json"]))
+        elif kwargs.get("data"):
+            data = kwargs["data"]
+            body = json.loads(data.decode("utf8") if is_binary(data) else data)
+
+        endpoint = method + " " + ("/{index}/_settings" if path.endswith("/_settings") and path != "/_cluster/settings" else path)
+        self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+        DEBUG and Log.note("simulate {{endpoint}}", endpoint=endpoint)
+
+        try:
+            if method == "get" and path.startswith("/_nodes/stats"):
+                return _json(200, self._nodes_stats())
+            elif method == "get" and path == "/_cat/shards":
+                return self._cat(self._cat_shards(), query)
+            elif method == "get" and path == "/_cat/indices":
+                return self._cat(self._cat_indices(), query)
+            elif method == "get" and path == "/_cat/recovery":
+                return self._cat(self._cat_recovery(), query)
+            elif method == "get" and path.startswith("/_stats"):
+                return _json(200, self._stats())
+            elif method == "get" and path.endswith("/_shard_stores"):
+                return _json(200, self._shard_stores(path, query))
+            elif method == "get" and path == "/_cluster/health":
+                return _json(200, self._cluster_health())
+            elif method == "post" and path == "/_cluster/reroute":
+                return self._reroute(body, query)
+            elif method == "put" and path == "/_cluster/settings":
+                return self._cluster_settings(body)
+            elif method == "put" and path.endswith("/_settings"):
+                return self._index_settings(path.split("/")[1], body)
+        except CommandFailure as e:
+            return _error(400, text(e))
+        return _error(404, "no handler found for uri [" + path + "] and method [" + method.upper() + "]")
+
+    ###########################################################################
+    # ENDPOINTS
+    ###########################################################################
+
+    def _nodes_stats(self):
+        return {"nodes": {
+            n.id: {
+                "name": n.name,
+                "host": n.ip,
+                "roles": n.roles,
+                "attributes": {"zone": n.zone},
+                "jvm": {"mem": {"heap_max_in_bytes": n.memory}},
+                "fs": {"total": {"total_in_bytes": n.disk, "available_in_bytes": max(0, n.disk - n.used)}}
+            }
+            for n in self.nodes.values()
+        }}
+
+    def _cluster_health(self):
+        """
+        THE wait_for_* PARAMETERS ARE IGNORED; THE SIMULATED CLOCK ONLY MOVES WITH tick()
+        """
+        counts = {STARTED: 0, RELOCATING: 0, INITIALIZING: 0, UNASSIGNED: 0}
+        status = "green"
+        for (index, i), copies in self.copies.items():
+            for s in copies:
+                counts[s.status] += 1
+            if not any(s.primary and s.status in (STARTED, RELOCATING) for s in copies):
+                status = "red"
+            elif status == "green" and any(s.status != STARTED and not s.source for s in copies):
+                status = "yellow"
+        return {
+            "status": status,
+            "number_of_nodes": len(self.nodes),
+            "active_shards": counts[STARTED] + counts[RELOCATING],
+            "relocating_shards": counts[RELOCATING],
+            "initializing_shards": counts[INITIALIZING],
+            "unassigned_shards": counts[UNASSIGNED]
+        }
+
+    def _shard_stores(self, path, query):
+        """
+        THE COPIES OF THE RED SHARDS (status=red IS ASSUMED) THAT ARE ON THE DISK OF A NODE
+        """
+        names = path.split("/")[1] if path != "/_shard_stores" else "_all"
+        wanted = None if names == "_all" else set(names.split(","))
+        output = {}
+        for (index, i), on_disk in sorted(self.stores.items()):
+            if wanted is not None and index not in wanted:
+                continue
+            copies = self.copies[(index, i)]
+            if any(s.primary and s.status != UNASSIGNED for s in copies):
+                continue  # NOT RED
+            stores = [
+                {
+                    self.nodes[name].id: {"name": name, "transport_address": self.nodes[name].ip + ":9300"},
+                    "allocation_id": "alloc_" + name,
+                    "allocation": allocation
+                }
+                for name, allocation in sorted(on_disk.items())
+                if name in self.nodes
+            ]
+            if stores:
+                output.setdefault(index, {"shards": {}})["shards"][text(i)] = {"stores": stores}
+        return {"indices": output}
+
+    def _stats(self):
+        """
+        level=shards; THE COUNTERS OF EACH STARTED COPY ARE THE RATES IN self.load TIMES THE CLOCK
+        """
+        output = {}
+        for (index, i), copies in sorted(self.copies.items()):
+            rates = self.load.get(index, (0, 0, 0))
+            rows = []
+            for s in copies:
+                if s.status not in (STARTED, RELOCATING):
+                    continue
+                rows.append({
+                    "routing": {"node": self.nodes[s.node].id, "primary": s.primary},
+                    "indexing": {"index_total": int(rates[0] * self.clock)},
+                    "search": {"query_total": int(rates[1] * self.clock)},
+                    "merges": {"total_time_in_millis": int(rates[2] * self.clock)}
+                })
+            if rows:
+                output.setdefault(index, {"shards": {}})["shards"][text(i)] = rows
+        return {"indices": output}
+
+    def _cat_shards(self):
+        rows = []
+        for (index, i), copies in sorted(self.copies.items()):
+            for s in copies:
+                if s.source:
+                    continue  # RELOCATION TARGETS ARE SHOWN ON THE RELOCATING SHARD
+                row = {"index": index, "shard": text(i), "prirep": "p" if s.primary else "r", "state": s.status}
+                if s.node:
+                    node = self.nodes[s.node]
+                    row["ip"] = node.ip
+                    row["node"] = node.name
+                    if s.status in (STARTED, RELOCATING):
+                        row["docs"] = text(int(s.size // 1000))
+                        row["store"] = text(int(s.size))
+                    if s.target:
+                        target = self.nodes[s.target.node]
+                        row["node"] = node.name + " -> " + target.ip + " " + target.id + " " + target.name
+                rows.append(row)
+        return rows, ["index", "shard", "prirep", "state", "docs", "store", "ip", "node"]
+
+    def _cat_recovery(self):
+        """
+        THE ACTIVE RECOVERIES (active_only IS ASSUMED); THROTTLED ONES ARE STILL IN THE init STAGE
+        """
+        waiting = sorted(
+            (s for copies in self.copies.values() for s in copies if s.status == INITIALIZING),
+            key=lambda s: s.started
+        )
+        copying = set(id(s) for s in self._progressing(waiting))
+        rows = []
+        for (index, i), copies in sorted(self.copies.items()):
+            for s in copies:
+                if s.status != INITIALIZING:
+                    continue
+                source = self._recovery_source(copies, s)
+                rows.append({
+                    "index": index,
+                    "shard": text(i),
+                    "type": "peer" if source else "empty_store",  # ES 5 AND 6 HAVE NO relocation TYPE
+                    "stage": "index" if id(s) in copying else "init",
+                    "source_node": source or "n/a",
+                    "target_node": s.node,
+                    "bytes_recovered": text(int(s.recovered)),
+                    "bytes_total": text(int(s.size))
+                })
+        return rows, ["index", "shard", "type", "stage", "source_node", "target_node", "bytes_recovered", "bytes_total"]
+
+    def _cat_indices(self):
+        rows = []
+        for index, (uuid, num_shards, num_replicas) in sorted(self.indexes.items()):
+            health = "green"
+            for i in range(num_shards):
+                copies = self.copies[(index, i)]
+                if not any(s.primary and s.status in (STARTED, RELOCATING) for s in copies):
+                    health = "red"
+                    break
+                if any(s.status != STARTED and not s.source for s in copies):
+                    health = "yellow"
+            rows.append({
+                "health": health,
+                "status": "open",
+                "index": index,
+                "uuid": uuid,
+                "pri": text(num_shards),
+                "rep": text(num_replicas)
+            })
+        return rows, ["health", "status", "index", "uuid", "pri", "rep"]
+
+    def _cat(self, table, query):
+        rows, columns = table
+        if query.get("h"):
+            columns = query["h"].split(",")
+        if query.get("format") == "json":
+            return _json(200, [{c: r.get(c) for c in columns} for r in rows])
+
+        # TEXT TABLE, NUMBERS RIGHT-ALIGNED, STORE IN BYTES
+        right = {"shard", "docs", "store", "pri", "rep", "bytes_recovered", "bytes_total"}
+        cells = [[r.get(c, "") + ("b" if c == "store" and r.get(c) else "") for c in columns] for r in rows]
+        if not cells:
+            return _response(200, b"")
+        widths = [max(len(r[k]) for r in cells) for k in range(len(columns))]
+        lines = [
+            " ".join(v.rjust(w) if c in right else v.ljust(w) for c, v, w in zip(columns, r, widths)).rstrip() + "\n"
+            for r in cells
+        ]
+        return _response(200, "".join(lines).encode("utf8"))
+
+    def _cluster_settings(self, body):
+        for scope in ("persistent", "transient"):
+            for k, v in (body or {}).get(scope, {}).items():
+                if v is None:
+                    self.settings[scope].pop(k, None)
+                else:
+                    self.settings[scope][k] = v
+        return _json(200, {"acknowledged": True})
+
+    def _setting(self, name):
+        return self.settings["transient"].get(name, self.settings["persistent"].get(name))
+
+    def _index_settings(self, index, body):
+        if index not in self.indexes:
+            raise CommandFailure("no such index [" + index + "]")
+        num_replicas = body.get("index", {}).get("number_of_replicas")
+        if num_replicas is None:
+            num_replicas = body.get("number_of_replicas")
+        if num_replicas is None:
+            return _json(200, {"acknowledged": True})
+
+        uuid, num_shards, _ = self.indexes[index]
+        self.indexes[index] = (uuid, num_shards, num_replicas)
+        for i in range(num_shards):
+            copies = self.copies[(index, i)]
+            size = max(s.size for s in copies)
+            real = [s for s in copies if not s.source]
+            while len(real) < num_replicas + 1:
+                s = SimulatedShard(index, i, False, size)
+                copies.append(s)
+                real.append(s)
+            # REMOVE REPLICAS, UNASSIGNED FIRST
+            order = {UNASSIGNED: 0, INITIALIZING: 1, STARTED: 2, RELOCATING: 3}
+            for s in sorted([s for s in real if not s.primary], key=lambda s: order[s.status]):
+                if len(real) <= num_replicas + 1:
+                    break
+                if s.target:
+                    self._release(s.target)
+                    copies.remove(s.target)
+                self._release(s)
+                copies.remove(s)
+                real.remove(s)
+        return _json(200, {"acknowledged": True})
+
+    def _reroute(self, body, query):
+        dry_run = query.get("dry_run") == "true"
+        explain = query.get("explain") == "true"
+        commands = (body or {}).get("commands", [])
+
+        self._journal = []
+        explanations = []
+        try:
+            for c in commands:
+                (name, params), = c.items()
+                decisions = self._execute(name, params)
+                if any(d["decision"] == "NO" for d in decisions):
+                    self.commands_rejected += 1
+                    if not explain:
+                        raise CommandFailure(
+                            "[" + name + "] can't execute on [" + params.get("index", "") + "][" + text(params.get("shard")) + "], reason: " +
+                            "".join("[NO(" + d["explanation"] + ")]" for d in decisions if d["decision"] == "NO")
+                        )
+                else:
+                    self.commands_accepted += 0 if dry_run else 1
+                explanations.append({"command": name, "parameters": params, "decisions": decisions})
+        except CommandFailure:
+            self._undo()
+            raise
+        except Exception as e:
+            self._undo()
+            raise CommandFailure(text(e))
+
+        if dry_run:
+            self._undo()
+        self._journal = None
+
+        output = {"acknowledged": True}
+        if explain:
+            output["explanations"] = explanations
+        return _json(200, output)
+
+    ###########################################################################
+    # REROUTE COMMANDS
+    ###########################################################################
+
+    def _execute(self, name, params):
+        """
+        APPLY ONE COMMAND
+        :return: LIST OF DECISIONS; IF ANY IS NO, NOTHING WAS CHANGED
+        """
+        index, i = params.get("index"), params.get("shard")
+        copies = self.copies.get((index, i))
+        if copies is None:
+            raise CommandFailure("[" + name + "] no such shard [" + text(index) + "][" + text(i) + "]")
+
+        if name == "move":
+            self._resolve(params.get("from_node"))
+            node = self._resolve(params.get("to_node"))
+            source = _first(s for s in copies if s.node == params.get("from_node") and not s.source)
+            if not source or source.status != STARTED:
+                raise CommandFailure("[move_allocation] can't move [" + index + "][" + text(i) + "], failed to find it on node " + params.get("from_node"))
+            decisions = self._deciders(copies, source, node)
+            if _accepted(decisions):
+                target = SimulatedShard(index, i, False, source.size)
+                self._append(copies, target)
+                self._assign(target, node, source=source)
+                self._set(source, "status", RELOCATING)
+                self._set(source, "target", target)
+            return decisions
+
+        elif name == "cancel":
+            node = self._resolve(params.get("node"))
+            shard = _first(s for s in copies if s.node == node.name)
+            if not shard or shard.status not in (INITIALIZING, RELOCATING):
+                raise CommandFailure("[cancel_allocation] can't cancel " + text(i) + ", failed to find it on node " + node.name)
+            if shard.status == RELOCATING:
+                shard = shard.target
+            if shard.source:
+                self._set(shard.source, "status", STARTED)
+                self._set(shard.source, "target", None)
+                self._unassign(shard)
+                self._remove(copies, shard)
+            else:
+                self._unassign(shard)
+            return [_decision("cancel", "YES", "shard recovery cancelled")]
+
+        elif name in ("allocate_replica", "allocate_empty_primary", "allocate_stale_primary"):
+            node = self._resolve(params.get("node"))
+            primary = name != "allocate_replica"
+            shard = _first(s for s in copies if s.status == UNASSIGNED and s.primary == primary)
+            if not shard:
+                raise CommandFailure("[" + name + "] all copies of [" + index + "][" + text(i) + "] are already assigned. Use the move allocation command instead")
+            if primary and not params.get("accept_data_loss"):
+                raise CommandFailure("[" + name + "] allocating an empty primary for [" + index + "][" + text(i) + "] can result in data loss. Please confirm by setting the accept_data_loss parameter to true")
+            if name == "allocate_stale_primary" and node.name not in self.stores.get((index, i), {}):
+                raise CommandFailure("[" + name + "] No data for shard [" + text(i) + "] of index [" + index + "] found on node [" + node.name + "]")
+            if not primary and not any(s.primary and s.status in (STARTED, RELOCATING) for s in copies):
+                raise CommandFailure("[" + name + "] trying to allocate a replica shard [" + index + "][" + text(i) + "], while corresponding primary shard is still unassigned")
+            decisions = self._deciders(copies, shard, node)
+            if _accepted(decisions):
+                self._assign(shard, node)
+                if name == "allocate_empty_primary":
+                    self._set(shard, "size", 0)
+            return decisions
+
+        raise CommandFailure("unknown command [" + name + "]")
+
+    def _resolve(self, name):
+        node = self.nodes.get(name)
+        if not node:
+            raise CommandFailure("failed to resolve [" + text(name) + "], no matching nodes")
+        return node
+
+    def _deciders(self, copies, shard, node):
+        decisions = []
+        if "data" not in node.roles:
+            decisions.append(_decision("data_role", "NO", "node does not have the data role"))
+        if any(s.node == node.name for s in copies):
+            decisions.append(_decision("same_shard", "NO", "the shard cannot be allocated to the same node on which a copy of the shard already exists"))
+
+        used = node.used + shard.size
+        if used > node.disk:
+            decisions.append(_decision("disk_threshold", "NO", "not enough disk space on node [" + node.name + "]"))
+        elif self._setting(DISK_THRESHOLD) not in (False, "false") and node.disk and used > HIGH_WATERMARK * node.disk:
+            decisions.append(_decision("disk_threshold", "NO", "after allocation more than allowed [90.0%] used disk on node"))
+
+        if self._setting(AWARENESS) == "zone":
+            # AT MOST ceil(copies / zones) COPIES PER ZONE; RELOCATION TARGETS AND THE SHARD ITSELF DO NOT COUNT
+            num_zones = len(set(n.zone for n in self.nodes.values()))
+            total = len([s for s in copies if not s.source])
+            in_zone = 1 + len([
+                s
+                for s in copies
+                if s.node and not s.source and s is not shard and self.nodes[s.node].zone == node.zone
+            ])
+            upper = int(ceil(total / num_zones))
+            if in_zone > upper:
+                decisions.append(_decision(
+                    "awareness",
+                    "NO",
+                    "there are too many copies of the shard allocated to nodes with attribute [zone], there are [" + text(total) +
+                    "] total configured shard copies for this shard id and [" + text(num_zones) +
+                    "] total attribute values, expected the allocated shard count per attribute [" + text(in_zone) +
+                    "] to be less or equal to the upper bound of the required number of shards per attribute [" + text(upper) + "]"
+                ))
+        if not decisions:
+            decisions.append(_decision("all", "YES", "all deciders allow the allocation"))
+        return decisions
+
+    # ALL CHANGES MADE BY COMMANDS GO THROUGH THESE, SO THEY CAN BE UNDONE
+
+    def _set(self, obj, attr, value):
+        if self._journal is not None:
+            old = getattr(obj, attr)
+            self._journal.append(lambda: setattr(obj, attr, old))
+        setattr(obj, attr, value)
+
+    def _append(self, copies, shard):
+        copies.append(shard)
+        if self._journal is not None:
+            self._journal.append(lambda: copies.remove(shard))
+
+    def _remove(self, copies, shard):
+        position = copies.index(shard)
+        copies.remove(shard)
+        if self._journal is not None:
+            self._journal.append(lambda: copies.insert(position, shard))
+
+    def _assign(self, shard, node, source=None):
+        self._set(shard, "status", INITIALIZING)
+        self._set(shard, "node", node.name)
+        self._set(shard, "recovered", 0)
+        self._set(shard, "source", source)
+        self._set(shard, "started", self.clock)
+        self._set(node, "used", node.used + shard.size)
+
+    def _unassign(self, shard):
+        node = self.nodes.get(shard.node)
+        if node:
+            self._set(node, "used", node.used - shard.size)
+        self._set(shard, "status", UNASSIGNED)
+        self._set(shard, "node", None)
+        self._set(shard, "recovered", 0)
+        self._set(shard, "started", None)
+
+    def _undo(self):
+        journal, self._journal = self._journal, None
+        for undo in reversed(journal or []):
+            undo()
+
+
+def _first(values):
+    for v in values:
+        return v
+    return None
+
+
+def _decision(decider, decision, explanation):
+    return {"decider": decider, "decision": decision, "explanation": explanation}
+
+
+def _accepted(decisions):
+    return all(d["decision"] != "NO" for d in decisions)
+
+
+class SimulatedResponse(object):
+    """
+    LOOKS LIKE mo_http.http.HttpResponse
+    """
+
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+
+    @property
+    def all_content(self):
+        return self.content
+
+
+def _response(status_code, content):
+    return SimulatedResponse(status_code, content)
+
+
+def _json(status_code, value):
+    return SimulatedResponse(status_code, json.dumps(value).encode("utf8"))
+
+
+def _error(status_code, reason):
+    return _json(status_code, {
+        "error": {
+            "root_cause": [{"type": "illegal_argument_exception", "reason": reason}],
+            "type": "illegal_argument_exception",
+            "reason": reason
+        },
+        "status": status_code
+    })
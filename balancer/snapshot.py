@@ -0,0 +1,235 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import, division, unicode_literals
+
+from array import array
+
+from mo_dots import FlatList
+
+UNASSIGNED = "UNASSIGNED"
+INITIALIZING = "INITIALIZING"
+STARTED = "STARTED"
+RELOCATING = "RELOCATING"
+
+STATUS = [UNASSIGNED, INITIALIZING, STARTED, RELOCATING]
+STATUS_CODE = {s: i for i, s in enumerate(STATUS)}
+ACTIVE = {INITIALIZING, STARTED, RELOCATING}
+TYPE_CODE = {"p": 0, "r": 1}
+NO_ID = -1
+
+
+class ClusterSnapshot(object):
+    """
+    COLUMNAR VIEW OF ALL SHARDS, BUILT ONCE PER CYCLE
+
+    EACH SHARD IS A ROW; THE ROW NUMBER IS THE POSITION IN self.shards.
+    INDEX, NODE AND ZONE NAMES ARE INTERNED TO INTEGER IDS. THE PRECOMPUTED
+    INDEXES MAP A KEY TO THE LIST OF ROWS, SO THE BALANCING PASSES NEVER
+    HAVE TO SCAN (OR REGROUP) THE WHOLE SHARD LIST
+    """
+
+    def __init__(self, shards=None):
+        self.shards = []  # THE SHARD OBJECTS, IN ROW ORDER
+
+        # INTERNED NAMES
+        self.index_names = []
+        self.node_names = []
+        self.zone_names = []
+        self._index_ids = {}
+        self._node_ids = {}
+        self._zone_ids = {}
+
+        # COLUMNS
+        self.index = array(str("l"))
+        self.i = array(str("l"))
+        self.type = array(str("b"))
+        self.status = array(str("b"))
+        self.node = array(str("l"))
+        self.zone = array(str("l"))
+        self.size = array(str("d"))
+
+        # INDEXES (ALL MAP TO LIST OF ROWS)
+        self.by_shard = {}  # (index, i) -> rows
+        self.by_index = {}  # index -> rows
+        self.by_node = {}  # node -> rows
+        self.by_node_index = {}  # (node, index) -> rows
+        self.by_zone = {}  # zone -> rows
+        self.by_status = {s: [] for s in range(len(STATUS))}  # status code -> rows
+
+        for s in shards or []:
+            self.add(s)
+
+    def add(self, shard):
+        """
+        APPEND shard TO THE SNAPSHOT, RETURN ITS ROW NUMBER
+        """
+        row = len(self.shards)
+        self.shards.append(shard)
+
+        node = shard.node
+        node_name = node.name
+        zone_name = node.zone.name
+        index_id = _intern(self._index_ids, self.index_names, shard.index)
+        node_id = _intern(self._node_ids, self.node_names, node_name) if node_name else NO_ID
+        zone_id = _intern(self._zone_ids, self.zone_names, zone_name) if zone_name else NO_ID
+        status = STATUS_CODE[shard.status]
+
+        self.index.append(index_id)
+        self.i.append(shard.i)
+        self.type.append(TYPE_CODE.get(shard.type, 1))
+        self.status.append(status)
+        self.node.append(node_id)
+        self.zone.append(zone_id)
+        self.size.append(shard.size or 0)
+
+        self.by_shard.setdefault((index_id, shard.i), []).append(row)
+        self.by_index.setdefault(index_id, []).append(row)
+        self.by_status[status].append(row)
+        if node_id != NO_ID:
+            self.by_node.setdefault(node_id, []).append(row)
+            self.by_node_index.setdefault((node_id, index_id), []).append(row)
+        if zone_id != NO_ID:
+            self.by_zone.setdefault(zone_id, []).append(row)
+        return row
+
+    def set_status(self, shard, status):
+        """
+        CHANGE STATUS OF shard, AND KEEP THE STATUS INDEX CONSISTENT
+        """
+        row = self.row_of(shard)
+        old = self.status[row]
+        new = STATUS_CODE[status]
+        shard.status = status
+        if old == new:
+            return
+        self.status[row] = new
+        self.by_status[old].remove(row)
+        self.by_status[new].append(row)
+
+    def normalize_sizes(self):
+        """
+        ALL REPLICAS OF A SHARD ARE GIVEN THE SIZE OF THE BIGGEST REPLICA
+        """
+        size, shards = self.size, self.shards
+        for rows in self.by_shard.values():
+            biggest = max(size[r] for r in rows)
+            for r in rows:
+                size[r] = biggest
+                shards[r].size = biggest
+
+    def row_of(self, shard):
+        for row in self.by_shard.get((self._index_ids.get(shard.index), shard.i), []):
+            if self.shards[row] is shard:
+                return row
+        raise KeyError("shard not in snapshot")
+
+    def _rows(self, rows):
+        shards = self.shards
+        return FlatList([shards[r] for r in rows])
+
+    def __len__(self):
+        return len(self.shards)
+
+    def __iter__(self):
+        return iter(self.shards)
+
+    def shard_keys(self):
+        """
+        ALL (index, i) PAIRS, IN SORTED ORDER (SAME ORDER AS jx.groupby(shards, ["index", "i"]))
+        """
+        names = self.index_names
+        return sorted((names[index_id], i) for index_id, i in self.by_shard.keys())
+
+    def groups(self):
+        """
+        REPLACEMENT FOR jx.groupby(shards, ["index", "i"])
+        :return: ((index, i), replicas) PAIRS, SORTED BY index, i
+        """
+        for index, i in self.shard_keys():
+            yield (index, i), self.replicas(index, i)
+
+    def index_groups(self):
+        """
+        REPLACEMENT FOR jx.groupby(shards, "index")
+        :return: (index, shards) PAIRS, SORTED BY index
+        """
+        for index in sorted(self._index_ids.keys()):
+            yield index, self.index_shards(index)
+
+    def replicas(self, index, i):
+        return self._rows(self.by_shard.get((self._index_ids.get(index), i), []))
+
+    def is_only_primary(self, index, i, source_node, target_node):
+        """
+        :return: True IF THE RECOVERY FROM source_node TO target_node MOVES THE PRIMARY OF (index, i), AND NO OTHER NODE HAS A STARTED COPY
+        """
+        replicas = self.replicas(index, i)
+        if not any(
+            r.type == "p" and ((r.node.name == source_node and r.status == RELOCATING) or r.node.name == target_node)
+            for r in replicas
+        ):
+            return False
+        return not any(r.status == STARTED and r.node.name not in (source_node, target_node) for r in replicas)
+
+    def index_shards(self, index):
+        return self._rows(self.by_index.get(self._index_ids.get(index), []))
+
+    def index_size(self, index):
+        size = self.size
+        return sum(size[r] for r in self.by_index.get(self._index_ids.get(index), []))
+
+    def on_node(self, node_name):
+        return self._rows(self.by_node.get(self._node_ids.get(node_name), []))
+
+    def on_node_index(self, node_name, index):
+        return self._rows(self.by_node_index.get((self._node_ids.get(node_name), self._index_ids.get(index)), []))
+
+    def in_zone(self, zone_name):
+        return self._rows(self.by_zone.get(self._zone_ids.get(zone_name), []))
+
+    def with_status(self, *statuses):
+        output = FlatList()
+        for s in statuses:
+            output.extend(self._rows(self.by_status[STATUS_CODE[s]]))
+        return output
+
+    def node_index_groups(self, status=None):
+        """
+        REPLACEMENT FOR jx.groupby(filter(lambda r: r.status == status, shards), ["node.name", "index"])
+        :param status: OPTIONAL, ONLY SHARDS WITH THIS STATUS
+        :return: ((node_name, index), shards) PAIRS
+        """
+        code = STATUS_CODE.get(status)
+        statuses = self.status
+        for (node_id, index_id), rows in sorted(self.by_node_index.items()):
+            if code is not None:
+                rows = [r for r in rows if statuses[r] == code]
+            if rows:
+                yield (self.node_names[node_id], self.index_names[index_id]), self._rows(rows)
+
+    def index_node_stats(self, index, status):
+        """
+        :return: MAP FROM node_name TO (count, total_size) OF index SHARDS WITH GIVEN status
+        """
+        code = STATUS_CODE[status]
+        statuses, nodes, size = self.status, self.node, self.size
+        output = {}
+        for r in self.by_index.get(self._index_ids.get(index), []):
+            node_id = nodes[r]
+            if statuses[r] != code or node_id == NO_ID:
+                continue
+            count, total = output.get(node_id, (0, 0))
+            output[node_id] = (count + 1, total + size[r])
+        return {self.node_names[k]: v for k, v in output.items()}
+
+
+def _intern(ids, names, name):
+    i = ids.get(name)
+    if i is None:
+        i = ids[name] = len(names)
+        names.append(name)
+    return i
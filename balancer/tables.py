@@ -0,0 +1,324 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import, division, unicode_literals
+
+from json import JSONDecoder
+from operator import itemgetter
+
+from mo_dots import wrap
+from mo_future import is_binary, text
+from mo_http import http
+from mo_logs import Log
+from mo_threads import Thread
+
+DEBUG = False
+
+# _cat/shards COLUMNS, AND THE NAMES WE USE FOR THEM
+SHARD_COLUMNS = ["index", "shard", "prirep", "state", "docs", "store", "ip", "node"]
+SHARD_NAMES = ["index", "i", "type", "status", "num", "size", "ip", "node"]
+
+# _cat/indices COLUMNS, AND THE NAMES WE USE FOR THEM
+INDEX_COLUMNS = ["health", "status", "index", "uuid"]
+INDEX_NAMES = ["status", "state", "index", "uuid", "_remainder"]
+
+# _cat/recovery COLUMNS
+RECOVERY_COLUMNS = ["index", "shard", "type", "stage", "source_node", "target_node", "bytes_recovered", "bytes_total"]
+
+# THE _nodes/stats FIELDS WE USE
+NODE_FIELDS = [
+    "name",
+    "host",
+    "roles",
+    "attributes.zone",
+    "jvm.mem.heap_max_in_bytes",
+    "jvm.timestamp",
+    "jvm.uptime_in_millis",
+    "fs.total.total_in_bytes",
+    "fs.total.available_in_bytes"
+]
+
+# _shard_stores FIELDS OF A STORE; THE OTHER KEY IS THE NODE ID
+STORE_FIELDS = {"allocation_id", "allocation", "store_exception"}
+MAX_INDEX_LIST = 3000  # CHARACTERS, ES LIMITS THE REQUEST LINE TO 4kb
+
+# _stats METRICS, AND THE FIELDS OF EACH SHARD COPY WE USE, IN balancer.load.COMPONENTS ORDER
+SHARD_STATS = ["indexing", "search", "merge"]
+SHARD_STAT_FIELDS = [
+    "routing.node",
+    "indexing.index_total",
+    "search.query_total",
+    "merges.total_time_in_millis"
+]
+
+json_supported = {}  # MAP FROM _cat ENDPOINT TO True/False; MISSING IF NOT KNOWN YET
+json_decoder = JSONDecoder().decode
+
+
+def get_cluster_state(path):
+    """
+    FETCH THE NODES, SHARDS AND INDICES AT THE SAME TIME; ON A BUSY MASTER
+    EACH CAN TAKE SECONDS
+    :return: (nodes, shards, indices) AS RETURNED BY get_nodes(), get_shards() AND get_indices()
+    """
+    results = {}
+
+    def fetch(name, get, please_stop):
+        results[name] = get(path)
+
+    threads = [
+        Thread.run("get " + name, fetch, name, get)
+        for name, get in [("nodes", get_nodes), ("shards", get_shards), ("indices", get_indices)]
+    ]
+    for t in threads:
+        t.join()  # RAISES THE FETCH PROBLEM, IF ANY
+    return results["nodes"], results["shards"], results["indices"]
+
+
+def get_nodes(path):
+    """
+    :return: THE _nodes/stats, WITH ONLY THE jvm AND fs METRICS, TRIMMED TO NODE_FIELDS
+    """
+    return http.get_json(path + "/_nodes/stats/jvm,fs?filter_path=" + ",".join("nodes.*." + f for f in NODE_FIELDS))
+
+
+def get_shards(path):
+    """
+    :return: LIST OF (index, i, type, status, num, size, ip, node) TUPLES, WITH i AND size CONVERTED
+    """
+    rows = _get_cat(path, "/_cat/shards", SHARD_COLUMNS)
+    if rows is None:
+        rows = parse_table(http.get(path + "/_cat/shards").content, len(SHARD_NAMES))
+    return [
+        (index, int(i), type_, status, num, text_to_bytes(size), ip, node)
+        for index, i, type_, status, num, size, ip, node in rows
+    ]
+
+
+def get_indices(path):
+    """
+    :return: LIST OF (health, status, index, uuid) TUPLES
+    """
+    rows = _get_cat(path, "/_cat/indices", INDEX_COLUMNS)
+    if rows is None:
+        rows = [r[:4] for r in parse_table(http.get(path + "/_cat/indices").content, len(INDEX_NAMES))]
+    return rows
+
+
+def get_recovery(path):
+    """
+    :return: LIST OF (index, shard, type, stage, source_node, target_node, bytes_recovered, bytes_total)
+             TUPLES FOR THE ACTIVE RECOVERIES, WITH shard AND BYTES CONVERTED
+    """
+    endpoint = "/_cat/recovery?active_only=true"
+    rows = _get_cat(path, endpoint, RECOVERY_COLUMNS)
+    if rows is None:
+        url = path + endpoint + "&bytes=b&h=" + ",".join(RECOVERY_COLUMNS)
+        rows = parse_table(http.get(url).content, len(RECOVERY_COLUMNS))
+    return [
+        (index, int(shard), type_, stage, source_node, target_node, text_to_bytes(done), text_to_bytes(total))
+        for index, shard, type_, stage, source_node, target_node, done, total in rows
+    ]
+
+
+def get_shard_stores(path, indices):
+    """
+    THE COPIES OF THE RED SHARDS FOUND ON THE NODES' DISKS, FOR ALL indices IN ONE REQUEST
+    :param indices: NAMES OF THE RED INDEXES
+    :return: MAP FROM (index, i) TO LIST OF {"node", "allocation_id", "allocation", "store_exception"}
+    """
+    names = ",".join(indices)
+    if len(names) > MAX_INDEX_LIST:
+        names = "_all"
+    response = http.get_json(path + "/" + names + "/_shard_stores?status=red")
+    output = {}
+    for index, details in response.indices.items():
+        for i, shard in details.shards.items():
+            copies = output[(index, int(i))] = []
+            for store in shard.stores:
+                node_name = None
+                for k, v in store.items():
+                    if k not in STORE_FIELDS:
+                        node_name = v.name
+                copies.append(wrap({
+                    "node": node_name,
+                    "allocation_id": store.allocation_id,
+                    "allocation": store.allocation,
+                    "store_exception": store.store_exception
+                }))
+    return output
+
+
+def get_shard_stats(path, node_names):
+    """
+    THE INDEXING, SEARCH AND MERGE COUNTERS OF EVERY SHARD COPY
+
+    THIS IS THE BIGGEST RESPONSE OF THE CYCLE, SO, LIKE _get_cat, IT IS
+    TRIMMED WITH filter_path AND DECODED WITHOUT THE Data WRAPPERS
+
+    :param node_names: MAP FROM NODE ID (THE _nodes/stats KEY) TO NODE NAME
+    :return: LIST OF (index, i, node_name, index_total, query_total, merge_millis) TUPLES
+    """
+    url = path + "/_stats/" + ",".join(SHARD_STATS) + "?level=shards&filter_path=" + ",".join(
+        "indices.*.shards.*." + f for f in SHARD_STAT_FIELDS
+    )
+    response = http.get(url)
+    if response.status_code != 200:
+        Log.error("Bad response {{code}} from {{url}}", code=response.status_code, url=url)
+    output = []
+    for index, details in json_decoder(response.all_content.decode("utf8")).get("indices", {}).items():
+        for i, copies in details.get("shards", {}).items():
+            for c in copies:
+                node_name = node_names.get(c.get("routing", {}).get("node"))
+                if not node_name:
+                    continue
+                output.append((
+                    index,
+                    int(i),
+                    node_name,
+                    c.get("indexing", {}).get("index_total", 0),
+                    c.get("search", {}).get("query_total", 0),
+                    c.get("merges", {}).get("total_time_in_millis", 0)
+                ))
+    return output
+
+
+def _get_cat(path, endpoint, columns):
+    """
+    DECODE THE JSON FORM OF A _cat ENDPOINT
+
+    THE mo_json.stream PARSER IS PURE PYTHON, AND ABOUT 25x SLOWER THAN THE
+    STANDARD (C) JSON DECODER (SEE bench_tables.py), SO THE WHOLE BODY IS
+    GIVEN TO THE STANDARD DECODER, AND THE Data WRAPPERS ARE SKIPPED
+
+    SUPPORT IS REMEMBERED PER ENDPOINT, SO ONE ENDPOINT THAT CAN NOT GIVE
+    JSON DOES NOT TURN IT OFF FOR THE OTHERS. ONLY A SERVER THAT REJECTS
+    THE FORMAT (400) OR IGNORES IT (NOT JSON) IS MARKED; TIMEOUTS, DROPPED
+    CONNECTIONS AND OTHER BAD RESPONSES ARE RAISED, AND THE NEXT CYCLE TRIES
+    JSON AGAIN
+
+    :return: LIST OF TUPLES, OR None IF THE SERVER DOES NOT SUPPORT JSON FOR endpoint
+    """
+    name = endpoint.split("?")[0]
+    supported = json_supported.get(name)
+    if supported is False:
+        return None
+    url = path + endpoint + ("&" if "?" in endpoint else "?") + "format=json&bytes=b&h=" + ",".join(columns)
+    response = http.get(url)
+    if response.status_code == 400 and not supported:
+        return _no_json(name, endpoint, "status 400")
+    if response.status_code != 200:
+        Log.error("Bad response {{code}} from {{url}}", code=response.status_code, url=url)
+    try:
+        rows = json_decoder(response.all_content.decode("utf8"))
+    except Exception as e:
+        if supported:
+            Log.error("Problem reading {{url}}", url=url, cause=e)
+        return _no_json(name, endpoint, str(e))
+    json_supported[name] = True
+    return [tuple(_string(row.get(c)) for c in columns) for row in rows]
+
+
+def _no_json(name, endpoint, reason):
+    Log.note("Server does not provide {{endpoint}} as JSON, using text tables: {{reason}}", endpoint=endpoint, reason=reason)
+    json_supported[name] = False
+    return None
+
+
+def _string(value):
+    if value is None:
+        return ""
+    return value
+
+
+def parse_table(content, num_columns):
+    """
+    FIXED-WIDTH TOKENIZER FOR THE TEXT FORM OF THE _cat ENDPOINTS
+
+    COLUMNS ARE SEPARATED BY THE CHARACTER POSITIONS THAT ARE SPACE IN
+    EVERY LINE.  THE LINES ARE PADDED TO THE SAME WIDTH AND JOINED, SO EACH
+    CHARACTER POSITION CAN BE CHECKED WITH ONE STRIDED SLICE, INSTEAD OF
+    LOOKING AT EVERY CHARACTER OF EVERY LINE. EACH LINE IS THEN SLICED AT
+    THE FIRST num_columns-1 GAPS; ANY REMAINDER IS LEFT IN THE LAST COLUMN.
+
+    :param content: THE RESPONSE BODY
+    :param num_columns: NUMBER OF COLUMNS EXPECTED
+    :return: LIST OF TUPLES, EACH OF num_columns STRINGS
+    """
+    if is_binary(content):
+        content = content.decode("utf8")
+    lines = [l for l in content.split("\n") if l.strip()]
+    if not lines:
+        return []
+
+    num_lines = len(lines)
+    width = max(len(l) for l in lines)
+    padded = "".join([l.ljust(width) for l in lines])
+    blank = [padded[c::width].count(" ") == num_lines for c in range(width)] + [True]
+
+    # START OF EACH GAP BETWEEN NON-BLANK POSITIONS
+    boundaries = []
+    for c in range(1, width):
+        if blank[c] and not blank[c - 1] and not all(blank[c:]):
+            boundaries.append(c)
+            if len(boundaries) == num_columns - 1:
+                break
+
+    getter = itemgetter(*[slice(a, b) for a, b in zip([0] + boundaries, boundaries + [None])])
+    padding = ("",) * (num_columns - len(boundaries) - 1)
+    strip = text.strip
+    if boundaries:
+        return [tuple(map(strip, getter(line))) + padding for line in lines]
+    else:
+        return [(strip(line),) + padding for line in lines]
+
+
+def convert_table_to_list(table, column_names):
+    """
+    ORIGINAL _cat TABLE PARSER, KEPT FOR COMPARISON (SEE bench_tables.py)
+    """
+    lines = [l for l in table.split("\n") if l.strip()]
+
+    # FIND THE COLUMNS WITH JUST SPACES
+    columns = []
+    for i, c in enumerate(zip(*lines)):
+        if all(r == " " for r in c):
+            columns.append(i)
+
+    columns = columns[0:len(column_names)-1]
+    for i, row in enumerate(lines):
+        yield wrap({c: r for c, r in zip(column_names, split_at(row, columns))})
+
+
+def split_at(row, columns):
+    output = []
+    last = 0
+    for c in columns:
+        output.append(row[last:c].strip())
+        last = c
+    output.append(row[last:].strip())
+    return output
+
+
+def text_to_bytes(size):
+    if size == "":
+        return 0
+
+    multiplier = {
+        "kb": 1000,
+        "mb": 1000000,
+        "gb": 1000000000
+    }.get(size[-2:])
+    if not multiplier:
+        multiplier = 1
+        if size[-1]=="b":
+            size = size[:-1]
+    else:
+        size = size[:-2]
+    try:
+        return float(size) * float(multiplier)
+    except Exception as e:
+        Log.error("not expected", cause=e)
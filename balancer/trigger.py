@@ -0,0 +1,111 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import, division, unicode_literals
+
+from mo_future import text
+from mo_http import http
+from mo_logs import Log
+from mo_threads import Till
+from mo_times import Date
+
+MIN_WAIT = 30  # SECONDS, SHORTEST TIME FROM THE START OF ONE CYCLE TO THE START OF THE NEXT
+MAX_WAIT = 600  # SECONDS, LONGEST WAIT WHEN NOTHING CHANGES
+POLL = 10  # SECONDS, LONGEST _cluster/health LONG-POLL
+
+HEALTH_FIELDS = ["status", "number_of_nodes", "active_shards", "relocating_shards", "initializing_shards", "unassigned_shards"]
+
+
+class CycleTrigger(object):
+    """
+    WAIT FOR THE NEXT BALANCING CYCLE
+
+    _cluster/health IS LONG-POLLED, WITH wait_for_active_shards SET TO ONE
+    MORE THAN NOW, SO THE REQUEST RETURNS AS SOON AS A SHARD STARTS, OR
+    AFTER poll SECONDS. A CYCLE STARTS AT ONCE WHEN
+    - A NODE IS LOST, OR JOINS
+    - THE CLUSTER TURNS RED, OR HAS MORE UNASSIGNED SHARDS
+    - A RECOVERY FINISHES
+    OTHERWISE THE WAIT DOUBLES, FROM min_wait UP TO max_wait, WHILE NOTHING CHANGES
+
+    BUT NO CYCLE STARTS WITHIN min_wait OF THE START OF THE LAST ONE, SO A
+    REBALANCE, WHERE RECOVERIES FINISH EVERY FEW SECONDS, DOES NOT RUN
+    CYCLES BACK TO BACK
+    """
+
+    def __init__(self, path, min_wait=MIN_WAIT, max_wait=MAX_WAIT, poll=POLL):
+        self.path = path
+        self.min_wait = min_wait
+        self.max_wait = max(min_wait, max_wait)
+        self.poll = poll
+        self.backoff = min_wait
+        self.last = None  # THE LAST _cluster/health SEEN
+        self.started = Date.now().unix  # WHEN THE LAST CYCLE STARTED; THE FIRST STARTS RIGHT AFTER THIS
+
+    def wait(self, limit, please_stop):
+        """
+        :param limit: LONGEST WAIT, IN SECONDS (LIKE WHEN A RECOVERY IS EXPECTED TO FINISH); min_wait STILL APPLIES
+        :return: THE REASON THE WAIT ENDED
+        """
+        end = Date.now().unix + min(self.backoff, limit)
+        reason = None
+        while not please_stop:
+            remaining = end - Date.now().unix
+            if remaining <= 0:
+                break
+            health = self._health(max(1, int(min(self.poll, remaining))))
+            if health is None:
+                (Till(seconds=min(self.poll, remaining)) | please_stop).wait()
+                continue
+            reason = self._event(health)
+            if reason:
+                break
+
+        if reason:
+            self.backoff = self.min_wait
+        else:
+            self.backoff = min(self.backoff * 2, self.max_wait)
+            reason = "no change"
+        (Till(till=self.started + self.min_wait) | please_stop).wait()
+        self.started = Date.now().unix
+        return reason
+
+    def _health(self, timeout):
+        """
+        :return: _cluster/health, AFTER WAITING UP TO timeout SECONDS FOR A SHARD TO START; None IF NOT AVAILABLE
+        """
+        url = self.path + "/_cluster/health?filter_path=" + ",".join(HEALTH_FIELDS) + "&timeout=" + text(timeout) + "s"
+        if self.last is not None:
+            url += "&wait_for_active_shards=" + text(self.last.active_shards + 1)
+        try:
+            # ES RESPONDS 408, WITH THE HEALTH, WHEN THE WAIT TIMES OUT
+            return http.get_json(url, timeout=timeout + POLL)
+        except Exception as e:
+            Log.warning("Can not get cluster health", cause=e)
+            return None
+
+    def _event(self, health):
+        """
+        :return: REASON TO START A CYCLE, OR None
+        """
+        last, self.last = self.last, health
+        if last is None:
+            return None
+        if health.number_of_nodes < last.number_of_nodes:
+            return "node lost"
+        if health.number_of_nodes > last.number_of_nodes:
+            return "node joined"
+        if health.status == "red" and last.status != "red":
+            return "cluster is red"
+        if health.unassigned_shards > last.unassigned_shards:
+            return "more unassigned shards"
+        if (
+            health.active_shards > last.active_shards or
+            health.relocating_shards < last.relocating_shards or
+            health.initializing_shards < last.initializing_shards
+        ):
+            return "recovery finished"
+        return None
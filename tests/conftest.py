@@ -0,0 +1,49 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# RUN FROM THE REPO ROOT WITH
+#
+#     python -m pytest tests
+#
+from __future__ import absolute_import, division, unicode_literals
+
+import json
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for p in (os.path.join(ROOT, "vendor"), ROOT):  # SAME AS export PYTHONPATH=.:vendor
+    if p not in sys.path:
+        sys.path.insert(0, p)
+
+
+class FakeHttp(object):
+    """
+    ANSWER EVERY GET WITH rows, AS JSON
+    """
+
+    def __init__(self):
+        self.rows = []
+
+    def get(self, url, **kwargs):
+        from balancer.recorder import RecordedResponse
+
+        return RecordedResponse(200, json.dumps(self.rows).encode("utf8"))
+
+
+@pytest.fixture
+def cat(monkeypatch):
+    """
+    POINT balancer.tables AT A FakeHttp; SET ITS rows TO THE _cat RESPONSE
+    """
+    from balancer import tables
+
+    fake = FakeHttp()
+    monkeypatch.setattr(tables, "http", fake)
+    monkeypatch.setattr(tables, "json_supported", {})
+    return fake
@@ -0,0 +1,91 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import, division, unicode_literals
+
+from mo_dots import Data
+
+from balancer.cycle import CycleState
+from balancer.model import Allocation
+
+
+def node(name, zone="spot", memory=64, roles=("data",)):
+    return Data(name=name, zone=Data(name=zone), memory=memory, roles=list(roles))
+
+
+def shard(index, i, node_name, status="STARTED", type_="p"):
+    return Data(index=index, i=i, type=type_, status=status, node=Data(name=node_name))
+
+
+NODES = [node("a"), node("b")]
+SHARDS = [shard("repo", 0, "a"), shard("repo", 0, "b", type_="r"), shard("task", 0, "a")]
+
+
+def test_first_cycle_reviews_everything():
+    state = CycleState()
+    delta = state.update(NODES, SHARDS)
+    assert delta.all_indexes
+    assert delta.new_shards == 3
+    assert delta.indexes == {"repo", "task"}
+
+
+def test_no_change():
+    state = CycleState()
+    state.update(NODES, SHARDS)
+    state.replicas_per_zone = {"repo": {}, "task": {}}
+    delta = state.update(NODES, SHARDS)
+    assert not delta.all_indexes
+    assert delta.indexes == set()
+    assert (delta.new_shards, delta.removed_shards, delta.changed_shards) == (0, 0, 0)
+    assert not state.is_affected(delta, "repo")
+
+
+def test_shard_change_affects_only_its_index():
+    state = CycleState()
+    state.update(NODES, SHARDS)
+    state.replicas_per_zone = {"repo": {}, "task": {}}
+    moved = [shard("repo", 0, "a", "RELOCATING"), shard("repo", 0, "b", type_="r"), shard("task", 0, "a"), shard("task", 1, None, "UNASSIGNED")]
+    delta = state.update(NODES, moved)
+    assert not delta.all_indexes
+    assert delta.changed_shards == 1
+    assert delta.new_shards == 1
+    assert delta.indexes == {"repo", "task"}
+
+    delta = state.update(NODES, [shard("repo", 0, "a", "RELOCATING"), shard("repo", 0, "b", type_="r")])
+    assert delta.removed_shards == 2
+    assert delta.indexes == {"task"}
+    assert "task" not in state.replicas_per_zone
+    assert state.is_affected(delta, "task")
+    assert not state.is_affected(delta, "repo")
+
+
+def test_node_change_reviews_everything():
+    state = CycleState()
+    state.update(NODES, SHARDS)
+    state.allocation.add(Allocation("repo", NODES[0], 0, 1))
+    state.populated = {("repo", "a")}
+
+    delta = state.update([node("a", memory=128), node("b")], SHARDS)
+    assert delta.changed_nodes == ["a"]
+    assert delta.all_indexes
+    assert len(state.allocation) == 0
+    assert state.populated == set()
+
+    delta = state.update([node("a", memory=128), node("c")], SHARDS)
+    assert delta.joined == ["c"]
+    assert delta.lost == ["b"]
+    assert delta.all_indexes
+
+
+def test_dirty_index_is_affected_until_gone():
+    state = CycleState()
+    state.update(NODES, SHARDS)
+    state.replicas_per_zone = {"repo": {}, "task": {}}
+    state.dirty.add("task")
+    delta = state.update(NODES, SHARDS)
+    assert state.is_affected(delta, "task")
+    state.update(NODES, SHARDS[:2])
+    assert state.dirty == set()
@@ -0,0 +1,105 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import, division, unicode_literals
+
+from mo_dots import Data
+
+from balancer.forecast import DiskForecast
+from balancer.recovery import RecoveryTracker
+
+HOUR = 3600
+
+
+def recovery(shard, source, target, recovered, total):
+    return {
+        "index": "repo", "shard": str(shard), "type": "peer", "stage": "index",
+        "source_node": source, "target_node": target,
+        "bytes_recovered": str(recovered), "bytes_total": str(total)
+    }
+
+
+def node(name, free, disk=1000):
+    return Data(name=name, disk=disk, disk_free=free)
+
+
+def test_growth_does_not_count_recoveries(cat):
+    now = [0]
+    tracker = RecoveryTracker(clock=lambda: now[0])
+    forecast = DiskForecast("hour", "6hour", 0.10)
+
+    cat.rows = [recovery(0, "a", "b", 0, 100)]
+    tracker.refresh("http://es:9200")
+    forecast.observe([node("b", 500)], tracker, now[0])
+    assert forecast.growth["b"] is None  # ONE SAMPLE
+
+    now[0] = 100
+    cat.rows = [recovery(0, "a", "b", 50, 100)]
+    tracker.refresh("http://es:9200")
+    forecast.observe([node("b", 440)], tracker, now[0])
+    assert forecast.growth["b"] == 0.1  # 60 BYTES USED, 50 OF THEM BY THE RECOVERY
+    assert forecast.pending["b"] == 50
+
+
+def test_interval_where_recovery_ends_is_skipped(cat):
+    now = [0]
+    tracker = RecoveryTracker(clock=lambda: now[0])
+    forecast = DiskForecast("hour", "6hour", 0.10)
+    for t, free, rows in [
+        (0, 500, []),
+        (100, 490, []),
+        (200, 380, [recovery(0, "a", "b", 100, 100)]),  # 100 BYTES ARRIVED AT ONCE
+        (300, 370, []),
+    ]:
+        now[0] = t
+        cat.rows = rows
+        tracker.refresh("http://es:9200")
+        forecast.observe([node("b", free)], tracker, now[0])
+    assert forecast.growth["b"] == 0.1
+
+
+def test_relocation_source_counts_bytes_leaving(cat):
+    tracker = RecoveryTracker(clock=lambda: 0)
+    forecast = DiskForecast("hour", "6hour", 0.10)
+    cat.rows = [recovery(0, "a", "b", 0, 300), recovery(1, "a", "c", 0, 200)]
+    tracker.refresh("http://es:9200")
+    # ONLY shard 0 IS SHOWN RELOCATING IN _cat/shards; shard 1 IS A NEW REPLICA
+    tracker.set_relocating([Data(index="repo", shard=0, source_node="a", target_node="b")])
+    forecast.observe([node("a", 200), node("b", 900), node("c", 900)], tracker, 0)
+    assert forecast.pending == {"a": -300, "b": 300, "c": 200}
+    assert forecast.time_to_full(node("a", 200)) is None  # FREES 300 SOON, NOT FILLING
+
+
+def test_fills_and_excess():
+    forecast = DiskForecast("hour", "6hour", 0.10)
+    forecast.growth = {"a": 50 / HOUR}
+    a = node("a", 200)
+    assert forecast.time_to_full(a) == 2 * HOUR  # 100 BYTES ABOVE THE FLOOR
+    assert forecast.fills(a)
+    assert forecast.excess(a) == 200  # 300 MORE IN 6 HOURS, ONLY 100 LEFT
+    assert not forecast.fills(node("a", 500))
+    assert forecast.fills(node("a", 500), extra=300)
+
+
+def test_evacuate_picks_little_more_than_needed():
+    forecast = DiskForecast("hour", "6hour", 0.10)
+    forecast.growth = {"a": 50 / HOUR}
+    shards = [Data(size=s) for s in [90, 60, 60, 40, 30, 5]]
+    chosen = forecast.evacuate(node("a", 200), shards)
+    assert sorted(s.size for s in chosen) == [30, 40, 60, 90]
+
+
+def test_evacuate_nothing_when_lasting_the_horizon():
+    forecast = DiskForecast("hour", "6hour", 0.10)
+    forecast.growth = {"a": 10 / HOUR}
+    assert forecast.evacuate(node("a", 200), [Data(size=100)]) == []
+
+
+def test_evacuate_everything_when_not_enough():
+    forecast = DiskForecast("hour", "6hour", 0.10)
+    forecast.growth = {"a": 50 / HOUR}
+    shards = [Data(size=s) for s in [50, 40]]
+    assert sorted(s.size for s in forecast.evacuate(node("a", 200), shards)) == [40, 50]
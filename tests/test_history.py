@@ -0,0 +1,75 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import, division, unicode_literals
+
+from mo_dots import Data
+
+from balancer.history import INDEX_COOLDOWN, MoveHistory, SHARD_COOLDOWN
+
+HOUR = 3600
+SHARD = Data(index="repo", i=0, size=100)
+OTHER = Data(index="repo", i=1, size=100)
+
+
+def history(now, **kwargs):
+    return MoveHistory(clock=lambda: now[0], **kwargs)
+
+
+def test_shard_cooldown_expires():
+    now = [0]
+    moves = history(now, shard_cooldown="hour")
+    moves.record(SHARD, "not started", 1, None, "a")
+
+    now[0] = HOUR - 1
+    assert moves.cooldown(SHARD, "not balanced") == SHARD_COOLDOWN
+    assert moves.cooldown(SHARD, "free_space") is None  # ONLY BALANCE IS SUPPRESSED
+    assert moves.cooldown(OTHER, "not balanced") is None
+
+    now[0] = HOUR
+    assert moves.cooldown(SHARD, "not balanced") is None
+
+
+def test_index_cooldown_only_after_balance():
+    now = [0]
+    moves = history(now, shard_cooldown="0second", index_cooldown="hour")
+    moves.record(SHARD, "not started", 1, None, "a")
+    assert moves.cooldown(OTHER, "not balanced") is None
+
+    moves.record(SHARD, "not balanced", 1, "a", "b")
+    now[0] = 10
+    assert moves.cooldown(OTHER, "not balanced") == INDEX_COOLDOWN
+
+
+def test_no_return_within_oscillation_window():
+    now = [0]
+    moves = history(now, oscillation_window="6hour")
+    moves.record(SHARD, "not balanced", 1, "a", "b")
+
+    now[0] = HOUR
+    assert moves.returns(SHARD, "slightly better balance") == {"a"}
+    assert moves.returns(SHARD, "free_space") == ()
+    assert moves.returns(OTHER, "not balanced") == ()
+
+    now[0] = 6 * HOUR
+    assert moves.returns(SHARD, "not balanced") == set()
+
+
+def test_prune_forgets_expired_moves():
+    now = [0]
+    moves = history(now, shard_cooldown="hour", oscillation_window="6hour")
+    moves.record(SHARD, "not balanced", 2, "a", "b")
+    assert moves.priority("repo", 0, "b") == 2
+
+    now[0] = 2 * HOUR
+    moves.prune()
+    assert (SHARD.index, SHARD.i) not in moves.shard_moved
+    assert moves.left[(SHARD.index, SHARD.i)] == {"a": 0}
+
+    now[0] = 24 * HOUR
+    moves.prune()
+    assert not moves.left
+    assert moves.priority("repo", 0, "b") is None
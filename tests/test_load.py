@@ -0,0 +1,61 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import, division, unicode_literals
+
+import pytest
+
+from balancer.load import MAX_CAPACITY, MIN_CAPACITY, LoadModel
+
+NODES = ["a", "b", "c"]
+
+
+def loaded(indexed, strength=None, nodes=NODES):
+    """
+    :param indexed: MAP FROM node name TO DOCUMENTS INDEXED IN 100 SECONDS, INTO ITS ONE SHARD
+    """
+    model = LoadModel(strength=strength)
+    model.observe([("repo", i, n, 0, 0, 0) for i, n in enumerate(sorted(indexed))], nodes, now=0)
+    model.observe([("repo", i, n, indexed[n], 0, 0) for i, n in enumerate(sorted(indexed))], nodes, now=100)
+    return model
+
+
+def test_no_rates_changes_nothing():
+    model = LoadModel()
+    model.observe([("repo", 0, "a", 100, 0, 0)], NODES, now=0)
+    for n in NODES + ["new"]:
+        assert model.score(n) == 1.0
+        assert model.capacity(n) == 1.0
+        assert model.weight(n, "repo", 0) == 1.0
+
+
+def test_busy_nodes_get_less():
+    model = loaded({"a": 500, "b": 400})  # c IS IDLE; MEAN IS 300
+    assert model.score("a") == pytest.approx(5 / 3)
+    assert model.capacity("a") == pytest.approx(0.6)
+    assert model.capacity("b") == pytest.approx(0.75)
+    assert loaded({"a": 500, "b": 400}, strength=0.5).capacity("a") == pytest.approx(0.75)
+
+
+def test_capacity_is_bounded():
+    model = loaded({"a": 900, "b": 100})
+    assert model.capacity("a") == MIN_CAPACITY  # SCORE 2.7
+    assert model.capacity("b") == MAX_CAPACITY  # SCORE 0.3
+    assert model.capacity("c") == MAX_CAPACITY  # IDLE
+
+
+def test_node_missing_from_stats_is_idle():
+    model = loaded({"a": 500, "b": 400})
+    assert model.score("c") == 0  # A DATA NODE WITH NO SHARD STATS
+    assert model.score("new") == 0  # A NODE THAT JOINED AFTER THE STATS WERE READ
+    assert model.capacity("new") == MAX_CAPACITY
+    assert model.weight("new", "repo", 0) == 1.0
+
+
+def test_counter_reset_keeps_rate():
+    model = loaded({"a": 500, "b": 400})
+    model.observe([("repo", 0, "a", 10, 0, 0), ("repo", 1, "b", 800, 0, 0)], NODES, now=200)  # a RESTARTED
+    assert model.rates[("repo", 0, "a")] == [5, 0, 0]
@@ -0,0 +1,72 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import, division, unicode_literals
+
+from mo_dots import wrap
+
+from balancer.patterns import IndexPatterns, IndexRules
+
+PATTERNS = ["saved*", "repo*", "repo-special", "re*", ".tasks", "*"]
+INDEXES = ["saved_1", "repo20201010", "repo-special", "release", "r", ".tasks", ".tasks2", "", "other"]
+
+
+def linear_first(patterns, index):
+    # THE ORIGINAL, ONE PATTERN AT A TIME
+    for i, p in enumerate(patterns):
+        if p.endswith("*") and index.startswith(p[:-1]):
+            return i
+        elif index == p:
+            return i
+    return len(patterns)
+
+
+def test_matches_in_pattern_order():
+    patterns = IndexPatterns(PATTERNS)
+    assert patterns.matches("repo-special") == (1, 2, 3, 5)
+    assert patterns.matches("release") == (3, 5)
+    assert patterns.matches(".tasks2") == (5,)
+
+
+def test_first_same_as_linear_search():
+    for patterns in (PATTERNS, PATTERNS[:-1], []):
+        compiled = IndexPatterns(patterns)
+        for index in INDEXES:
+            assert compiled.first(index) == linear_first(patterns, index), (patterns, index)
+
+
+def test_rules():
+    settings = wrap({
+        "allocate": [
+            {"name": ".tasks", "zone": "spot", "shards": 1},
+            {"name": "repo*", "zone": "spot", "shards": 2},
+            {"name": "repo2020*", "zone": "spot", "shards": 3},
+            {"name": "repo2020*", "zone": "primary", "shards": 4}
+        ],
+        "replication_priority": ["saved*", "repo*"]
+    })
+    rules = IndexRules(settings)
+    assert rules.override("repo20201010", "spot").shards == 2  # FIRST RULE FOR THE ZONE WINS
+    assert rules.override("repo20201010", "primary").shards == 4
+    assert rules.override(".tasks", "spot").shards == 1
+    assert rules.override(".tasks", "primary") == None
+    assert rules.override("other", "spot") == None
+    assert rules.replication_priority("saved_1") == 0
+    assert rules.replication_priority("repo20201010") == 1
+    assert rules.replication_priority("other") == 2
+
+
+def test_prune_forgets_deleted_indexes():
+    settings = wrap({"allocate": [{"name": "repo*", "zone": "spot", "shards": 2}], "replication_priority": ["repo*"]})
+    rules = IndexRules(settings)
+    for index in ("repo20201010", "repo20201011", "other"):
+        rules.override(index, "spot")
+        rules.replication_priority(index)
+    rules.prune({"repo20201011", "other"})
+    assert sorted(rules.overrides) == ["other", "repo20201011"]
+    assert sorted(rules.allocate_patterns.cache) == ["other", "repo20201011"]
+    assert sorted(rules.priority_patterns.cache) == ["other", "repo20201011"]
+    assert rules.override("repo20201010", "spot").shards == 2  # STILL ANSWERS, IF ASKED AGAIN
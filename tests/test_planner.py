@@ -0,0 +1,90 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import, division, unicode_literals
+
+from mo_dots import Data
+
+from balancer.model import Allocation, Allocations
+from balancer.planner import GlobalPlanner
+
+GB = 1000 * 1000 * 1000
+
+
+def cluster(*nodes, **max_allowed):
+    """
+    :param nodes: (name, disk_free, {index: shards on node}) TUPLES
+    :return: (nodes, allocation)
+    """
+    allocation = Allocations()
+    output = []
+    for name, disk_free, shards in nodes:
+        n = Data(name=name, disk=100 * GB, disk_free=disk_free * GB)
+        output.append(n)
+        for index, limit in max_allowed.items():
+            alloc = Allocation(index, n, 0, limit)
+            alloc.shards = [None] * shards.get(index, 0)
+            allocation.add(alloc)
+    return output, allocation
+
+
+def move(index, i, reason="not started", node=None, size=GB):
+    return Data(
+        shard=Data(index=index, i=i, size=size, node=Data(name=node)),
+        reason=reason,
+        mode_priority=1,
+        replication_priority=1
+    )
+
+
+def everywhere(nodes):
+    return lambda move: (move.shard.node.name, nodes, [1] * len(nodes))
+
+
+def test_spreads_new_shards():
+    nodes, allocation = cluster(("a", 80, {}), ("b", 80, {}), ("c", 80, {}), repo=2)
+    plan = list(GlobalPlanner(allocation).plan([move("repo", i) for i in range(3)], everywhere(nodes)))
+    assert sorted(d for _, _, d in plan) == ["a", "b", "c"]
+
+
+def test_only_choice_is_planned_first():
+    nodes, allocation = cluster(("a", 80, {}), ("b", 80, {}), repo=1)
+    anywhere = move("repo", 0)
+    only_a = move("repo", 1)
+
+    def destinations(m):
+        if m is only_a:
+            return None, nodes[:1], [1]
+        return None, nodes, [1, 1]
+
+    plan = list(GlobalPlanner(allocation).plan([anywhere, only_a], destinations))
+    assert [(m.shard.i, d) for m, _, d in plan] == [(1, "a"), (0, "b")]
+
+
+def test_balance_move_must_improve():
+    nodes, allocation = cluster(("a", 80, {"repo": 2}), ("b", 80, {"repo": 1}), repo=2)
+    plan = list(GlobalPlanner(allocation).plan([move("repo", 0, "not balanced", "a")], everywhere(nodes[1:])))
+    assert plan == []
+
+
+def test_full_disk_is_not_a_destination():
+    nodes, allocation = cluster(("a", 6, {}), ("b", 80, {}), repo=5)
+    plan = list(GlobalPlanner(allocation).plan([move("repo", i, size=2 * GB) for i in range(3)], everywhere(nodes)))
+    assert [d for _, _, d in plan] == ["b", "b", "b"]
+
+
+def test_rejected_move_gives_back_its_reservation():
+    nodes, allocation = cluster(("a", 80, {}), ("b", 80, {"repo": 2}), repo=2)
+    planner = GlobalPlanner(allocation)
+    first = move("repo", 0, "not balanced", "b")
+    plan = planner.plan([first], everywhere(nodes[:1]))
+    assert [d for _, _, d in plan] == ["a"]
+    assert planner.planned_shards == {("repo", "a"): 1, ("repo", "b"): -1}
+    assert planner.planned_bytes == {"a": GB}
+
+    planner.reserve(first.shard, "a", accepted=False)
+    assert planner.planned_shards == {("repo", "a"): 0, ("repo", "b"): 0}
+    assert planner.planned_bytes == {"a": 0}
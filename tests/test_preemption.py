@@ -0,0 +1,115 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import, division, unicode_literals
+
+from mo_dots import Data, Null, wrap
+
+from balancer.history import MoveHistory
+from balancer.model import Shard
+from balancer.preemption import Preemption
+from balancer.snapshot import ClusterSnapshot
+
+URGENT = Data(mode_priority=1)
+
+
+def node(name):
+    return Data(name=name, zone=Data(name="primary"))
+
+
+def cluster(*copies):
+    """
+    :param copies: (i, type, status, node name) OF INDEX "repo"
+    """
+    return ClusterSnapshot([Shard("repo", i, t, status, 10, 1000, None, node(n) if n else Null) for i, t, status, n in copies])
+
+
+def recovery(i, source, target, recovered=0, total=1000):
+    return Data(index="repo", shard=i, source_node=source, target_node=target, bytes_recovered=recovered, bytes_total=total)
+
+
+def history(*sent):
+    """
+    :param sent: (i, target node, mode_priority) OF THE MOVES THE BALANCER SENT
+    """
+    output = MoveHistory(clock=lambda: 0)
+    for i, target, priority in sent:
+        output.record(Data(index="repo", i=i, size=1000), "balance", priority, "a", target)
+    return output
+
+
+def replicated(*shards):
+    # EVERY SHARD HAS A STARTED COPY ON z, SO ANY OTHER COPY CAN BE CANCELLED
+    return cluster(*([(i, "p", "STARTED", "z") for i in shards] + [(i, "r", "INITIALIZING", None) for i in shards]))
+
+
+def test_urgent():
+    preemption = Preemption(wrap({}))
+    assert preemption.is_urgent(URGENT)
+    assert not preemption.is_urgent(Data(mode_priority=6))
+    assert not Preemption(wrap({"enabled": False})).is_urgent(URGENT)
+
+
+def test_only_balancer_moves_are_preempted():
+    preemption = Preemption(wrap({}))
+    preemption.blocked("b", "ingress", URGENT)
+    tracker = [recovery(0, "a", "b"), recovery(1, "a", "b")]
+    victims = preemption.victims(tracker, history((1, "b", 8)), replicated(0, 1))
+    assert [r.shard for r in victims] == [1]
+
+    preemption.blocked("b", "ingress", URGENT)
+    assert preemption.victims(tracker, history(), replicated(0, 1)) == []  # ES STARTED BOTH
+
+
+def test_least_urgent_least_copied_first():
+    preemption = Preemption(wrap({}))
+    tracker = [
+        recovery(0, "a", "b"),
+        recovery(1, "a", "b", recovered=100),
+        recovery(2, "a", "b", recovered=200),
+        recovery(3, "a", "b"),
+    ]
+    sent = history((0, "b", 6), (1, "b", 8), (2, "b", 8), (3, "b", 3))
+    preemption.blocked("b", "ingress", URGENT)
+    assert [r.shard for r in preemption.victims(tracker, sent, replicated(0, 1, 2, 3))] == [1]
+
+    # ONLY MORE URGENT THAN THE VICTIM CAN PREEMPT
+    preemption.blocked("b", "ingress", Data(mode_priority=8))
+    assert preemption.victims(tracker, sent, replicated(0, 1, 2, 3)) == []
+
+    # victim_priority IS THE MOST URGENT THAT CAN BE CANCELLED
+    preemption.blocked("b", "ingress", URGENT)
+    assert preemption.victims(tracker[3:], sent, replicated(3)) == []
+
+
+def test_most_urgent_need_first():
+    preemption = Preemption(wrap({"max_cancels": 1}))
+    tracker = [recovery(0, "a", "b"), recovery(1, "c", "d")]
+    sent = history((0, "b", 8), (1, "d", 8))
+    preemption.blocked("b", "ingress", Data(mode_priority=2))
+    preemption.blocked("c", "egress", Data(mode_priority=1))
+    assert [r.shard for r in preemption.victims(tracker, sent, replicated(0, 1))] == [1]
+
+
+def test_mostly_copied_is_left_to_finish():
+    preemption = Preemption(wrap({}))
+    preemption.blocked("b", "ingress", URGENT)
+    tracker = [recovery(0, "a", "b", recovered=600)]
+    assert preemption.victims(tracker, history((0, "b", 8)), replicated(0)) == []
+
+
+def test_only_primary_is_never_preempted():
+    tracker = [recovery(0, "a", "b")]
+    sent = history((0, "b", 8))
+
+    preemption = Preemption(wrap({}))
+    preemption.blocked("b", "ingress", URGENT)
+    alone = cluster((0, "p", "RELOCATING", "a"), (0, "r", "UNASSIGNED", None))
+    assert preemption.victims(tracker, sent, alone) == []
+
+    preemption.blocked("b", "ingress", URGENT)
+    with_replica = cluster((0, "p", "RELOCATING", "a"), (0, "r", "STARTED", "c"))
+    assert [r.shard for r in preemption.victims(tracker, sent, with_replica)] == [0]
@@ -0,0 +1,41 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import, division, unicode_literals
+
+import pytest
+from mo_http.big_data import bytes2zip
+from mo_json import value2json
+
+from balancer import tables
+from balancer.recorder import Replayer
+
+SHARDS_TEXT = "repo 0 p STARTED 10 1kb 10.0.0.1 spot_0001\n"
+
+
+def replayer(tmp_path, requests):
+    filename = tmp_path / "cycle_20201010_000000_000000.json.gz"
+    filename.write_bytes(bytes2zip(value2json({"time": 0, "requests": requests}).encode("utf8")))
+    return Replayer(str(filename))
+
+
+def test_replay_recorded_text_tables(tmp_path, monkeypatch):
+    monkeypatch.setattr(tables, "http", replayer(tmp_path, [
+        {"url": "/_cat/shards", "status": 200, "content": SHARDS_TEXT}
+    ]))
+    monkeypatch.setattr(tables, "json_supported", {})
+    assert tables.get_shards("http://es:9200") == [("repo", 0, "p", "STARTED", "10", 1000, "10.0.0.1", "spot_0001")]
+
+
+def test_not_recorded_is_an_error(tmp_path, monkeypatch):
+    monkeypatch.setattr(tables, "http", replayer(tmp_path, [
+        {"url": "/_cat/shards", "status": 200, "content": SHARDS_TEXT}
+    ]))
+    monkeypatch.setattr(tables, "json_supported", {})
+    with pytest.raises(Exception) as error:
+        tables.get_indices("http://es:9200")
+    assert "was not recorded" in str(error.value)
+    assert tables.json_supported == {}
@@ -0,0 +1,66 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import, division, unicode_literals
+
+from mo_dots import Data
+
+from balancer.recovery import RecoveryTracker
+
+# _cat/recovery?format=json OF AN ES 6 CLUSTER: A RELOCATION, A NEW REPLICA, AND A STORE RECOVERY
+ES6_RECOVERY = [
+    {"index": "repo20200101", "shard": "0", "type": "peer", "stage": "index", "source_node": "node-1", "target_node": "node-2", "bytes_recovered": "1000", "bytes_total": "4000"},
+    {"index": "repo20200101", "shard": "1", "type": "peer", "stage": "index", "source_node": "node-1", "target_node": "node-3", "bytes_recovered": "0", "bytes_total": "2000"},
+    {"index": "repo20200101", "shard": "2", "type": "existing_store", "stage": "translog", "source_node": "n/a", "target_node": "node-4", "bytes_recovered": "0", "bytes_total": "0"},
+]
+
+
+def tracker_at(cat, rows):
+    now = [0]
+    cat.rows = rows
+    return RecoveryTracker(clock=lambda: now[0]), now
+
+
+def test_store_recovery_has_no_source(cat):
+    tracker, _ = tracker_at(cat, ES6_RECOVERY)
+    assert tracker.refresh("http://es:9200")
+    store = [r for r in tracker if r.shard == 2][0]
+    assert store.source_node == None  # Null, NOT "n/a"
+    assert store.target_node == "node-4"
+
+
+def test_peer_relocation_found_from_cat_shards(cat):
+    tracker, _ = tracker_at(cat, ES6_RECOVERY)
+    tracker.refresh("http://es:9200")
+    assert tracker.relocations() == []  # _cat/recovery ALONE CAN NOT TELL
+
+    tracker.set_relocating([Data(index="repo20200101", shard=0, source_node="node-1", target_node="node-2")])
+    relocations = tracker.relocations()
+    assert [(r.index, r.shard, r.source_node, r.target_node) for r in relocations] == [("repo20200101", 0, "node-1", "node-2")]
+    assert tracker.target_nodes() == {"node-2", "node-3", "node-4"}
+
+
+def test_rate_between_refreshes(cat):
+    tracker, now = tracker_at(cat, ES6_RECOVERY)
+    tracker.refresh("http://es:9200")
+    rows = [dict(r) for r in ES6_RECOVERY]
+    rows[0]["bytes_recovered"] = "3000"
+    cat.rows = rows
+    now[0] = 10
+    tracker.refresh("http://es:9200")
+    r = [r for r in tracker if r.shard == 0][0]
+    assert r.delta == 2000
+    assert r.rate == 200
+    assert tracker.remaining(r) == 1000
+    assert tracker.eta(r) == 5
+    stalled = tracker.stalled(10)
+    assert [s.shard for s in stalled] == [1]  # COPYING, BUT NOTHING FOR 10 SECONDS
+
+
+def test_only_peer_recoveries_are_peers(cat):
+    tracker, _ = tracker_at(cat, ES6_RECOVERY)
+    tracker.refresh("http://es:9200")
+    assert sorted(r.shard for r in tracker if tracker.is_peer(r)) == [0, 1]
@@ -0,0 +1,82 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import, division, unicode_literals
+
+from mo_dots import Data, wrap
+
+from balancer.model import NamedIndex
+from balancer.rejections import DISK, OTHER, THROTTLED, ZONE_FULL, RejectionCache, failure_class
+
+MINUTE = 60
+DISK_REASON = "the node is above the high watermark cluster setting"
+ZONE_REASON = "there are too many shards on nodes for attribute [zone]"
+
+
+def nodes(*nodes):
+    return NamedIndex(nodes)
+
+
+def node(name, disk_free=100, started=1000):
+    return Data(name=name, disk_free=disk_free, started=started)
+
+
+def test_failure_class():
+    assert failure_class(ZONE_REASON) == ZONE_FULL
+    assert failure_class(DISK_REASON) == DISK
+    assert failure_class("reached the limit of incoming shard recoveries [2]") == THROTTLED
+    assert failure_class("something new") == OTHER
+    assert failure_class(None) == OTHER
+
+
+def test_rejection_expires_after_ttl():
+    now = [0]
+    cache = RejectionCache(wrap({"zone_full": "10minute"}), clock=lambda: now[0])
+    a = node("a")
+    assert cache.add("repo", 0, 10, a, ZONE_REASON) == ZONE_FULL
+    assert cache.nodes("repo", 0, 10, nodes(a)) == {"a"}
+    assert cache.nodes("repo", 1, 10, nodes(a)) == set()
+
+    now[0] = 10 * MINUTE
+    assert cache.nodes("repo", 0, 10, nodes(a)) == set()
+    assert len(cache) == 0
+
+
+def test_throttled_is_not_remembered():
+    cache = RejectionCache(clock=lambda: 0)
+    cache.add("repo", 0, 10, node("a"), "reached the limit of incoming shard recoveries [2]")
+    assert len(cache) == 0
+
+
+def test_restart_forgets_rejection():
+    cache = RejectionCache(clock=lambda: 0)
+    cache.add("repo", 0, 10, node("a", started=1000), ZONE_REASON)
+    assert cache.nodes("repo", 0, 10, nodes(node("a", started=1030))) == {"a"}  # JITTER, NOT A RESTART
+    assert cache.nodes("repo", 0, 10, nodes(node("a", started=5000))) == set()
+
+
+def test_disk_rejection_blocks_bigger_shards_until_space_frees():
+    cache = RejectionCache(clock=lambda: 0)
+    cache.add("repo", 0, 50, node("a", disk_free=100), DISK_REASON)
+    a = nodes(node("a", disk_free=120))
+    assert cache.nodes("other", 3, 60, a) == {"a"}
+    assert cache.nodes("other", 3, 40, a) == set()
+    assert cache.nodes("repo", 0, 50, nodes(node("a", disk_free=150))) == set()
+
+
+def test_expire():
+    now = [0]
+    cache = RejectionCache(wrap({"disk": "10minute", "other": "2minute"}), clock=lambda: now[0])
+    cache.add("repo", 0, 50, node("a"), DISK_REASON)
+    cache.add("repo", 1, 50, node("b"), "something new")
+    now[0] = 2 * MINUTE
+    cache.expire()
+    assert len(cache) == 1
+    assert "a" in cache.full
+    now[0] = 10 * MINUTE
+    cache.expire()
+    assert len(cache) == 0
+    assert not cache.full
@@ -0,0 +1,106 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import, division, unicode_literals
+
+import json
+
+import pytest
+from mo_dots import wrap
+
+from balancer import reroute
+from balancer.recorder import RecordedResponse
+from balancer.reroute import RerouteBatch, main_reason
+
+THROWS = "bad"  # A COMMAND TO THIS NODE MAKES THE WHOLE REQUEST FAIL
+DECLINES = "full"  # A COMMAND TO THIS NODE IS REJECTED BY A DECIDER
+
+
+class FakeMaster(object):
+    """
+    ANSWER _cluster/reroute LIKE ES: ONE EXPLANATION PER COMMAND, OR AN ERROR FOR THE WHOLE REQUEST
+    """
+
+    def __init__(self):
+        self.requests = []  # (dry_run, number of commands)
+        self.applied = []
+
+    def post(self, url, json=None, **kwargs):
+        commands = json["commands"]
+        dry_run = "dry_run=true" in url
+        self.requests.append((dry_run, len(commands)))
+        nodes = [c["move"]["to_node"] for c in commands]
+        if THROWS in nodes:
+            return respond(400, {"error": {"root_cause": [{"reason": "failed to resolve [bad]"}], "reason": "failed to resolve [bad]"}})
+        if not dry_run:
+            self.applied.extend(nodes)
+            return respond(200, {"acknowledged": True})
+        return respond(200, {"acknowledged": True, "explanations": [
+            {"decisions": [{"decision": "NO", "explanation": "the node is above the high watermark"}] if n == DECLINES else []}
+            for n in nodes
+        ]})
+
+
+def respond(code, body):
+    return RecordedResponse(code, json.dumps(body).encode("utf8"))
+
+
+def move(node):
+    return {"move": {"index": "repo", "shard": 0, "from_node": "a", "to_node": node}}
+
+
+@pytest.fixture
+def master(monkeypatch):
+    fake = FakeMaster()
+    monkeypatch.setattr(reroute, "http", fake)
+    return fake
+
+
+def test_one_request_per_batch(master):
+    batch = RerouteBatch("http://es:9200", 10)
+    for i in range(25):
+        batch.add(move("n" + str(i)), i=i)
+    entries = batch.flush()
+    assert all(e.accepted for e in entries)
+    assert master.requests == [(True, 10), (True, 10), (True, 5), (False, 10), (False, 10), (False, 5)]
+    assert len(batch) == 0
+
+
+def test_declined_command_is_not_sent(master):
+    batch = RerouteBatch("http://es:9200")
+    for n in ["a1", DECLINES, "a2"]:
+        batch.add(move(n))
+    entries = batch.flush()
+    assert [e.accepted for e in entries] == [True, False, True]
+    assert entries[1].reason == "(the node is above the high watermark)"
+    assert master.applied == ["a1", "a2"]
+
+
+def test_failing_command_found_by_bisection(master):
+    batch = RerouteBatch("http://es:9200")
+    nodes = ["n" + str(i) for i in range(8)]
+    nodes[5] = THROWS
+    for n in nodes:
+        batch.add(move(n))
+    entries = batch.flush()
+    assert [e.accepted for e in entries] == [n != THROWS for n in nodes]
+    assert entries[5].reason == "failed to resolve [bad]"
+    assert "failed to resolve [bad]" in entries[5].error
+    # ONLY THE FAILING HALF IS SPLIT AGAIN; THEN ONE REAL REQUEST
+    assert master.requests == [(True, 8), (True, 4), (True, 4), (True, 2), (True, 1), (True, 1), (True, 2), (False, 7)]
+    assert master.applied == [n for n in nodes if n != THROWS]
+
+
+def test_plan_only_sends_nothing(master):
+    batch = RerouteBatch("http://es:9200", plan_only=True)
+    batch.add(move(THROWS))
+    assert [e.accepted for e in batch.flush()] == [True]
+    assert master.requests == []
+
+
+def test_main_reason():
+    assert main_reason("[NO(the node is above the high watermark)]") == "(the node is above the high watermark)"
+    assert main_reason(wrap({"root_cause": [{"reason": "failed to resolve [bad]"}], "reason": "outer"})) == "failed to resolve [bad]"
@@ -0,0 +1,104 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import, division, unicode_literals
+
+import pytest
+from mo_dots import Data
+from mo_logs import Log
+
+pytest.importorskip("paramiko")
+
+from balancer.scanner import DirectoryScanner, SshPool, parse_directory
+
+UUIDS = {"uuid1": "repo20201010"}
+INDEX_DIR = "/data1/nodes/0/indices/uuid1"
+
+
+def test_parse_directory():
+    assert parse_directory(INDEX_DIR + "/11", UUIDS, "ip") == {"index": "repo20201010", "i": 11, "dir": INDEX_DIR + "/11"}
+    assert parse_directory(INDEX_DIR, UUIDS, "ip") is None
+    assert parse_directory(INDEX_DIR + "/11/index", UUIDS, "ip") is None
+    assert parse_directory(INDEX_DIR + "/_state", UUIDS, "ip") is None
+    assert parse_directory("/data1/nodes/0/indices/junk/3", UUIDS, "ip") is None
+    assert parse_directory("find: '/data2': No such file or directory", UUIDS, "ip") is None
+
+
+class Client(object):
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_release_closes_least_recently_used():
+    pool = SshPool(Data(), max_connections=2)
+    a, b, c = Client(), Client(), Client()
+    pool._release("a", a)
+    pool._release("b", b)
+    pool.idle.move_to_end("a")  # a WAS USED AGAIN
+    pool._release("c", c)
+    assert list(pool.idle) == ["a", "c"]
+    assert b.closed and not a.closed and not c.closed
+
+    pool.close()
+    assert a.closed and c.closed
+    assert not pool.idle
+
+
+class FakePool(object):
+    """
+    ANSWER find WITH THE DIRECTORIES OF EACH ip
+    """
+
+    def __init__(self, directories):
+        self.directories = directories
+
+    def run(self, ip, command):
+        if command.startswith("find"):
+            for d in self.directories[ip]:
+                yield d
+        else:
+            yield "/dev/xvda1  100G  50G  50G  50% /"
+
+
+def node(name):
+    return Data(name=name, ip=name)
+
+
+def test_scan_returns_every_node():
+    pool = FakePool({"a": [INDEX_DIR, INDEX_DIR + "/1"], "b": [INDEX_DIR + "/2"]})
+    scanner = DirectoryScanner(pool, UUIDS, lambda n: n.ip, threads=2)
+    found = {n.name: [d["i"] for d in dirs] for n, dirs in scanner.scan([node("a"), node("b")])}
+    assert found == {"a": [1], "b": [2]}
+
+
+def test_scan_survives_ip_lookup_failure():
+    def ip_of(n):
+        if n.name == "bad":
+            Log.error("Expecting an ip address for {{node}}", node=n.name)
+        return n.ip
+
+    pool = FakePool({"a": [INDEX_DIR + "/1"]})
+    scanner = DirectoryScanner(pool, UUIDS, ip_of, threads=1, timeout=10)
+    found = {n.name: dirs for n, dirs in scanner.scan([node("bad"), node("a")])}
+    assert found["bad"] == None
+    assert [d["i"] for d in found["a"]] == [1]
+
+
+def test_scan_times_out():
+    class Stuck(FakePool):
+        def run(self, ip, command):
+            if ip == "slow":
+                from time import sleep
+                sleep(3)
+            return FakePool.run(self, ip, command)
+
+    pool = Stuck({"a": [INDEX_DIR + "/1"], "slow": []})
+    scanner = DirectoryScanner(pool, UUIDS, lambda n: n.ip, threads=2, timeout=1)
+    found = [n.name for n, _ in scanner.scan([node("slow"), node("a")])]
+    assert found == ["a"]
@@ -0,0 +1,74 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import, division, unicode_literals
+
+from mo_dots import Data, wrap
+
+from balancer.model import NamedIndex, Shard
+from balancer.scheduler import RecoveryScheduler
+from balancer.snapshot import ClusterSnapshot
+
+# 10 BYTES/SECOND FOR 100 SECONDS: 1000 BYTES PER NODE; 1500 INTO THE spot ZONE
+SETTINGS = wrap({"recovery": {"ingress": 10, "egress": 10, "window": "100second"}})
+SPOT = Data(name="spot", ingress=15)
+PRIMARY = Data(name="primary")
+
+
+def cluster():
+    return NamedIndex([
+        Data(name="a", zone=SPOT),
+        Data(name="b", zone=SPOT),
+        Data(name="c", zone=PRIMARY),
+        Data(name="d", zone=PRIMARY),
+    ])
+
+
+def scheduler(relocating=(), snapshot=None):
+    output = RecoveryScheduler()
+    output.start(SETTINGS, cluster(), list(relocating), snapshot or ClusterSnapshot())
+    return output
+
+
+def test_node_budget():
+    s = scheduler()
+    assert s.can_send("c", 1) and s.can_receive("d", 1)
+    s.reserve("c", "d", 1000)
+    assert not s.can_send("c", 1)
+    assert not s.can_receive("d", 1)
+    assert s.can_receive("d", 2)  # URGENT MOVES GET A BIGGER BUDGET
+    assert s.can_send("d", 1) and s.can_receive("c", 1)  # THE OTHER DIRECTION IS NOT USED
+
+    s.reserve("c", "d", -1000)  # THE MOVE FINISHED
+    assert s.can_send("c", 1) and s.can_receive("d", 1)
+
+
+def test_zone_budget():
+    s = scheduler()
+    s.reserve("c", "a", 800)
+    assert s.can_receive("a", 1)  # 800 OF 1000 FOR THE NODE
+    s.reserve("d", "b", 800)
+    assert not s.can_receive("a", 1)  # 1600 OF 1500 FOR THE ZONE
+    assert not s.can_receive("b", 1)
+    assert s.can_send("a", 1)  # NO EGRESS LIMIT ON THE ZONE
+
+    s.reserve("d", "b", -800)
+    assert s.can_receive("a", 1)
+
+
+def test_start_counts_what_is_recovering():
+    nodes = cluster()
+    copies = [Shard("repo", 0, "p", "STARTED", 10, 1000, None, nodes["c"]), Shard("repo", 0, "r", "INITIALIZING", 10, 1000, None, nodes["d"])]
+    snapshot = ClusterSnapshot(copies)
+    s = scheduler(snapshot.with_status("RELOCATING", "INITIALIZING"), snapshot)
+    assert s.outbound == {"c": 1000} and s.inbound == {"d": 1000}
+    assert not s.can_send("c", 1)
+    assert not s.can_receive("d", 1)
+
+    # NEXT CYCLE, THE REPLICA HAS STARTED
+    snapshot.set_status(copies[1], "STARTED")
+    s.start(SETTINGS, nodes, snapshot.with_status("RELOCATING", "INITIALIZING"), snapshot)
+    assert s.can_send("c", 1) and s.can_receive("d", 1)
@@ -0,0 +1,104 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import, division, unicode_literals
+
+from mo_dots import Data, Null
+
+from balancer.model import Shard
+from balancer.snapshot import ClusterSnapshot
+
+
+def node(name, zone="primary"):
+    return Data(name=name, zone=Data(name=zone))
+
+
+def shard(index, i, type_, status, node_=Null, size=1000):
+    return Shard(index, i, type_, status, 10, size, None, node_)
+
+
+def test_only_primary():
+    a, b, c = node("a"), node("b"), node("c")
+    snapshot = ClusterSnapshot([
+        shard("repo", 0, "p", "RELOCATING", a),
+        shard("repo", 0, "r", "UNASSIGNED"),
+        shard("repo", 1, "p", "RELOCATING", a),
+        shard("repo", 1, "r", "STARTED", c),
+        shard("repo", 2, "p", "STARTED", a),
+        shard("repo", 2, "r", "INITIALIZING", b),
+    ])
+    assert snapshot.is_only_primary("repo", 0, "a", "b")  # MOVING THE ONLY COPY
+    assert not snapshot.is_only_primary("repo", 1, "a", "b")  # c HAS A STARTED COPY
+    assert not snapshot.is_only_primary("repo", 2, "a", "b")  # A NEW REPLICA; THE PRIMARY STAYS ON a
+
+
+def cluster():
+    a, b, c = node("a"), node("b"), node("c", zone="spot")
+    shards = [
+        shard("repo", 0, "p", "STARTED", a, 3000),
+        shard("repo", 0, "r", "INITIALIZING", b, 1000),
+        shard("repo", 1, "p", "STARTED", b, 2000),
+        shard("repo", 1, "r", "UNASSIGNED"),
+        shard("saved", 0, "p", "STARTED", a, 500),
+        shard("saved", 0, "r", "STARTED", c, 500),
+    ]
+    return ClusterSnapshot(shards), shards
+
+
+def keys(shards):
+    return sorted((s.index, s.i, s.type) for s in shards)
+
+
+def test_views():
+    snapshot, shards = cluster()
+    assert len(snapshot) == 6
+    assert keys(snapshot.index_shards("repo")) == [("repo", 0, "p"), ("repo", 0, "r"), ("repo", 1, "p"), ("repo", 1, "r")]
+    assert keys(snapshot.replicas("repo", 1)) == [("repo", 1, "p"), ("repo", 1, "r")]
+    assert keys(snapshot.on_node("a")) == [("repo", 0, "p"), ("saved", 0, "p")]
+    assert keys(snapshot.on_node_index("b", "repo")) == [("repo", 0, "r"), ("repo", 1, "p")]
+    assert keys(snapshot.in_zone("spot")) == [("saved", 0, "r")]
+    assert keys(snapshot.with_status("UNASSIGNED", "INITIALIZING")) == [("repo", 0, "r"), ("repo", 1, "r")]
+    assert [k for k, _ in snapshot.groups()] == [("repo", 0), ("repo", 1), ("saved", 0)]
+    assert [k for k, _ in snapshot.index_groups()] == ["repo", "saved"]
+
+
+def test_unknown_names_are_empty():
+    snapshot, _ = cluster()
+    assert snapshot.on_node("z") == []
+    assert snapshot.on_node_index("a", "other") == []
+    assert snapshot.index_shards("other") == []
+    assert snapshot.replicas("repo", 9) == []
+    assert snapshot.index_size("other") == 0
+
+
+def test_node_index_groups():
+    snapshot, _ = cluster()
+    groups = {k: keys(v) for k, v in snapshot.node_index_groups()}
+    assert groups == {
+        ("a", "repo"): [("repo", 0, "p")],
+        ("a", "saved"): [("saved", 0, "p")],
+        ("b", "repo"): [("repo", 0, "r"), ("repo", 1, "p")],
+        ("c", "saved"): [("saved", 0, "r")],
+    }
+    started = {k: keys(v) for k, v in snapshot.node_index_groups("STARTED")}
+    assert started[("b", "repo")] == [("repo", 1, "p")]
+    assert len(started) == 4
+
+
+def test_sizes_and_stats():
+    snapshot, shards = cluster()
+    snapshot.normalize_sizes()
+    assert shards[1].size == 3000  # A REPLICA IS AS BIG AS ITS BIGGEST COPY
+    assert snapshot.index_size("repo") == 3000 + 3000 + 2000 + 2000
+    assert snapshot.index_node_stats("repo", "STARTED") == {"a": (1, 3000), "b": (1, 2000)}
+
+
+def test_set_status_moves_row():
+    snapshot, shards = cluster()
+    snapshot.set_status(shards[1], "STARTED")
+    assert keys(snapshot.with_status("INITIALIZING")) == []
+    assert ("repo", 0, "r") in keys(snapshot.with_status("STARTED"))
+    assert snapshot.index_node_stats("repo", "STARTED")["b"] == (2, 3000)
@@ -0,0 +1,134 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import, division, unicode_literals
+
+import json
+
+import pytest
+
+from balancer import tables
+from balancer.recorder import RecordedResponse
+from balancer.tables import SHARD_NAMES, convert_table_to_list, parse_table, text_to_bytes
+
+SHARDS = [
+    ("repo-20201010", "0", "p", "STARTED", "1234", "10.2mb", "172.31.0.1", "spot_0001"),
+    ("repo-20201010", "0", "r", "RELOCATING", "1234", "10.2mb", "172.31.0.2", "spot_0002 -> 172.31.0.3 Xyz spot_0003"),
+    ("repo-20201010", "1", "p", "UNASSIGNED", "", "", "", ""),
+    ("task", "1", "r", "INITIALIZING", "", "0b", "172.31.0.4", "primary_0001"),
+]
+
+
+def table(rows):
+    """
+    LIKE _cat: EVERY COLUMN BUT THE LAST IS PADDED TO ITS WIDEST VALUE; A RELOCATING node HAS SPACES IN IT
+    """
+    widths = [max(len(r[c]) for r in rows) for c in range(len(rows[0]) - 1)]
+    return "".join(
+        " ".join(v.ljust(w) for v, w in zip(r, widths)) + " " + r[-1] + "\n"
+        for r in rows
+    )
+
+
+SHARD_TABLE = table(SHARDS)
+
+
+def test_parse_table_matches_original():
+    expected = [tuple(row[name] or "" for name in SHARD_NAMES) for row in convert_table_to_list(SHARD_TABLE, SHARD_NAMES)]
+    assert parse_table(SHARD_TABLE, len(SHARD_NAMES)) == expected
+    assert parse_table(SHARD_TABLE.encode("utf8"), len(SHARD_NAMES)) == expected
+
+
+def test_parse_table_keeps_blank_cells_and_relocating_node():
+    assert parse_table(SHARD_TABLE, len(SHARD_NAMES)) == SHARDS
+
+
+def test_parse_table_empty():
+    assert parse_table("", 4) == []
+    assert parse_table("\n\n", 4) == []
+
+
+def test_text_to_bytes():
+    assert text_to_bytes("") == 0
+    assert text_to_bytes("0b") == 0
+    assert text_to_bytes("1234") == 1234
+    assert text_to_bytes("10.2mb") == 10.2 * 1000 * 1000
+    assert text_to_bytes("3gb") == 3 * 1000 * 1000 * 1000
+
+
+class TextOnly(object):
+    """
+    format=json WORKS ONLY FOR THE ENDPOINTS IN json_endpoints
+    """
+
+    def __init__(self, json_endpoints):
+        self.json_endpoints = json_endpoints
+        self.urls = []
+
+    def get(self, url, **kwargs):
+        self.urls.append(url)
+        endpoint = url.split("http://es:9200", 1)[1].split("?")[0]
+        if "format=json" not in url:
+            return RecordedResponse(200, SHARD_TABLE.encode("utf8"))
+        if endpoint not in self.json_endpoints:
+            return RecordedResponse(400, b'{"error": "unknown format"}')
+        return RecordedResponse(200, json.dumps([]).encode("utf8"))
+
+
+def test_json_support_is_per_endpoint(monkeypatch):
+    fake = TextOnly({"/_cat/indices"})
+    monkeypatch.setattr(tables, "http", fake)
+    monkeypatch.setattr(tables, "json_supported", {})
+
+    assert len(tables.get_shards("http://es:9200")) == 4
+    assert tables.get_indices("http://es:9200") == []
+    assert tables.json_supported == {"/_cat/shards": False, "/_cat/indices": True}
+
+    # THE FAILED ENDPOINT IS NOT ASKED FOR JSON AGAIN
+    fake.urls = []
+    tables.get_shards("http://es:9200")
+    assert fake.urls == ["http://es:9200/_cat/shards"]
+
+
+class Flaky(object):
+    """
+    FAIL THE FIRST REQUEST WITH code, THEN ANSWER WITH JSON
+    """
+
+    def __init__(self, code):
+        self.code = code
+        self.urls = []
+
+    def get(self, url, **kwargs):
+        self.urls.append(url)
+        if len(self.urls) == 1:
+            return RecordedResponse(self.code, b"service unavailable")
+        return RecordedResponse(200, json.dumps([]).encode("utf8"))
+
+
+def test_transient_error_does_not_disable_json(monkeypatch):
+    fake = Flaky(503)
+    monkeypatch.setattr(tables, "http", fake)
+    monkeypatch.setattr(tables, "json_supported", {})
+
+    with pytest.raises(Exception):
+        tables.get_indices("http://es:9200")
+    assert tables.json_supported == {}
+    assert tables.get_indices("http://es:9200") == []
+    assert tables.json_supported == {"/_cat/indices": True}
+    assert all("format=json" in u for u in fake.urls)
+
+
+def test_server_ignoring_format_uses_text(monkeypatch):
+    class Old(TextOnly):
+        def get(self, url, **kwargs):
+            self.urls.append(url)
+            return RecordedResponse(200, SHARD_TABLE.encode("utf8"))  # format=json IS IGNORED
+
+    monkeypatch.setattr(tables, "http", Old(set()))
+    monkeypatch.setattr(tables, "json_supported", {})
+    assert len(tables.get_shards("http://es:9200")) == 4
+    assert tables.json_supported == {"/_cat/shards": False}
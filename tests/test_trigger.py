@@ -0,0 +1,58 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import, division, unicode_literals
+
+from time import time
+
+import pytest
+from mo_dots import wrap
+from mo_threads import Signal
+
+from balancer import trigger
+from balancer.trigger import CycleTrigger
+
+
+class Recovering(object):
+    """
+    _cluster/health WHERE ANOTHER SHARD STARTS BEFORE EVERY RESPONSE
+    """
+
+    def __init__(self):
+        self.active = 100
+
+    def get_json(self, url, **kwargs):
+        self.active += 1
+        return wrap({"status": "green", "number_of_nodes": 3, "active_shards": self.active, "relocating_shards": 5, "initializing_shards": 0, "unassigned_shards": 0})
+
+
+@pytest.fixture
+def recovering(monkeypatch):
+    fake = Recovering()
+    monkeypatch.setattr(trigger, "http", fake)
+    return fake
+
+
+def test_event_waits_for_min_wait(recovering):
+    start = time()
+    t = CycleTrigger("http://es:9200", min_wait=1, max_wait=4, poll=1)
+    assert t.wait(10, Signal()) == "recovery finished"
+    first = time()
+    assert first - start >= 1
+
+    # THE NEXT EVENT COMES AT ONCE, BUT THE CYCLE STARTED ONLY NOW
+    assert t.wait(10, Signal()) == "recovery finished"
+    assert time() - first >= 1
+    assert t.backoff == 1
+
+
+def test_stop_ends_min_wait(recovering):
+    t = CycleTrigger("http://es:9200", min_wait=60, max_wait=120, poll=1)
+    please_stop = Signal()
+    please_stop.go()
+    start = time()
+    t.wait(10, please_stop)
+    assert time() - start < 5